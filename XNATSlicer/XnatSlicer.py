@@ -57,6 +57,7 @@ from XnatSlicerUtils import *
 from SettingsFile import *
 from Timer import *
 from Error import *
+from CacheIndex import *
 
 # module - ui
 from Viewer import *
@@ -74,6 +75,7 @@ from Settings_Cache import *
 from Settings_Metadata import *
 from Settings_Details import *
 from Settings_View import *
+from Settings_Save import *
 
 
 
@@ -159,6 +161,7 @@ class XnatSlicerWidget:
             self.parent.show()
 
         self.XnatIo = None 
+        self.Workflow_Save = None
         self.layout = self.parent.layout()
 
         XnatSlicerUtils.constructNecessaryModuleDirectories()
@@ -267,6 +270,7 @@ class XnatSlicerWidget:
       """
       """
       self.__initSettingsFile()
+      self.__initCacheIndex()
       self.__initSettings()
       self.__initLoginMenu()
       self.__initSearchBar()
@@ -301,6 +305,14 @@ class XnatSlicerWidget:
                     XnatSlicerGlobals.LOCAL_URIS['settings'], self)
       
 
+    def __initCacheIndex(self):
+      """
+      """
+      self.CacheIndex = CacheIndex(XnatSlicerGlobals.LOCAL_URIS['downloads'],
+                    os.path.join(XnatSlicerGlobals.LOCAL_URIS['metadata'], 
+                                 'cache.db'))
+      
+
     def __initNodeDetails(self):
       """
       """
@@ -342,6 +354,7 @@ class XnatSlicerWidget:
         """ 
         #print("'Close Scene' called. Resetting Xnat session data.")    
         self.View.sessionManager.clearCurrentSession()  
+        self.CacheIndex.unpin()
 
 
             
@@ -567,7 +580,9 @@ class XnatSlicerWidget:
         self.XnatIo = Xnat.io(\
         self.SettingsFile.getAddress(self.LoginMenu.hostDropdown.currentText), 
                     self.LoginMenu.usernameLine.text,
-                    self.LoginMenu.passwordLine.text)
+                    self.LoginMenu.passwordLine.text,
+                    os.path.join(XnatSlicerGlobals.LOCAL_URIS['metadata'], 
+                                 'metadata.db'))
 
         self.XnatIo.onEvent('jsonError', self.__jsonError)        
 
@@ -892,6 +907,7 @@ class XnatSlicerWidget:
         if self.LoginMenu.hostDropdown.currentText in self.__loggedIn and \
            self.__loggedIn[self.LoginMenu.hostDropdown.currentText]:
           self.__loggedIn[self.LoginMenu.hostDropdown.currentText] = False
+          self.XnatIo.closeSession()
           self. __contractCollapsibles(self.onLoginButtonClicked)
           return
 
@@ -920,8 +936,11 @@ class XnatSlicerWidget:
                   qt.QUrl(self.SettingsFile.\
                           getAddress(self.LoginMenu.hostDropdown.currentText))
             #
-            # Call the 'beginXnat' function from the MODULE.
+            # Close the session of the previous login (i.e. a different
+            # host), then call the 'beginXnat' function from the MODULE.
             #
+            if self.XnatIo:
+                self.XnatIo.closeSession()
             self.beginXnat()
         else:
             print MokaUtils.lf("The host '%s' doesn't appear to" + 
@@ -948,8 +967,13 @@ class XnatSlicerWidget:
         """     
         
         self.lastButtonClicked = "save" 
-        saver = Workflow_Save(self)
-        saver.beginWorkflow()
+
+        #--------------------
+        # Kept between saves: its uploads run in the background.
+        #--------------------
+        if not self.Workflow_Save:
+            self.Workflow_Save = Workflow_Save(self)
+        self.Workflow_Save.beginWorkflow()
 
 
         
@@ -1173,6 +1197,7 @@ class XnatSlicerWidget:
           ('METADATA', Settings_Metadata(_SettingsFile)),
           ('VIEW', Settings_View(_SettingsFile, 'View')),
           ('DETAILS' , Settings_Details(_SettingsFile)),
+          ('SAVE', Settings_Save(_SettingsFile)),
          ])
         return settingsDict
 
@@ -10,11 +10,24 @@ __status__ = "Production"
 
 
 import os
+import re
+import time
+import errno
+import socket
+import hashlib
 import urllib2
 import base64
 import urlparse
 import httplib
 import json
+import Queue
+import threading
+import cStringIO
+import collections
+import sqlite3
+import zlib
+import shutil
+import tarfile
 
 
 
@@ -91,10 +104,62 @@ class Xnat(object):
             'downloadQueueFinished',
             'downloadQueueStarted',
             'downloadFailed',
-            'jsonError'
+            'jsonError',
+            'uploadStarted',
+            'uploading',
+            'uploadFinished',
+            'uploadQueueStarted',
+            'uploadQueueFinished',
+            'uploadCancelled',
+            'uploadFailed',
+            'metadataChanged'
         ] 
 
-        def __init__(self, host, username, password):
+        MAX_REDIRECTS = 5
+        REDIRECT_STATUSES = [301, 302, 303, 307]
+        MAX_DOWNLOAD_STREAMS = 4
+        MAX_QUERY_STREAMS = 8
+        UPLOAD_CHUNK_SIZE = 256 * 1024
+        MAX_UPLOAD_STREAMS = 4
+        ARCHIVE_UPLOAD_MIN_FILES = 32
+        DOWNLOAD_RETRIES = 3
+        PARTIAL_SUFFIX = '.part'
+        PARTIAL_INFO_SUFFIX = '.part.json'
+        STREAM_ERRORS = (httplib.HTTPException, socket.error)
+        EVENT_DISPATCH_INTERVAL = 0.05
+        PROGRESS_INTERVAL = 0.1
+        MIN_BUFFER_SIZE = 8192
+        MAX_BUFFER_SIZE = 1024 * 1024
+        VERIFY_DIGESTS = True
+        ACCEPT_ENCODING = 'gzip, deflate'
+        SCAN_ID = re.compile('/scans/([^/]+)/')
+        SESSION_ID = re.compile('^[A-Za-z0-9._-]+$')
+        SESSION_COOKIE = re.compile('JSESSIONID=([A-Za-z0-9._-]+)')
+        SESSION_REFUSED_STATUSES = [401, 403, 404]
+
+
+
+        class digestError(httplib.HTTPException):
+            """
+            Raised when a downloaded file doesn't match the MD5 digest 
+            listed in its XNAT catalog.  As with a dropped connection, the 
+            download is retried.
+            """
+            pass
+
+
+
+        class uploadCancelled(Exception):
+            """
+            Raised by the body of an upload (see Xnat.uploadStream) once 
+            the upload is cancelled, which aborts the request.
+            """
+            pass
+
+
+
+        def __init__(self, host, username, password, 
+                     metadataStorePath = None):
             """ 
             Initializes the internal variables. 
 
@@ -107,9 +172,15 @@ class Xnat(object):
 
             @param password: The password for the XNAT host.
             @type password: string        
+
+            @param metadataStorePath: The optional SQLite file that metadata 
+                is persisted to (see Xnat.metadataStore), so that a later 
+                session can start from it.
+            @type metadataStorePath: string
             """
             
             self.downloadQueue = []        
+            self.uploadQueue = []
 
 
             #-------------------
@@ -121,15 +192,53 @@ class Xnat(object):
             self.password = password
 
 
-                
 
             #-------------------
-            # Make tracking dictionary for download modal.
+            # Download engine.  'maxDownloadStreams' is the number of 
+            # concurrent downloads allowed per host.  Events raised by the
+            # download workers are queued and run on the thread that created
+            # this instance (see 'runEventCallbacks').
             #-------------------
-            self.downloadTracker = {
-                'totalDownloadSize': {'bytes': None, 'MB': None},
-                'downloadedSize': {'bytes': None, 'MB': None},
-            }
+            self.maxDownloadStreams = Xnat.io.MAX_DOWNLOAD_STREAMS
+            self.__activeDownloads = {}
+            self.__queueCondition = threading.Condition(threading.RLock())
+            self.__eventQueue = Queue.Queue()
+            self.__eventThread = threading.current_thread()
+
+
+
+            #-------------------
+            # Upload engine.  Queued uploads are sent one at a time by a 
+            # single worker thread, so the caller isn't blocked (see 
+            # 'startUploadQueue').  'maxUploadStreams' is the number of 
+            # files of a directory upload sent at a time (see 'putFiles').
+            #-------------------
+            self.maxUploadStreams = Xnat.io.MAX_UPLOAD_STREAMS
+            self.__uploadCondition = threading.Condition(threading.RLock())
+            self.__uploadThread = None
+
+
+
+            #-------------------
+            # The 'downloading' and 'uploading' callbacks of a transfer are
+            # run at most once every 'progressInterval' seconds (see
+            # '__runProgressCallbacks').
+            #-------------------
+            self.progressInterval = Xnat.io.PROGRESS_INTERVAL
+            self.__progressTimes = {}
+            self.__progressLock = threading.Lock()
+
+
+
+            #-------------------
+            # Downloads given the MD5 digests of their files (as listed in 
+            # the XNAT catalogs) are checked against them as they are read, 
+            # if 'verifyDigests' is True.  The digests of the verified 
+            # files are kept in 'verifiedDigests', by local path, for the 
+            # caller to record.
+            #-------------------
+            self.verifyDigests = Xnat.io.VERIFY_DIGESTS
+            self.verifiedDigests = {}
 
 
             #-------------------
@@ -142,8 +251,43 @@ class Xnat(object):
 
 
 
+            #-------------------
+            # Requests authenticate with a JSESSION cookie, opened with the 
+            # Basic 'authHeader' on the first request (see '__getSession').  
+            # 'useSessions' is turned off if the host answers without one.
+            #-------------------
+            self.useSessions = True
+            self.__session = None
+            self.__sessionLock = threading.Lock()
+
+
+
+            #-------------------
+            # Keep-alive connections shared by every request made by this
+            # instance (metadata, uploads, deletes and downloads).
+            #-------------------
+            self.connectionPool = Xnat.connectionPool()
+
+
+
+            #-------------------
+            # Parsed JSON responses, revalidated with the host once they 
+            # expire and invalidated by 'putFile', 'putFolder' and 'delete'.
+            # Backed by an on-disk store if a path is given.
+            #-------------------
+            metadataStore = None
+            if metadataStorePath:
+                metadataStore = Xnat.metadataStore(metadataStorePath, 
+                                                   self.host, self.username)
+            self.metadataCache = Xnat.metadataCache(store = metadataStore)
+            self.__revalidating = set()
+            self.__revalidatingLock = threading.Lock()
+
 
-        def getFolder(self, folderUris, metadata = None, queryArgs = None):   
+
+
+        def getFolder(self, folderUris, metadata = None, queryArgs = None, 
+                      allowStale = False):   
             """ 
             Returns the contents of a given folder provided in the arguments
             'folderUris'.  Returns an object based on the 'metadata' argument
@@ -166,6 +310,13 @@ class Xnat(object):
                 See XNAT documentation for more details.  Default is no suffix. 
             @type queryArgs: string | list.<string>
 
+            @param allowStale: If True, expired cached contents (i.e. from a 
+                previous session) are returned straight away and 
+                revalidated in the background; 'metadataChanged' is run 
+                with the url if they turn out to have changed.  Defaults 
+                to False.
+            @type allowStale: boolean
+
             @return: A list of dicts describing the contents of the folders, 
                 with metadata as keys.
             @rtype: list.<dict>
@@ -186,25 +337,25 @@ class Xnat(object):
 
 
             #-------------------- 
-            # Acquire contents via 'self.__getJson'
+            # Make the full urls, applying query arguments, if any.
             #-------------------- 
-            contents = []
+            folderUrls = []
             for folderUri in folderUris:
-
-                #
-                # Apply query arguments, if any.
-                #
                 if queryArgs:
                     folderUri = Xnat.path.applyQueryArguments(folderUri, 
                                                               queryArgs)
+                folderUrls.append(Xnat.path.makeXnatUrl(self.host, folderUri))
 
 
-                #
-                # Get the JSON
-                #
-                folderUri = Xnat.path.makeXnatUrl(self.host, folderUri)
-                json = self.__getJson(folderUri)
 
+            #-------------------- 
+            # Acquire contents via 'self.__getJsonAll' (concurrently if 
+            # there are several folders).
+            #-------------------- 
+            contents = []
+            for folderUri, json in zip(folderUrls, 
+                                       self.__getJsonAll(folderUrls, 
+                                                         allowStale)):
                 #
                 # If json is null we have a login error.
                 # Return out.
@@ -212,9 +363,9 @@ class Xnat(object):
                 if json == None:
                     return None
                 #
-                # Otherwise, concatenate to rest of contents.
+                # Otherwise, add to rest of contents.
                 #
-                contents =  contents + json
+                contents.extend(json)
 
                 #
                 # If we want the projects, store projects in a dictionary. 
@@ -222,7 +373,7 @@ class Xnat(object):
                 # host or logs in a again.
                 #
                 if folderUri.endswith('/projects'):
-                    self.projectCache = contents
+                    self.projectCache = list(contents)
                 #print "CONTENTS", contents
             #-------------------- 
             # Exit out if there are non-Json or XML values.
@@ -236,19 +387,10 @@ class Xnat(object):
             # Get other attributes with the contents 
             # for metadata tracking.
             #-------------------- 
-            for content in contents:
-                if metadata:
-                    for metadataTag in metadata:
-                        if metadataTag in content:
-                            #
-                            # Create the object attribute if not there.
-                            #
-                            if not metadataTag in returnContents:
-                                returnContents[metadataTag] = []
-                            returnContents[metadataTag].append(\
-                                                    content[metadataTag])
-                else:
-                    returnContents = contents
+            if metadata:
+                returnContents = Xnat.metadata.toColumns(contents, metadata)
+            elif contents:
+                returnContents = contents
 
 
             #-------------------- 
@@ -276,7 +418,7 @@ class Xnat(object):
 
 
 
-        def getFile(self, _src, _dst): 
+        def getFile(self, _src, _dst, digest = None): 
             """ 
             Downloads a file from a given XNAT host.
 
@@ -285,23 +427,485 @@ class Xnat(object):
 
             @param _dst: The local dst to download to.
             @type: string
-            """
-
-            #--------------------
-            # Reset total size of downloads for all files
-            #-------------------------
-            self.downloadTracker['totalDownloadSize']['bytes'] = 0
-            self.downloadTracker['downloadedSize']['bytes'] = 0
-            downloadFolders = []
-
 
+            @param digest: The MD5 digest of the file, if known, to verify 
+                the download against.
+            @type: string
+            """
 
             #-------------------------
             # Remove existing dst files from their local URI
             #-------------------------
             if os.path.exists(_dst):
                 os.remove(_dst)
-            self.__getFile_urllib(_src, _dst)
+            self.__getFile_urllib(_src, _dst, digest)
+
+
+
+
+        def getFileExtracted(self, _src, _dstDir, digests = None):
+            """ 
+            Downloads a tar archive (plain, gzip or bzip2) from a given XNAT 
+            host, i.e. a '?format=tar.gz' folder download, extracting its 
+            files into '_dstDir' as the archive is read.  No archive is 
+            written to disk, and extraction is done when the download is.
+
+            As with MokaUtils.file.extractAllFiles, the directory structure 
+            within the archive is disregarded.  Files are extracted into 
+            '_dstDir' + '.part', which replaces '_dstDir' once the archive 
+            is complete.  Archives can't be resumed, so interrupted 
+            downloads start over (up to DOWNLOAD_RETRIES times).
+
+            @param _src: The source XNAT URL to download form.
+            @type: string
+
+            @param _dstDir: The local directory to extract to.
+            @type: string
+
+            @param digests: The MD5 digests of the files of the archive, by 
+                their XNAT URL, to verify them against.
+            @type: dict
+            """
+            xnatUrl = Xnat.path.makeXnatUrl(self.host, _src)
+            partDir = _dstDir + self.PARTIAL_SUFFIX
+            cancelled = self.__getCancelFlag(xnatUrl)
+
+            #
+            # The archive's files are extracted by name.
+            #
+            fileDigests = {}
+            for fileSrc, digest in (digests or {}).iteritems():
+                if digest:
+                    fileDigests[os.path.basename(fileSrc.split('?')[0])] = \
+                                                                    digest
+
+            attempt = 0
+            while True:
+                if os.path.exists(partDir):
+                    shutil.rmtree(partDir)
+                try:
+                    os.makedirs(partDir)
+                    response = self.__openStream(xnatUrl)
+                    try:
+                        if response.status >= 400:
+                            response.read()
+                            raise Exception("HTTP Error %s: %s"%(
+                                response.status, response.reason))
+                        extracted = self.__extractStream(xnatUrl, partDir, 
+                                                         response, cancelled,
+                                                         fileDigests)
+                    finally:
+                        self.connectionPool.release(response)
+                    break
+
+                except Xnat.io.STREAM_ERRORS, e:
+                    attempt += 1
+                    if attempt > self.DOWNLOAD_RETRIES or \
+                       cancelled.is_set():
+                        shutil.rmtree(partDir, True)
+                        self.__downloadFailed(_src, _dstDir, None, str(e))
+                        return
+                    print "Download of '%s' interrupted (%s).  Restarting..."%(
+                        _src, str(e))
+
+                except Exception, e:
+                    shutil.rmtree(partDir, True)
+                    self.__downloadFailed(_src, _dstDir, None, str(e))
+                    return
+
+
+
+            #-------------------- 
+            # Cancelled: discard what was extracted.
+            #-------------------- 
+            if extracted == None:
+                print "Cancelling download of '%s'"%(xnatUrl)
+                shutil.rmtree(partDir, True)
+                self.runEventCallbacks('downloadCancelled', xnatUrl)
+                return
+
+
+
+            #-------------------- 
+            # Finished: move the extracted files into place.
+            #-------------------- 
+            if os.path.exists(_dstDir):
+                shutil.rmtree(_dstDir)
+            os.rename(partDir, _dstDir)
+            if self.verifyDigests:
+                for filename, digest in fileDigests.iteritems():
+                    self.__setVerified(os.path.join(_dstDir, filename), 
+                                       digest)
+            self.removeFromDownloadQueue(xnatUrl)
+            self.runEventCallbacks('downloadFinished', xnatUrl)
+
+
+
+
+        def __extractStream(self, xnatUrl, dstDir, response, cancelled,
+                            digests, bufferSize = 65536):
+            """
+            Extracts the tar archive 'response' into 'dstDir' as it is read, 
+            running the download callbacks with the number of archive bytes 
+            read.  Files with a digest are verified as they are extracted.
+
+            @param xnatUrl: The url of the download.
+            @type xnatUrl: string
+
+            @param dstDir: The directory to extract to.
+            @type dstDir: string
+
+            @param response: The archive response.
+            @type response: httplib.HTTPResponse
+
+            @param cancelled: Set if the download is cancelled (see 
+                '__getCancelFlag').
+            @type cancelled: threading.Event
+
+            @param digests: The MD5 digests of the files, by file name.
+            @type digests: dict
+
+            @param bufferSize: The number of bytes extracted at a time.
+            @type bufferSize: integer
+
+            @return: The number of extracted files, or None if the download 
+                was cancelled.
+            @rtype: integer
+            """
+            size = self.getFileSize(xnatUrl)['bytes']
+            if not size and response.getheader('content-length'):
+                size = int(response.getheader('content-length'))
+            self.runEventCallbacks('downloadStarted', xnatUrl, size or -1)
+
+            reader = Xnat.progressReader(response, lambda read: 
+                        self.__runProgressCallbacks('downloading', xnatUrl, 
+                                                    read))
+            #
+            # A dropped connection surfaces from tarfile as a ReadError
+            # (i.e. 'unexpected end of data'): report it as the truncated
+            # read it is, so the download is retried.
+            #
+            try:
+                archive = tarfile.open(fileobj = reader, mode = 'r|*')
+                extracted = 0
+                for member in archive:
+                    if cancelled.is_set():
+                        return None
+                    filename = os.path.basename(member.name)
+                    if not member.isfile() or not filename:
+                        continue
+                    source = archive.extractfile(member)
+                    hasher = self.__getHasher(digests.get(filename))
+                    with open(os.path.join(dstDir, filename), 'wb') as target:
+                        while True:
+                            buffer = source.read(bufferSize)
+                            if not buffer:
+                                break
+                            target.write(buffer)
+                            if hasher:
+                                hasher.update(buffer)
+                            if cancelled.is_set():
+                                return None
+                    self.__checkDigest(filename, hasher, 
+                                       digests.get(filename))
+                    extracted += 1
+                archive.close()
+                self.__runProgressCallbacks('downloading', xnatUrl, 
+                                            reader.bytesRead, True)
+            except (tarfile.ReadError, tarfile.StreamError), e:
+                if getattr(response, 'length', None):
+                    raise httplib.IncompleteRead('', response.length)
+                raise
+
+            #
+            # See '__bufferRead'.
+            #
+            if getattr(response, 'length', None):
+                raise httplib.IncompleteRead('', response.length)
+            return extracted
+
+
+
+
+        def getFiles(self, _src, _files, _dstDir, digests = None, 
+                     keepPaths = False):
+            """ 
+            Downloads a set of files from a given XNAT host into '_dstDir', 
+            up to 'maxDownloadStreams' of them at a time, as a single 
+            download of '_src': the download callbacks are run for '_src' 
+            with the number of bytes read across all of the files.  This is 
+            the alternative to a '?format=zip' download of a folder, which 
+            the host has to build before sending the first byte.
+
+            As with 'getFileExtracted', the files are written flat into 
+            '_dstDir' + '.part' (unless 'keepPaths' is True), which 
+            replaces '_dstDir' once every file is in.  Files that finished 
+            before a failed download are kept there and skipped when it is 
+            retried.
+
+            @param _src: The XNAT URL of the folder being downloaded.
+            @type: string
+
+            @param _files: The XNAT URLs of the files to download, by their 
+                size in bytes (None if unknown).
+            @type: dict
+
+            @param _dstDir: The local directory to download to.
+            @type: string
+
+            @param digests: The MD5 digests of the files, by their XNAT URL, 
+                to verify them against.
+            @type: dict
+
+            @param keepPaths: If True, the files keep their paths below the 
+                'files' level of their resource (i.e. the 'Data' folder 
+                of a scene) rather than being written flat.
+            @type: boolean
+            """
+            xnatUrl = Xnat.path.makeXnatUrl(self.host, _src)
+            partDir = _dstDir + self.PARTIAL_SUFFIX
+            digests = digests or {}
+            cancelled = self.__getCancelFlag(xnatUrl)
+            if not os.path.exists(partDir):
+                os.makedirs(partDir)
+
+
+
+            #-------------------- 
+            # Queue the files that aren't already in 'partDir'.
+            #-------------------- 
+            pending = Queue.Queue()
+            progress = {'bytes': 0, 'error': None}
+            progressLock = threading.Lock()
+            for fileSrc, size in _files.iteritems():
+                filePath = os.path.join(partDir, 
+                                        self.__getFileName(fileSrc, keepPaths))
+                if os.path.exists(filePath):
+                    progress['bytes'] += os.path.getsize(filePath)
+                else:
+                    pending.put((fileSrc, filePath, digests.get(fileSrc)))
+            sizes = _files.values()
+            size = sum(sizes) if sizes and not None in sizes else -1
+            self.runEventCallbacks('downloadStarted', xnatUrl, size)
+
+
+
+            #-------------------- 
+            # Download the files, each on whichever worker is free.
+            #-------------------- 
+            def onRead(read):
+                with progressLock:
+                    progress['bytes'] += read
+                    downloaded = progress['bytes']
+                self.__runProgressCallbacks('downloading', xnatUrl, 
+                                            downloaded)
+
+            def isStopped():
+                return progress['error'] or cancelled.is_set()
+
+            def fetch():
+                while not isStopped():
+                    try:
+                        fileSrc, filePath, digest = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        self.__getQueuedFile(fileSrc, filePath, onRead, 
+                                             isStopped, digest)
+                    except Exception, e:
+                        progress['error'] = e
+
+            workers = []
+            for i in range(min(pending.qsize(), self.maxDownloadStreams)):
+                worker = threading.Thread(target = fetch)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+
+
+
+            #-------------------- 
+            # Failed: keep the finished files for the next attempt.
+            #-------------------- 
+            if progress['error']:
+                self.__downloadFailed(_src, _dstDir, None, 
+                                      str(progress['error']))
+                return
+
+
+            #-------------------- 
+            # Cancelled: discard what was downloaded.
+            #-------------------- 
+            if cancelled.is_set():
+                print "Cancelling download of '%s'"%(xnatUrl)
+                shutil.rmtree(partDir, True)
+                self.runEventCallbacks('downloadCancelled', xnatUrl)
+                return
+
+
+
+            #-------------------- 
+            # Finished: move the files into place.
+            #-------------------- 
+            if os.path.exists(_dstDir):
+                shutil.rmtree(_dstDir)
+            os.rename(partDir, _dstDir)
+            if self.verifyDigests:
+                for fileSrc, digest in digests.iteritems():
+                    self.__setVerified(os.path.join(_dstDir, 
+                        self.__getFileName(fileSrc, keepPaths)), digest)
+            self.__runProgressCallbacks('downloading', xnatUrl, 
+                                        progress['bytes'], True)
+            self.removeFromDownloadQueue(xnatUrl)
+            self.runEventCallbacks('downloadFinished', xnatUrl)
+
+
+
+
+        def __getFileName(self, fileSrc, keepPaths = False):
+            """
+            @param fileSrc: The XNAT URL of a file of 'getFiles'.
+            @type fileSrc: string
+
+            @param keepPaths: Whether to keep the path of the file below the
+                'files' level of its resource.
+            @type keepPaths: boolean
+
+            @return: The local path of the file, relative to the directory 
+                it is downloaded into.
+            @rtype: string
+            """
+            fileSrc = fileSrc.split('?')[0]
+            if keepPaths and '/files/' in fileSrc:
+                #
+                # Nothing is written outside of the download directory.
+                #
+                parts = [part for part in fileSrc.split('/files/', 1)[1].\
+                         split('/') if not part in ['', '.', '..']]
+                if parts:
+                    return os.path.join(*parts)
+            return os.path.basename(fileSrc)
+
+
+
+
+        def __getQueuedFile(self, fileSrc, filePath, onRead, isStopped, 
+                            digest = None):
+            """
+            Downloads one of the files of 'getFiles', restarting it if the 
+            connection drops or it doesn't match 'digest' (up to 
+            DOWNLOAD_RETRIES times).  The file is written to 'filePath' + 
+            '.part' and renamed once complete.
+
+            @param fileSrc: The XNAT URL of the file.
+            @type fileSrc: string
+
+            @param filePath: The local path to download to.
+            @type filePath: string
+
+            @param onRead: The callback run with the number of bytes read 
+                (negative if a restarted attempt's bytes are discarded).
+            @type onRead: function
+
+            @param isStopped: Returns True if the download should stop.
+            @type isStopped: function
+
+            @param digest: The MD5 digest of the file, if known.
+            @type digest: string
+            """
+            fileUrl = Xnat.path.makeXnatUrl(self.host, fileSrc)
+            partPath = filePath + self.PARTIAL_SUFFIX
+            if not os.path.exists(os.path.dirname(filePath)):
+                try:
+                    os.makedirs(os.path.dirname(filePath))
+                except OSError, e:
+                    # i.e. made by another worker.
+                    if e.errno != errno.EEXIST:
+                        raise
+            attempt = 0
+            while True:
+                read = 0
+                hasher = self.__getHasher(digest)
+                try:
+                    response = self.__openStream(fileUrl)
+                    try:
+                        if response.status >= 400:
+                            response.read()
+                            raise Exception("HTTP Error %s: %s (%s)"%(
+                                response.status, response.reason, fileUrl))
+                        with open(partPath, 'wb') as dstFile:
+                            for buffer in self.__readBuffers(response, 
+                                                             isStopped):
+                                dstFile.write(buffer)
+                                if hasher:
+                                    hasher.update(buffer)
+                                read += len(buffer)
+                                onRead(len(buffer))
+                    finally:
+                        self.connectionPool.release(response)
+                    if not isStopped():
+                        self.__checkDigest(fileUrl, hasher, digest)
+                    break
+
+                except Xnat.io.STREAM_ERRORS, e:
+                    onRead(-read)
+                    attempt += 1
+                    if attempt > self.DOWNLOAD_RETRIES or isStopped():
+                        raise
+                    print "Download of '%s' interrupted (%s).  Restarting..."%(
+                        fileUrl, str(e))
+
+            if isStopped():
+                os.remove(partPath)
+                return
+            os.rename(partPath, filePath)
+
+
+
+
+        def getScanFiles(self, experimentUri, metadata = None):
+            """ 
+            Returns the files of every scan of an experiment, from a single 
+            'scans/ALL/files' request rather than one request per scan.  
+            Files are grouped by the scan ID in their URI, in the order the 
+            scans are listed.
+
+            @param experimentUri: The URI of the experiment.
+            @type experimentUri: string
+
+            @param metadata: The metadata tags of the files to return, as 
+                with 'getFolder'.  Default is all metadata.
+            @type metadata: list.<string>
+
+            @return: The files of each scan, by scan ID, or None if the host 
+                can't list the files of all the scans at once.
+            @rtype: collections.OrderedDict
+            """
+            xnatUrl = Xnat.path.makeXnatUrl(self.host, 
+                            experimentUri.rstrip('/') + '/scans/ALL/files')
+            rows = self.__getJson(xnatUrl, reportErrors = False)
+            if rows == None:
+                return None
+
+            scans = collections.OrderedDict()
+            for row in rows:
+                match = Xnat.io.SCAN_ID.search(row.get('URI', ''))
+                if not match:
+                    return None
+                scans.setdefault(match.group(1), []).append(row)
+
+            #-------------------- 
+            # Track the files in the global dict, as 'getFolder' does.
+            #-------------------- 
+            for row in rows:
+                self.fileDict[row['Name']] = row
+
+            for scanId, rows in scans.iteritems():
+                scans[scanId] = Xnat.metadata.toColumns(rows, metadata) \
+                                if metadata else rows
+            return scans
 
 
 
@@ -348,6 +952,107 @@ class Xnat(object):
 
 
 
+        def iterFolder(self, folderUris, metadata = None, queryArgs = None):
+            """
+            Streaming version of 'getFolder': yields the contents of the 
+            folders one row at a time, as the response is parsed, instead 
+            of returning them once all of it has been read.  Meant for 
+            very large listings (i.e. the files of a DICOM scan).
+
+            Contents are cached as with 'getFolder': fresh cached contents
+            are used without a request, and expired ones are revalidated 
+            with 'If-None-Match'/'If-Modified-Since'.  Streamed rows are 
+            added to 'self.metadataCache' once the whole response is read.
+            Only the 'metadata' tags of each row are yielded.
+
+            @param folderUris: A string or list of URIs to retrieve the 
+                contents from.
+            @type folderUris: string | list.<string>
+
+            @param metadata: A list of metadata attributes to keep in each 
+                row.  Default is all metadata.
+            @type metadata: list.<string>
+
+            @param queryArgs: A string or list of query argument suffixes to 
+                apply.  See 'getFolder'.
+            @type queryArgs: string | list.<string>
+
+            @return: The rows of the folders, in order.  Stops early (after 
+                running the 'jsonError' callbacks) if the host answers with
+                an error, or a response isn't a JSON listing.
+            @rtype: generator.<dict>
+            """
+            if isinstance(folderUris, basestring):
+               folderUris = [folderUris]
+            if isinstance(queryArgs, basestring):
+               queryArgs = [queryArgs]
+
+            for folderUri in folderUris:
+                trackFiles = folderUri.replace('//', '/').endswith('/files')
+                if queryArgs:
+                    folderUri = Xnat.path.applyQueryArguments(folderUri, 
+                                                              queryArgs)
+                folderUrl = Xnat.path.makeXnatUrl(self.host, folderUri)
+
+                def select(row):
+                    # Tracks a row, as 'getFolder' does, and keeps its 
+                    # 'metadata' tags.
+                    if trackFiles:
+                        self.fileDict[row['Name']] = row
+                    return row if not metadata else \
+                        dict((tag, row[tag]) for tag in metadata 
+                             if tag in row)
+
+                #
+                # Use the cache if it's fresh.
+                #
+                cached = self.metadataCache.get(folderUrl)
+                if cached and cached.fresh():
+                    for row in cached.result:
+                        yield select(row)
+                    continue
+
+                #
+                # Otherwise revalidate expired contents, or parse the rows 
+                # as they are read, keeping them for the cache.
+                #
+                headers = cached.validators() if cached else {}
+                response = self.__httpsRequest('GET', folderUrl, 
+                                               headerAdditions = headers,
+                                               stream = True)
+                result = None
+                try:
+                    if cached and response.status == 304:
+                        response.read()
+                        self.metadataCache.refresh(folderUrl)
+                        result = cached.result
+                    elif response.status >= 400:
+                        self.runEventCallbacks('jsonError', self.host, 
+                                               self.username, 
+                                               response.read())
+                        return
+                    else:
+                        etag = response.getheader('etag')
+                        lastModified = response.getheader('last-modified')
+                        rows = []
+                        for row in Xnat.utils.iterJsonRows(response):
+                            rows.append(row)
+                            yield select(row)
+                        self.metadataCache.put(folderUrl, rows, etag, 
+                                               lastModified)
+                except ValueError, e:
+                    self.runEventCallbacks('jsonError', self.host, 
+                                           self.username, str(e))
+                    return
+                finally:
+                    self.connectionPool.release(response)
+
+                for row in result or []:
+                    yield select(row)
+
+
+
+
         def getFileSize(self, _uri):
             """ 
             Retrieves a tracked file's size and 
@@ -385,16 +1090,22 @@ class Xnat(object):
             _dst = str(Xnat.path.cleanUri(_dst)).encode('ascii', 'ignore')
             #print "XNAT 2", _dst, '\n\n'     
             response = self.__httpsRequest('PUT', _dst)
+            self.metadataCache.invalidate(_dst)
             return response
 
 
 
 
-        def putFile(self, _src, _dst, delExisting = True):
+        def putFile(self, _src, _dst, delExisting = True, cancelled = None):
             """ 
             Upload a file to an XNAT host.  Utilizes the internal
             method __httpsRequest.
 
+            The file is streamed from disk in UPLOAD_CHUNK_SIZE chunks 
+            rather than read into memory, so memory use doesn't grow with 
+            the size of the file.  Runs the 'uploadStarted', 'uploading' 
+            and 'uploadFinished' callbacks, which mirror the download ones.
+
             @param _src: The local source file to upload to.
             @type: string
 
@@ -404,54 +1115,508 @@ class Xnat(object):
             @param delExisting: Delete the exsting _dst if it exists in the 
                 XNAT host.   Defaults to 'True'.
             @type: boolean   
+
+            @param cancelled: The optional flag that cancels the upload 
+                when set, raising Xnat.io.uploadCancelled.
+            @type: threading.Event
+
+            @raise: Exception if the host refuses the DELETE (other than 
+                for a missing '_dst') or the file.
             """
+            _dst = str(Xnat.path.makeXnatUrl(self.host, _dst)).encode(\
+                                                        'ascii', 'ignore')
+            response = self.__putFile(_src, _dst, delExisting, cancelled)
+            self.runEventCallbacks('uploadFinished', _dst)
+            return response
 
 
-            #-------------------- 
-            # Read '_src' data.
-            #-------------------- 
-            f = open(_src, 'rb')
-            filebody = f.read()
-            f.close()
 
+        def __putFile(self, _src, _dst, delExisting = True, cancelled = None):
+            """
+            Uploads a file as 'putFile' does, except for running the 
+            'uploadFinished' callbacks, which is left to the caller (see 
+            '__uploadWorker').
 
+            @param _src: The local source file to upload.
+            @type: string
 
-            #-------------------- 
-            # Delete existing _dst from XNAT host.
-            #-------------------- 
-            if delExisting:
-                self.__httpsRequest('DELETE', _dst, '')
-            #print "%s Uploading\nsrc: '%s'\n_dst: '%s'"%(_src, _dst)
+            @param _dst: The XNAT url to upload to.
+            @type: string
+
+            @param delExisting: Delete the exsting _dst first.
+            @type: boolean
 
+            @param cancelled: The optional flag that cancels the upload.
+            @type: threading.Event
+
+            @return: The response of the host.
+            @rtype: Xnat.connectionPool.bufferedResponse
+            """
 
 
             #-------------------- 
-            # Clean '_dst' string and endcode
+            # Delete existing _dst from XNAT host.
             #-------------------- 
-            _dst = Xnat.path.makeXnatUrl(self.host, _dst)
-            _dst = str(_dst).encode('ascii', 'ignore')
+            if delExisting:
+                response = self.__httpsRequest('DELETE', _dst, '')
+                if response.status >= 400 and response.status != 404:
+                    raise Exception("HTTP Error %s: %s (DELETE %s)"%(
+                                    response.status, response.reason, _dst))
+            #print "%s Uploading\nsrc: '%s'\n_dst: '%s'"%(_src, _dst)
 
 
 
             #-------------------- 
             # Put the file in XNAT using the internal '__httpsRequest'
-            # method.
+            # method, streaming it from disk.
             #-------------------- 
-            response = self.__httpsRequest('PUT', _dst, filebody, 
-                            {'content-type': 'application/octet-stream'})
+            filebody = Xnat.uploadStream(_src, self.UPLOAD_CHUNK_SIZE, 
+                lambda uploaded: self.__runProgressCallbacks('uploading', 
+                                                             _dst, uploaded),
+                cancelled)
+            try:
+                self.runEventCallbacks('uploadStarted', _dst, filebody.size)
+                response = self.__putBody(_dst, filebody)
+            finally:
+                filebody.close()
+            self.__runProgressCallbacks('uploading', _dst, filebody.size, True)
+            self.metadataCache.invalidate(_dst)
             return response
 
 
 
-        def delete(self, _uri):
+        def putFiles(self, _srcDir, _dst, archive = None, overwrite = True, 
+                     cancelled = None):
             """ 
-            Deletes a given file or folder from an XNAT host.
+            Uploads the files of a local directory, and of its 
+            subdirectories, to a folder of an XNAT resource.  The files 
+            keep their paths below '_srcDir'.
+
+            Directories of ARCHIVE_UPLOAD_MIN_FILES files or more are sent 
+            as one request: a tar archive of the directory, generated as it 
+            is sent (see Xnat.archiveStream), which the host extracts 
+            ('?extract=true').  Smaller directories are sent file by file, 
+            up to 'maxUploadStreams' files at a time, which spares the host 
+            the extraction.  Either way, the upload callbacks are run for 
+            '_dst' with the number of bytes sent across all of the files, 
+            as 'getFiles' does for downloads.
+
+            @param _srcDir: The local directory to upload.
+            @type: string
 
-            @param _uri: The XNAT URI to run the "DELETE" method on.
+            @param _dst: The XNAT uri of the folder to upload to, i.e. 
+                '/data/experiments/E/resources/R/files'.
+            @type: string
+
+            @param archive: Whether to send the files as an archive.  
+                Chosen by the number of files if None.
+            @type: boolean
+
+            @param overwrite: Whether files already on the host are 
+                replaced (otherwise the host refuses them).  Unlike the 
+                'delExisting' of 'putFile', this costs no extra requests.
+            @type: boolean
+
+            @param cancelled: The optional flag that cancels the upload 
+                when set, raising Xnat.io.uploadCancelled.  Files already 
+                sent by a cancelled file-by-file upload are kept.
+            @type: threading.Event
+
+            @raise: Exception if the host refuses a file or the archive.
+            """
+            _dst = str(Xnat.path.makeXnatUrl(self.host, _dst)).encode(\
+                                                        'ascii', 'ignore')
+            self.__putFiles(_srcDir, _dst, archive, overwrite, cancelled)
+            self.runEventCallbacks('uploadFinished', _dst)
+
+
+
+        def __putFiles(self, _srcDir, _dst, archive = None, overwrite = True,
+                       cancelled = None):
+            """
+            Uploads a directory as 'putFiles' does, except for running the 
+            'uploadFinished' callbacks, which is left to the caller (see 
+            '__uploadWorker').
+
+            @param _srcDir: The local directory to upload.
+            @type: string
+
+            @param _dst: The XNAT url of the folder to upload to.
+            @type: string
+
+            @param archive: Whether to send the files as an archive.
+            @type: boolean
+
+            @param overwrite: Whether files already on the host are 
+                replaced.
+            @type: boolean
+
+            @param cancelled: The optional flag that cancels the upload.
+            @type: threading.Event
+            """
+            relPaths = []
+            for root, dirs, files in os.walk(_srcDir):
+                for fileName in files:
+                    relPaths.append(os.path.relpath(os.path.join(root, 
+                                                    fileName), _srcDir))
+            progress = {'bytes': 0}
+            progressLock = threading.Lock()
+            def onRead(read):
+                with progressLock:
+                    progress['bytes'] += read
+                    uploaded = progress['bytes']
+                self.__runProgressCallbacks('uploading', _dst, uploaded)
+
+            try:
+                self.__sendFiles(_srcDir, _dst, relPaths, 
+                    lambda size: self.runEventCallbacks('uploadStarted', 
+                                                        _dst, size),
+                    onRead, archive, overwrite, cancelled)
+            finally:
+                self.metadataCache.invalidate(_dst)
+            self.__runProgressCallbacks('uploading', _dst, progress['bytes'],
+                                        True)
+
+
+
+        def __sendFiles(self, _srcDir, _dst, relPaths, onStarted, onRead, 
+                        archive = None, overwrite = True, cancelled = None):
+            """
+            Sends files of a local directory to a folder of an XNAT 
+            resource, as one archive extracted by the host if there are 
+            ARCHIVE_UPLOAD_MIN_FILES of them or more, otherwise file by 
+            file, up to 'maxUploadStreams' files at a time (see 
+            'putFiles').
+
+            @param _srcDir: The local directory.
+            @type: string
+
+            @param _dst: The XNAT url of the folder to upload to.
+            @type: string
+
+            @param relPaths: The paths of the files to send, relative to 
+                '_srcDir'.
+            @type: list.<string>
+
+            @param onStarted: The callback run with the number of bytes 
+                to send (the size of the archive, or of the files), before
+                any are sent.
+            @type onStarted: function
+
+            @param onRead: The callback run with the number of bytes sent 
+                since it was last run (negative if a retried request's 
+                bytes are sent again).
+            @type onRead: function
+
+            @param archive: Whether to send the files as an archive.  
+                Chosen by the number of files if None.
+            @type: boolean
+
+            @param overwrite: Whether files already on the host are 
+                replaced.
+            @type: boolean
+
+            @param cancelled: The optional flag that cancels the upload.
+            @type: threading.Event
+
+            @raise: Exception if the host refuses a file or the archive, 
+                or Xnat.io.uploadCancelled.
+            """
+            folderUrl = _dst.rstrip('/')
+            query = '?overwrite=true' if overwrite else ''
+            cancelled = cancelled or threading.Event()
+            if archive == None:
+                archive = len(relPaths) >= self.ARCHIVE_UPLOAD_MIN_FILES
+
+            def makeOnRead():
+                # Bodies report the bytes read so far, which drop back 
+                # if the request is retried.
+                sent = [0]
+                def onBodyRead(bodyRead):
+                    onRead(bodyRead - sent[0])
+                    sent[0] = bodyRead
+                return onBodyRead
+
+
+
+            #-------------------- 
+            # One archive, extracted by the host.
+            #-------------------- 
+            if archive:
+                archiveUrl = '%s/%s.tar?extract=true%s'%(folderUrl, 
+                    os.path.basename(os.path.normpath(_srcDir)), 
+                    query.replace('?', '&'))
+                body = Xnat.archiveStream(_srcDir, self.UPLOAD_CHUNK_SIZE,
+                                          makeOnRead(), cancelled, relPaths)
+                try:
+                    onStarted(body.size)
+                    self.__putBody(archiveUrl, body)
+                finally:
+                    body.close()
+                return
+
+
+
+            #-------------------- 
+            # File by file, each on whichever worker is free.
+            #-------------------- 
+            onStarted(sum([os.path.getsize(os.path.join(_srcDir, relPath)) \
+                           for relPath in relPaths]))
+            pending = Queue.Queue()
+            for relPath in relPaths:
+                pending.put(relPath)
+            errors = []
+
+            def put():
+                while not errors and not cancelled.is_set():
+                    try:
+                        relPath = pending.get_nowait()
+                    except Queue.Empty:
+                        return
+                    body = Xnat.uploadStream(os.path.join(_srcDir, relPath),
+                                self.UPLOAD_CHUNK_SIZE, makeOnRead(), 
+                                cancelled)
+                    try:
+                        self.__putBody('%s/%s%s'%(folderUrl, relPath.replace(\
+                                                os.sep, '/'), query), body)
+                    except Exception, e:
+                        errors.append(e)
+                    finally:
+                        body.close()
+
+            workers = []
+            for i in range(min(len(relPaths), self.maxUploadStreams)):
+                worker = threading.Thread(target = put)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+            for worker in workers:
+                worker.join()
+
+            if errors:
+                raise errors[0]
+            if cancelled.is_set():
+                raise Xnat.io.uploadCancelled("Upload cancelled.")
+
+
+
+        def syncFiles(self, _src, _dst, _srcDir, _dstDir, cancelled = None):
+            """ 
+            Uploads a file that refers to the files of a directory (i.e. a 
+            scene's MRML) along with that directory, sending only the files
+            of the directory that changed:
+
+                1. The files of '_srcDir' whose size and MD5 digest match 
+                   those the host lists for them in '_dstDir' are skipped.
+                   The others are sent as 'putFiles' sends them.
+                2. '_src' is uploaded to '_dst', once they are all in.
+                3. The files of '_dstDir' that aren't in '_srcDir' are 
+                   deleted, once '_src' no longer refers to them.  A file 
+                   that can't be deleted is left for the next sync.
+
+            If the upload fails or is cancelled before '_src' is in, the 
+            host keeps its earlier '_src' and every file it refers to.  
+            The upload callbacks are run for '_dst', with the number of 
+            bytes sent across all of the files.
+
+            @param _src: The local file to upload.
+            @type: string
+
+            @param _dst: The XNAT dst to upload it to.
+            @type: string
+
+            @param _srcDir: The local directory of the files '_src' refers
+                to.
+            @type: string
+
+            @param _dstDir: The XNAT uri of the folder to upload them to, 
+                i.e. '/data/experiments/E/resources/R/files/scene'.
+            @type: string
+
+            @param cancelled: The optional flag that cancels the upload 
+                when set, raising Xnat.io.uploadCancelled.
+            @type: threading.Event
+
+            @raise: Exception if the host refuses a file.
+            """
+            _dst = str(Xnat.path.makeXnatUrl(self.host, _dst)).encode(\
+                                                        'ascii', 'ignore')
+            self.__syncFiles(_src, _dst, _srcDir, _dstDir, cancelled)
+            self.runEventCallbacks('uploadFinished', _dst)
+
+
+
+        def __syncFiles(self, _src, _dst, _srcDir, _dstDir, cancelled = None):
+            """
+            Syncs a file and its directory as 'syncFiles' does, except for 
+            running the 'uploadFinished' callbacks, which is left to the 
+            caller (see '__uploadWorker').
+
+            @param _src: The local file to upload.
+            @type: string
+
+            @param _dst: The XNAT url to upload it to.
+            @type: string
+
+            @param _srcDir: The local directory of the files '_src' refers
+                to.
+            @type: string
+
+            @param _dstDir: The XNAT uri of the folder to upload them to.
+            @type: string
+
+            @param cancelled: The optional flag that cancels the upload.
+            @type: threading.Event
+            """
+            cancelled = cancelled or threading.Event()
+            dstDir = Xnat.path.cleanUri(str(_dstDir))
+            dirName = dstDir.split('/files/', 1)[1]
+
+
+
+            #-------------------- 
+            # The files the host has in '_dstDir', by their path in it.
+            # Listed from the resource, which is listed whole.  Rows 
+            # without a digest (i.e. non-MD5 catalogs) count as changed.
+            #-------------------- 
+            listUrl = Xnat.path.makeXnatUrl(self.host, 
+                                dstDir.split('/files/', 1)[0] + '/files')
+            self.metadataCache.invalidate(listUrl)
+            # None if the resource is new.
+            rows = self.__getJson(listUrl, reportErrors = False) or []
+            remoteFiles = {}
+            for row in rows:
+                fileUri = row.get('URI', '')
+                fileName = fileUri.split('/files/', 1)[-1]
+                if fileName.startswith(dirName + '/'):
+                    remoteFiles[fileName[len(dirName) + 1:]] = \
+                        (fileUri, row.get('Size'), row.get('digest'))
+
+
+
+            #-------------------- 
+            # The files that changed.
+            #-------------------- 
+            relPaths = []
+            for root, dirs, files in os.walk(_srcDir):
+                for fileName in files:
+                    path = os.path.join(root, fileName)
+                    relPath = os.path.relpath(path, _srcDir)
+                    remote = remoteFiles.pop(relPath.replace(os.sep, '/'), 
+                                             None)
+                    if cancelled.is_set():
+                        raise Xnat.io.uploadCancelled("Upload cancelled.")
+                    if remote and remote[2] and \
+                       str(remote[1]) == str(os.path.getsize(path)) and \
+                       self.__getChecksum(path) == remote[2].lower():
+                        continue
+                    relPaths.append(relPath)
+
+
+
+            #-------------------- 
+            # Send them, then '_src'.
+            #-------------------- 
+            srcSize = os.path.getsize(_src)
+            progress = {'bytes': 0}
+            progressLock = threading.Lock()
+            def onRead(read):
+                with progressLock:
+                    progress['bytes'] += read
+                    uploaded = progress['bytes']
+                self.__runProgressCallbacks('uploading', _dst, uploaded)
+
+            try:
+                self.__sendFiles(_srcDir, Xnat.path.makeXnatUrl(self.host, 
+                                                                dstDir), 
+                    relPaths, 
+                    lambda size: self.runEventCallbacks('uploadStarted', 
+                                                        _dst, size + srcSize),
+                    onRead, cancelled = cancelled)
+                sent = [0]
+                def onSrcRead(srcRead):
+                    onRead(srcRead - sent[0])
+                    sent[0] = srcRead
+                body = Xnat.uploadStream(_src, self.UPLOAD_CHUNK_SIZE, 
+                                         onSrcRead, cancelled)
+                try:
+                    self.__putBody(_dst + '?overwrite=true', body)
+                finally:
+                    body.close()
+            finally:
+                self.metadataCache.invalidate(listUrl)
+            self.__runProgressCallbacks('uploading', _dst, progress['bytes'],
+                                        True)
+
+
+
+            #-------------------- 
+            # Delete the files '_src' no longer refers to.
+            #-------------------- 
+            for fileUri, size, digest in remoteFiles.values():
+                if cancelled.is_set():
+                    break
+                response = self.__httpsRequest('DELETE', fileUri, '')
+                if response.status >= 400 and response.status != 404:
+                    print "Unable to delete '%s': HTTP Error %s"%(fileUri, 
+                                                            response.status)
+            self.metadataCache.invalidate(listUrl)
+
+
+
+        def __getChecksum(self, path):
+            """
+            @param path: A local file.
+            @type path: string
+
+            @return: The MD5 digest of the file.
+            @rtype: string
+            """
+            hasher = hashlib.md5()
+            with open(path, 'rb') as f:
+                for buffer in iter(lambda: f.read(self.MAX_BUFFER_SIZE), ''):
+                    hasher.update(buffer)
+            return hasher.hexdigest()
+
+
+
+        def __putBody(self, xnatUrl, body):
+            """
+            PUTs a request body (an Xnat.uploadStream or 
+            Xnat.archiveStream) to the host.
+
+            @param xnatUrl: The XNAT url to PUT to.
+            @type xnatUrl: string
+
+            @param body: The body to send.
+            @type body: Xnat.uploadStream | Xnat.archiveStream
+
+            @return: The response of the host.
+            @rtype: Xnat.connectionPool.bufferedResponse
+
+            @raise: Exception if the host refuses the body.
+            """
+            response = self.__httpsRequest('PUT', xnatUrl, body, 
+                            {'content-type': 'application/octet-stream', 
+                             'content-length': str(body.size)})
+            if response.status >= 400:
+                raise Exception("HTTP Error %s: %s (%s)"%(response.status, 
+                                                    response.reason, xnatUrl))
+            return response
+
+
+
+        def delete(self, _uri):
+            """ 
+            Deletes a given file or folder from an XNAT host.
+
+            @param _uri: The XNAT URI to run the "DELETE" method on.
             @type: string
             """
             print "Deleting '%s'"%(_uri)
             response =  self.__httpsRequest('DELETE', _uri, '')
+            self.metadataCache.invalidate(Xnat.path.makeXnatUrl(self.host, 
+                                                                _uri))
 
 
 
@@ -529,6 +1694,7 @@ class Xnat(object):
             # on the releant columns.
             #--------------------       
             levels = ['projects', 'subjects', 'experiments']
+            searches = []
             for level in levels:
                 resultsDict[level] = []
                 for levelTag in levelTags[level]:
@@ -537,15 +1703,21 @@ class Xnat(object):
                     # Experiments: only search folders with images
                     #
                     if level == 'experiments':
-                        searchStr2 = searchStr + '&xsiType=xnat:mrSessionData'
+                        searches.append((level, searchStr + 
+                                         '&xsiType=xnat:mrSessionData'))
                         searchStr = searchStr + '&xsiType=xnat:petSessionData'
-                        resultsDict[level] = resultsDict[level] + \
-                                             self.__getJson(searchStr2)
-                    resultsDict[level] = resultsDict[level] + \
-                                         self.__getJson(searchStr)
+                    searches.append((level, searchStr))
 
 
 
+            #-------------------- 
+            # Run the queries concurrently, merging them in order.
+            #-------------------- 
+            results = self.__getJsonAll([searchStr for level, searchStr 
+                                         in searches])
+            for (level, searchStr), result in zip(searches, results):
+                if result:
+                    resultsDict[level].extend(result)
             return resultsDict
 
 
@@ -603,6 +1775,21 @@ class Xnat(object):
             if not event in self.EVENT_TYPES:
                 raise Exception("XnatIo (onEvent): invalid event type '%s'"%(\
                                                                     event))
+
+            #--------------------
+            # Events raised off the owning thread (i.e. by the download
+            # workers) are queued for 'dispatchEvents'.
+            #--------------------
+            if threading.current_thread() != self.__eventThread:
+                self.__eventQueue.put((event, args))
+                return
+
+            #--------------------
+            # Nothing to run if no callbacks were ever added.
+            #--------------------
+            if not hasattr(self, 'eventCallbacks__'):
+                return
+
             for callback in self.eventCallbacks__[event]:
                 #print "EVENT CALLBACK", event
                 callback(*args)
@@ -610,6 +1797,67 @@ class Xnat(object):
 
 
 
+        def __runProgressCallbacks(self, event, _src, progress, 
+                                   final = False):
+            """
+            Runs the 'downloading' or 'uploading' callbacks of a transfer,
+            at most once every 'progressInterval' seconds: the callbacks 
+            update the GUI, which costs more than reading a buffer.  The 
+            first update and the 'final' one are always run.
+
+            @param event: 'downloading' or 'uploading'.
+            @type event: string
+
+            @param _src: The url of the transfer.
+            @type _src: string
+
+            @param progress: The number of bytes transferred.
+            @type progress: integer
+
+            @param final: Whether this is the last update of the transfer.
+            @type final: boolean
+            """
+            now = time.time()
+            with self.__progressLock:
+                if final:
+                    self.__progressTimes.pop((event, _src), None)
+                else:
+                    last = self.__progressTimes.get((event, _src))
+                    if last != None and now - last < self.progressInterval:
+                        return
+                    self.__progressTimes[(event, _src)] = now
+            self.runEventCallbacks(event, _src, progress)
+
+
+
+
+        def dispatchEvents(self, timeout = 0):
+            """
+            Runs the event callbacks queued by other threads.  Must be called
+            from the thread that created this instance (i.e. the GUI thread).
+
+            @param timeout: The number of seconds to wait for an event if 
+                none are queued.
+            @type timeout: number
+
+            @return: The number of events dispatched.
+            @rtype: integer
+            """
+            dispatched = 0
+            while True:
+                try:
+                    if dispatched == 0 and timeout > 0:
+                        event, args = self.__eventQueue.get(True, timeout)
+                    else:
+                        event, args = self.__eventQueue.get(False)
+                except Queue.Empty:
+                    return dispatched
+                self.runEventCallbacks(event, *args)
+                dispatched += 1
+
+
+
+
         def clearEvents(self, eventKey = None):
             """
             Clears the event callbacks associated with the 'eventKey' 
@@ -619,6 +1867,9 @@ class Xnat(object):
             @param eventKey: The event key to clear.
             @type eventKey: string
             """
+            if not hasattr(self, 'eventCallbacks__'):
+                return
+
             if not eventKey:
                 for key in self.eventCallbacks__:
                     self.eventCallbacks__[key] = []
@@ -634,7 +1885,9 @@ class Xnat(object):
 
 
 
-        def addToDownloadQueue(self, _src, _dst):
+        def addToDownloadQueue(self, _src, _dst, extract = False, 
+                               files = None, digests = None, 
+                               keepPaths = False):
             """
             Adds a file to the download queue.
 
@@ -643,32 +1896,95 @@ class Xnat(object):
 
             @param _dst: The local dst to download to.
             @type: string
+
+            @param extract: If True, '_src' is a tar archive (i.e. 
+                '?format=tar.gz') that is extracted into the directory 
+                '_dst' as it downloads.  See 'getFileExtracted'.
+            @type: boolean
+
+            @param files: If provided, the files of the folder '_src' are 
+                downloaded individually into the directory '_dst' instead, 
+                by their size in bytes.  See 'getFiles'.
+            @type: dict
+
+            @param digests: The MD5 digests to verify the downloaded files 
+                against, by XNAT URL (the URL of '_src' itself if it is a 
+                single file).
+            @type: dict
+
+            @param keepPaths: Whether 'files' keep their paths below the 
+                'files' level of their resource.  See 'getFiles'.
+            @type: boolean
             """
-            self.downloadQueue.append({'src': _src, 'dst': _dst})
+            with self.__queueCondition:
+                self.downloadQueue.append({'src': _src, 'dst': _dst, 
+                                           'extract': extract, 
+                                           'files': files,
+                                           'digests': digests or {},
+                                           'keepPaths': keepPaths,
+                                           'cancelled': threading.Event()})
 
 
 
         def clearDownloadQueue(self):
             """
-            Clears the download queue.
+            Clears the download queue.  Downloads in progress are cancelled.
             """
             #print "CLEAR DOWNLOAD QUEUE"
-            self.downloadQueue = []
-            self.clearEvents()
+            with self.__queueCondition:
+                for dl in self.downloadQueue:
+                    dl['cancelled'].set()
+                self.downloadQueue = []
+                self.__queueCondition.notifyAll()
+
+            #--------------------
+            # Only the download callbacks are cleared: uploads run in 
+            # the background alongside downloads.
+            #--------------------
+            for eventKey in self.EVENT_TYPES:
+                if eventKey.startswith('download'):
+                    self.clearEvents(eventKey)
 
 
 
 
         def startDownloadQueue(self):
             """
-            Begins the the download queue.
+            Begins the the download queue.  
+
+            Up to 'maxDownloadStreams' files per host are downloaded at the 
+            same time by worker threads.  This method blocks until the queue 
+            is drained, running the download event callbacks on the calling 
+            thread as they arrive.
             """
 
             self.runEventCallbacks('downloadQueueStarted') 
-            while len(self.downloadQueue):
-                if self.downloadQueue[0]['dst'] != None:
-                    self.getFile(self.downloadQueue[0]['src'], 
-                                 self.downloadQueue[0]['dst'])
+
+            #--------------------
+            # Start the workers.
+            #--------------------
+            with self.__queueCondition:
+                hosts = set([self.__getDownloadHost(dl['src']) \
+                             for dl in self.downloadQueue])
+                workerCount = min(len(self.downloadQueue), 
+                                  self.maxDownloadStreams * len(hosts))
+            workers = []
+            for i in range(workerCount):
+                worker = threading.Thread(target = self.__downloadWorker)
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+
+
+            #--------------------
+            # Run the worker events on this thread until
+            # the workers are done.
+            #--------------------
+            while len([w for w in workers if w.is_alive()]):
+                self.dispatchEvents(Xnat.io.EVENT_DISPATCH_INTERVAL)
+            self.dispatchEvents()
+
             self.runEventCallbacks('downloadQueueFinished') 
             self.clearDownloadQueue()
 
@@ -687,9 +2003,10 @@ class Xnat(object):
             @return: boolean
             @rtype: string
             """
-            for dl in self.downloadQueue:
-                if _src in dl['src']:
-                    return True
+            with self.__queueCondition:
+                for dl in self.downloadQueue:
+                    if _src in dl['src']:
+                        return True
             return False
 
 
@@ -702,10 +2019,35 @@ class Xnat(object):
             @param _src: The source XNAT URL to remove from the download queue.
             @type: string
             """
-            for dl in self.downloadQueue:
-                if _src in dl['src']:
-                    self.downloadQueue.pop(self.downloadQueue.index(dl))
-                    return
+            with self.__queueCondition:
+                for dl in self.downloadQueue:
+                    if _src in dl['src']:
+                        self.downloadQueue.pop(self.downloadQueue.index(dl))
+                        dl['cancelled'].set()
+                        return
+
+
+
+        def __getCancelFlag(self, _src):
+            """
+            Returns the flag that is set once a download is no longer in 
+            the download queue (i.e. it was cancelled), so that transfers 
+            can check for cancellation between buffers without scanning 
+            the queue.
+
+            @param _src: The source XNAT URL of the download.
+            @type: string
+
+            @return: The flag, already set if '_src' isn't queued.
+            @rtype: threading.Event
+            """
+            with self.__queueCondition:
+                for dl in self.downloadQueue:
+                    if _src in dl['src']:
+                        return dl['cancelled']
+            cancelled = threading.Event()
+            cancelled.set()
+            return cancelled
 
 
 
@@ -727,388 +2069,2452 @@ class Xnat(object):
             self.removeFromDownloadQueue(_src) 
 
 
-            #-------------------- 
-            # Callbacks
-            #-------------------- 
-            self.runEventCallbacks('downloadCancelled', _src) 
+            #-------------------- 
+            # Callbacks
+            #-------------------- 
+            self.runEventCallbacks('downloadCancelled', _src) 
+
+
+            #-------------------- 
+            # Clear queue if there is nothing
+            # left in it.
+            #-------------------- 
+            if len(self.downloadQueue) == 0:
+                self.clearDownloadQueue()
+
+
+
+
+
+        def __getDownloadHost(self, _src):
+            """
+            @param _src: The source XNAT URL of a download.
+            @type _src: string
+
+            @return: The host that '_src' is downloaded from.
+            @rtype: string
+            """
+            return urlparse.urlparse(Xnat.path.makeXnatUrl(self.host, 
+                                                           _src)).netloc
+
+
+
+
+        def __nextDownload(self):
+            """
+            Claims the next queued download whose host has a free stream.  
+            Waits for a stream to free up if every queued download's host is 
+            busy.
+
+            @return: The claimed download queue item, or None if there is 
+                nothing left to claim.
+            @rtype: dict
+            """
+            with self.__queueCondition:
+                while True:
+                    waiting = False
+                    for dl in self.downloadQueue:
+                        if id(dl) in self.__activeDownloads or \
+                           dl['dst'] == None:
+                            continue
+                        host = self.__getDownloadHost(dl['src'])
+                        if self.__activeDownloads.values().count(host) < \
+                           self.maxDownloadStreams:
+                            self.__activeDownloads[id(dl)] = host
+                            return dl
+                        waiting = True
+                    if not waiting:
+                        return None
+                    self.__queueCondition.wait()
+
+
+
+
+        def __downloadWorker(self):
+            """
+            Download worker thread.  Downloads queued items until there are 
+            none left to claim.
+            """
+            while True:
+                dl = self.__nextDownload()
+                if not dl:
+                    return
+                try:
+                    if dl.get('files'):
+                        self.getFiles(dl['src'], dl['files'], dl['dst'], 
+                                      dl['digests'], dl['keepPaths'])
+                    elif dl.get('extract'):
+                        self.getFileExtracted(dl['src'], dl['dst'], 
+                                              dl['digests'])
+                    else:
+                        self.getFile(dl['src'], dl['dst'], 
+                                     dl['digests'].get(dl['src']))
+                except Exception, e:
+                    self.removeFromDownloadQueue(dl['src'])
+                    self.runEventCallbacks('downloadFailed', dl['src'], 
+                                           dl['dst'], str(e))
+                finally:
+                    with self.__queueCondition:
+                        self.__activeDownloads.pop(id(dl), None)
+                        self.downloadQueue[:] = [item for item in \
+                                        self.downloadQueue if item is not dl]
+                        self.__queueCondition.notifyAll()
+
+
+
+
+        def addToUploadQueue(self, _src, _dst, delExisting = True, 
+                             srcDir = None, dstDir = None):
+            """
+            Adds a file, or a directory, to the upload queue.
+
+            An earlier upload to the same '_dst' that is still queued, or 
+            in progress, is replaced: it is cancelled, and its 
+            'uploadFinished', 'uploadCancelled' or 'uploadFailed' 
+            callbacks aren't run, so those of '_dst' are this upload's.
+
+            @param _src: The local source file to upload.  Directories are
+                uploaded with 'putFiles'.
+            @type: string
+
+            @param _dst: The XNAT dst to upload to (the folder to upload 
+                into, for a directory).
+            @type: string
+
+            @param delExisting: Delete the exsting _dst if it exists in the 
+                XNAT host (see 'putFile'), or replace its files (see 
+                'putFiles').
+            @type: boolean
+
+            @param srcDir: The optional local directory of the files 
+                '_src' refers to, synced to 'dstDir' along with it (see 
+                'syncFiles').
+            @type: string
+
+            @param dstDir: The XNAT uri of the folder to sync 'srcDir' to.
+            @type: string
+
+            @return: The XNAT url of '_dst', which the upload events are 
+                run with.
+            @rtype: string
+            """
+            _dst = str(Xnat.path.makeXnatUrl(self.host, _dst)).encode(\
+                                                        'ascii', 'ignore')
+            with self.__uploadCondition:
+                for ul in self.uploadQueue:
+                    if ul['dst'] == _dst:
+                        ul['replaced'] = True
+                        ul['cancelled'].set()
+                self.uploadQueue.append({'src': _src, 'dst': _dst, 
+                                         'delExisting': delExisting,
+                                         'srcDir': srcDir, 
+                                         'dstDir': dstDir,
+                                         'cancelled': threading.Event(),
+                                         'replaced': False})
+            return _dst
+
+
+
+        def startUploadQueue(self):
+            """
+            Begins the upload queue, if it isn't running already.
+
+            Unlike 'startDownloadQueue', this method doesn't block: the 
+            queued files are uploaded one at a time by a worker thread.  
+            The upload event callbacks ('uploadStarted', 'uploading', 
+            'uploadFinished', 'uploadCancelled', 'uploadFailed' and 
+            'uploadQueueFinished') are queued for the caller to run with 
+            'dispatchEvents' (i.e. from a GUI timer) until 'isUploading' 
+            is False.
+            """
+            with self.__uploadCondition:
+                if self.__uploadThread or not self.uploadQueue:
+                    return
+                self.__uploadThread = threading.Thread(\
+                                            target = self.__uploadWorker)
+                self.__uploadThread.daemon = True
+
+            self.runEventCallbacks('uploadQueueStarted')
+            self.__uploadThread.start()
+
+
+
+        def isUploading(self):
+            """
+            @return: Whether the upload queue is running.
+            @rtype: boolean
+            """
+            with self.__uploadCondition:
+                return self.__uploadThread != None
+
+
+
+        def inUploadQueue(self, _dst):
+            """
+            Determines whether a given dst is in the upload queue.
+
+            @param _dst: The XNAT dst to check.
+            @type: string
+
+            @return: Whether '_dst' is queued or uploading (and not 
+                cancelled).
+            @rtype: boolean
+            """
+            with self.__uploadCondition:
+                for ul in self.uploadQueue:
+                    if _dst in ul['dst'] and not ul['cancelled'].is_set():
+                        return True
+            return False
+
+
+
+        def cancelUpload(self, _dst):
+            """
+            Cancels an upload, whether it is queued or in progress.  An
+            upload in progress is aborted before its next chunk is sent.
+            The worker runs the 'uploadCancelled' callbacks once it gets 
+            to the upload, so they follow any of its earlier events.
+
+            @param _dst: The XNAT dst of the upload.
+            @type: string
+            """
+            with self.__uploadCondition:
+                for ul in self.uploadQueue:
+                    if _dst in ul['dst']:
+                        ul['cancelled'].set()
+
+
+
+        def clearUploadQueue(self):
+            """
+            Cancels every upload in the upload queue.
+            """
+            with self.__uploadCondition:
+                for ul in self.uploadQueue:
+                    ul['cancelled'].set()
+
+
+
+        def __uploadWorker(self):
+            """
+            Upload worker thread.  Uploads the queued items in order until 
+            there are none left.
+            """
+            while True:
+                with self.__uploadCondition:
+                    if not self.uploadQueue:
+                        #
+                        # Queued before 'isUploading' turns False, so 
+                        # it is dispatched by the caller.
+                        #
+                        self.runEventCallbacks('uploadQueueFinished')
+                        self.__uploadThread = None
+                        return
+                    ul = self.uploadQueue[0]
+                try:
+                    if ul['cancelled'].is_set():
+                        raise Xnat.io.uploadCancelled("Upload cancelled.")
+                    if ul['srcDir']:
+                        self.__syncFiles(ul['src'], ul['dst'], ul['srcDir'],
+                                         ul['dstDir'], ul['cancelled'])
+                    elif os.path.isdir(ul['src']):
+                        self.__putFiles(ul['src'], ul['dst'], 
+                                        overwrite = ul['delExisting'],
+                                        cancelled = ul['cancelled'])
+                    else:
+                        self.__putFile(ul['src'], ul['dst'], 
+                                       ul['delExisting'], ul['cancelled'])
+                    event = ('uploadFinished', ul['dst'])
+                except Xnat.io.uploadCancelled:
+                    event = ('uploadCancelled', ul['dst'])
+                except Exception, e:
+                    event = ('uploadFailed', ul['dst'], ul['src'], str(e))
+
+                #
+                # Under the lock, so an upload is either replaced (see 
+                # 'addToUploadQueue') or runs its last callbacks.
+                #
+                with self.__uploadCondition:
+                    self.uploadQueue[:] = [item for item in \
+                                    self.uploadQueue if item is not ul]
+                    if not ul['replaced']:
+                        self.runEventCallbacks(*event)
+
+
+
+
+        def __httpsRequest(self, method, _uri, body='', headerAdditions={}, 
+                           stream = False):
+            """ 
+            Makes httpsRequests to an XNAT host.  Connections are borrowed 
+            from 'self.connectionPool', so consecutive requests to the same 
+            host reuse the same TCP/TLS session.
+
+            @param method: The request method to run ('GET', 'PUT', 'POST', 
+                'DELETE').
+            @type: string
+
+            @param _uri: The XNAT uri to run the request on.
+            @type: string      
+
+            @param body: The body contents of the request.  Defaults to an 
+                empty string.
+            @type: string
+
+            @param headerAdditions: The additional header dictionary to add 
+                to the request.
+            @type: dict
+
+            @param stream: If True, the live httplib response is returned and 
+                the caller must hand it back with 
+                'self.connectionPool.release' once it has been read.  
+                Otherwise the body is read up front and the connection is 
+                returned to the pool immediately.
+            @type: boolean
+
+            @return: The response of the request.
+            @rtype: httplib.HTTPResponse | Xnat.connectionPool.bufferedResponse
+            """
+
+            #-------------------- 
+            # Make the request arguments
+            #-------------------- 
+            url = Xnat.path.makeXnatUrl(self.host, _uri)
+            session = self.__getSession()
+            header = dict(self.__getAuthHeader(session).items() + 
+                          [('Accept-Encoding', self.ACCEPT_ENCODING)] + 
+                          headerAdditions.items())
+
+
+
+            #-------------------- 
+            # Conduct REST call
+            #-------------------- 
+            response = self.connectionPool.request(method.upper(), url, 
+                                                   body, header)
+
+            #
+            # The session expired: open a new one and retry once.
+            #
+            if session and response.status == 401:
+                response.read()
+                self.connectionPool.release(response)
+                session = self.__refreshSession(session)
+                header = dict(self.__getAuthHeader(session).items() + 
+                              [('Accept-Encoding', self.ACCEPT_ENCODING)] + 
+                              headerAdditions.items())
+                if hasattr(body, 'seek'):
+                    body.seek(0)
+                response = self.connectionPool.request(method.upper(), url, 
+                                                       body, header)
+
+            if stream:
+                return response
+
+
+
+            #-------------------- 
+            # Read the body so the connection can go straight back 
+            # to the pool.
+            #-------------------- 
+            buffered = Xnat.connectionPool.bufferedResponse(response)
+            self.connectionPool.release(response)
+            return buffered
+
+
+
+
+        def closeSession(self):
+            """
+            Closes the JSESSION of the host, if one is open, and the 
+            connections to it.  Meant for logging out (or switching hosts); 
+            a new session is opened if the instance is used again.
+            """
+            with self.__sessionLock:
+                session = self.__session
+                self.__session = None
+
+            if session:
+                try:
+                    response = self.connectionPool.request('DELETE', 
+                                Xnat.path.makeXnatUrl(self.host, 
+                                                      'data/JSESSION'), 
+                                '', self.__getAuthHeader(session))
+                    response.read()
+                    self.connectionPool.release(response)
+                except Xnat.io.STREAM_ERRORS, e:
+                    print "Unable to close the session of '%s': %s"%(
+                        self.host, str(e))
+            self.connectionPool.clear()
+
+
+
+
+        def __getAuthHeader(self, session):
+            """
+            @param session: The JSESSION id, or None.
+            @type session: string
+
+            @return: The header that authenticates a request: the session 
+                cookie if there is a session, otherwise 'self.authHeader'.
+            @rtype: dict
+            """
+            if session:
+                return {'Cookie': 'JSESSIONID=%s'%(session)}
+            return self.authHeader
+
+
+
+
+        def __getSession(self):
+            """
+            @return: The current JSESSION id, opening one if there isn't one 
+                yet.  None if sessions aren't used.
+            @rtype: string
+            """
+            with self.__sessionLock:
+                if self.__session == None and self.useSessions:
+                    self.__openSession()
+                return self.__session
+
+
+
+
+        def __refreshSession(self, expired):
+            """
+            Replaces an expired JSESSION, unless another thread already has.
+
+            @param expired: The session id that was rejected.
+            @type expired: string
+
+            @return: The current session id, or None.
+            @rtype: string
+            """
+            with self.__sessionLock:
+                if self.__session == expired:
+                    self.__openSession()
+                return self.__session
+
+
+
+
+        def __openSession(self):
+            """
+            Opens a JSESSION by POSTing the Basic credentials to 
+            '/data/JSESSION'.  The session id is the body of the response 
+            (or its 'Set-Cookie' header), jvmRoute suffix included.  
+
+            If the host refuses (SESSION_REFUSED_STATUSES: bad credentials, 
+            older hosts) or answers without a session, 'useSessions' is 
+            turned off so that requests fall back to Basic authentication 
+            -- and report login errors as before.  If the host can't be 
+            reached, or has another error, the request goes out with Basic 
+            authentication and the session is opened on the next one.  
+            Must be called with '__sessionLock' held.
+            """
+            self.__session = None
+            try:
+                response = self.connectionPool.request('POST', 
+                                Xnat.path.makeXnatUrl(self.host, 
+                                                      'data/JSESSION'), 
+                                '', self.authHeader)
+                session = response.read().strip()
+                self.connectionPool.release(response)
+            except Xnat.io.STREAM_ERRORS, e:
+                self.runEventCallbacks('jsonError', self.host, 
+                                       self.username, 
+                                       "Unable to open a session on " + 
+                                       "'%s': %s"%(self.host, str(e)))
+                return
+            if response.status in Xnat.io.SESSION_REFUSED_STATUSES:
+                self.useSessions = False
+            elif response.status != 200:
+                self.runEventCallbacks('jsonError', self.host, 
+                                       self.username, 
+                                       "Unable to open a session on " + 
+                                       "'%s': HTTP Error %s"%(self.host, 
+                                                        response.status))
+            elif Xnat.io.SESSION_ID.match(session):
+                self.__session = session
+            else:
+                cookie = Xnat.io.SESSION_COOKIE.search(
+                    response.getheader('set-cookie') or '')
+                if cookie:
+                    self.__session = cookie.group(1)
+                else:
+                    self.useSessions = False
+
+
+
+
+        def __downloadFailed(self, _src, _dst, dstFile, message):
+            """ 
+            Removes the failed download from the queue and runs the 
+            'downloadFailed' callbacks.
+
+            Partially downloaded files are kept (along with their 
+            '.part.json' sidecar) so the next attempt can resume them.  
+            Empty ones are removed.
+
+            @param _src: The source of the download file.
+            @type _src: string
+
+            @param _dst: The destination of the download file.
+            @type _dst: string
+
+            @param dstFile: The destination file that has been opened already.
+            @type dstFile: file
+
+            @param message: The message to indicated that the download failed.
+            @type message: string
+            """
+            self.removeFromDownloadQueue(_src)
+            if dstFile:
+                dstFile.close()
+                if os.path.getsize(dstFile.name) == 0:
+                    self.__removePartial(_dst)
+            print "\nFailed to download '%s'.  Error: %s"%(_src, message)
+            self.runEventCallbacks('downloadFailed', _src, _dst, message)
+
+
+
+
+        def __getFile_httplib(self, _src, _dst):
+            """
+            NOT the preferred method for getting files from XNAT.
+
+            This method exists as a backup to the urllib2-based '__getFile' 
+            function of Xnat.  It's currently not utilized by Xnat.
+
+            urllib2.urlopen + reponse.read is the preferred method for getting 
+                files because 
+            files can be downloaded in chunks (to allow for a progress
+            indicator) as opposed to one grab, which httplib.HTTPSConnection 
+            does.
+
+            @param _src: The _src url to run the GET request on.
+            @type _src: string
+
+            @param _dst: The destination path of the GET (for getting files).
+            @type _dst: string
+
+            @param dstFile: The python 'file' classType to run the write the 
+                file to.
+            @type dstFile: file
+            """
+
+            #-------------------- 
+            # Pre-download callbacks
+            #-------------------- 
+            self.runEventCallbacks('downloadStarted', _src, -1)
+            self.runEventCallbacks('downloading', _src, 0)
+
+
+
+            #-------------------- 
+            # Download
+            #-------------------- 
+            response = self.__httpsRequest('GET', _src)
+            data = response.read()  
+            with open(_dst, 'wb') as f:
+                f.write(data)     
+
+
+
+            #-------------------- 
+            # Post-download callbacks
+            #--------------------     
+            self.removeFromDownloadQueue(_src)
+            self.runEventCallbacks('downloadFinished', _src)
+
+
+
+
+
+
+        def __getFile_urllib(self, _src, _dst, digest = None):
+            """ 
+            This is the preferred method for getting files from XNAT.
+
+            This method is in place for the main purpose of downlading
+            a given source in packets (buffers) as opposed to one large file.
+
+            The method originally opened the source with urllib2, which 
+            opens a new socket for every file.  It now borrows a keep-alive 
+            connection from 'self.connectionPool' like every other request, 
+            and so handles the two things urllib2 used to do for it: 
+            following redirects and treating error statuses as failures.
+
+            It should be noted that the urllib2 manager-based convention of 
+            authentication returns a 401 error if the server does not follow 
+            the HTTP authentication standard (some CNDA machines are like this),
+            which is why the authentication header is always sent with the 
+            request rather than negotiated.
+
+            @see:
+            U{http://www.voidspace.org.uk/python/articles/authentication.shtml}
+            U{http://stackoverflow.com/questions/5131403/http-basic-
+                 authentication-doesnt-seem-to-work-with-urllib2-in-python}
+
+
+            @param _src: The _src url to run the GET request on.
+            @type _src: string
+
+            @param _dst: The destination path of the GET (for getting files).
+            @type _dst: string         
+
+            @param digest: The MD5 digest of the file, if known.
+            @type digest: string
+            """
+
+            xnatUrl = Xnat.path.makeXnatUrl(self.host, _src)
+            partPath = _dst + self.PARTIAL_SUFFIX
+            cancelled = self.__getCancelFlag(xnatUrl)
+
+
+
+            #-------------------- 
+            # Make the destination directory.
+            #
+            # NOTE: Other downloads may be creating the same directory.
+            #-------------------- 
+            try:
+                dstDir = os.path.dirname(_dst)        
+                try:
+                    os.makedirs(dstDir)
+                except OSError:
+                    if not os.path.isdir(dstDir):
+                        raise
+            except Exception, e:
+                self.__downloadFailed(_src, _dst, None, str(e))
+                return
+
+
+
+            #-------------------- 
+            # Download into '_dst' + '.part', resuming it if a previous 
+            # attempt (in this session or an earlier one) left it behind.  
+            # Dropped connections are retried, as are downloads that don't 
+            # match 'digest' (from scratch).
+            #-------------------- 
+            attempt = 0
+            while True:
+                dstFile = None
+                try:
+                    dstFile, response, downloadTracker = \
+                                self.__openPartial(xnatUrl, _dst)
+                    offset = downloadTracker['downloadedSize']['bytes']
+                    hasher = self.__getHasher(digest, 
+                                              partPath if offset else None)
+                    try:
+                        bytesRead = self.__bufferRead(xnatUrl, dstFile, 
+                                                      response, 
+                                                      downloadTracker, 
+                                                      cancelled, hasher)
+                    finally:
+                        self.connectionPool.release(response)
+                    if bytesRead != None:
+                        self.__checkDigest(xnatUrl, hasher, digest)
+                    break
+
+                except Xnat.io.STREAM_ERRORS, e:
+                    if isinstance(e, Xnat.io.digestError):
+                        dstFile.close()
+                        dstFile = None
+                        self.__removePartial(_dst)
+                    attempt += 1
+                    if attempt > self.DOWNLOAD_RETRIES or \
+                       cancelled.is_set():
+                        self.__downloadFailed(_src, _dst, dstFile, str(e))
+                        return
+                    if dstFile:
+                        dstFile.close()
+                    print "Download of '%s' interrupted (%s).  Resuming..."%(
+                        _src, str(e))
+
+                except Exception, e:
+                    self.__downloadFailed(_src, _dst, dstFile, str(e))
+                    return
+            dstFile.close()
+
+
+
+            #-------------------- 
+            # Cancelled: discard the partial download.
+            #-------------------- 
+            if bytesRead == None:
+                print "Cancelling download of '%s'"%(xnatUrl)
+                self.__removePartial(_dst)
+                self.runEventCallbacks('downloadCancelled', xnatUrl)
+                return
+
+
+
+            #-------------------- 
+            # Finished: move the partial download into place.
+            #-------------------- 
+            if os.path.exists(_dst):
+                os.remove(_dst)
+            os.rename(partPath, _dst)
+            self.__removePartial(_dst)
+            if hasher:
+                self.__setVerified(_dst, digest)
+            self.removeFromDownloadQueue(xnatUrl)
+            self.runEventCallbacks('downloadFinished', xnatUrl)
+
+
+
+
+        def __openPartial(self, xnatUrl, _dst):
+            """
+            Opens '_dst' + '.part' for writing along with the response to 
+            write into it.  
+
+            If the partial file was started from the same url, a 'Range' 
+            request is made for the rest of it, with the ETag or 
+            Last-Modified validator stored in its sidecar as 'If-Range'.  
+            The partial file is only appended to if the server answers 
+            with the requested range; otherwise (the server ignores 
+            ranges, or the file changed) it is restarted from scratch.
+
+            @param xnatUrl: The full XNAT url to download.
+            @type xnatUrl: string
+
+            @param _dst: The local destination of the download.
+            @type _dst: string
+
+            @return: The open partial file, the response and the size 
+                tracker of the download.
+            @rtype: file, httplib.HTTPResponse, dict
+
+            @raise: Exception if the server responds with an error.
+            """
+            partPath = _dst + self.PARTIAL_SUFFIX
+            infoPath = _dst + self.PARTIAL_INFO_SUFFIX
+
+
+            #-------------------- 
+            # Read the sidecar of the partial file, if any.
+            #-------------------- 
+            info = {}
+            offset = 0
+            try:
+                with open(infoPath, 'r') as f:
+                    info = json.load(f)
+                if info.get('url') == xnatUrl:
+                    offset = os.path.getsize(partPath)
+            except (IOError, OSError, ValueError):
+                info = {}
+            validator = info.get('etag') or info.get('lastModified')
+            headers = {}
+            if offset and validator:
+                #
+                # Ranges of a compressed response are ranges of the 
+                # compressed bytes, so ask for the file as it is.
+                #
+                headers['Range'] = 'bytes=%i-'%(offset)
+                headers['If-Range'] = validator
+                headers['Accept-Encoding'] = 'identity'
+            else:
+                offset = 0
+
+
+
+            #-------------------- 
+            # Get the response from the XNAT host.
+            #-------------------- 
+            response = self.__openStream(xnatUrl, headers)
+
+            #
+            # A partial file that no longer fits the remote file
+            #
+            if response.status == 416 and offset:
+                response.read()
+                self.connectionPool.release(response)
+                self.__removePartial(_dst)
+                return self.__openPartial(xnatUrl, _dst)
+
+            if response.status >= 400:
+                response.read()
+                self.connectionPool.release(response)
+                raise Exception("HTTP Error %s: %s"%(response.status, 
+                                                     response.reason))
+
+            #
+            # Only append if we got the range we asked for.
+            #
+            contentRange = response.getheader('content-range') or ''
+            if response.status != 206 or \
+               not contentRange.startswith('bytes %i-'%(offset)):
+                offset = 0
+
+
+
+            #-------------------- 
+            # Get the content size, first by checking log, then by reading 
+            # header.  Every download has its own tracker as several can 
+            # run at once.
+            #
+            # NOTE: The 'content-length' of a compressed response is its 
+            # compressed size, in which case progress is counted in 
+            # compressed bytes ('encoded').
+            #-------------------- 
+            downloadTracker = {
+                'totalDownloadSize': self.getFileSize(xnatUrl),
+                'downloadedSize': {'bytes': offset, 'MB': None},
+                'encoded': False,
+            }
+            if not downloadTracker['totalDownloadSize']['bytes']:
+                # If not in log, read the header
+                contentLength = response.getheader('content-length')
+                downloadTracker['encoded'] = isinstance(response, 
+                                    Xnat.connectionPool.decodedResponse)
+                if contentLength:
+                    downloadTracker['totalDownloadSize']['bytes'] = \
+                                    int(contentLength) + offset
+                    downloadTracker['totalDownloadSize']['MB'] =  \
+                            Xnat.utils.bytesToMB(\
+                            downloadTracker['totalDownloadSize']['bytes'])
+
+
+
+            #-------------------- 
+            # Record what is needed to resume, then open the partial file.
+            #-------------------- 
+            info = {
+                'url': xnatUrl,
+                'size': downloadTracker['totalDownloadSize']['bytes'],
+                'etag': response.getheader('etag'),
+                'lastModified': response.getheader('last-modified'),
+            }
+            with open(infoPath, 'w') as f:
+                json.dump(info, f)
+            dstFile = open(partPath, 'ab' if offset else 'wb')
+            return dstFile, response, downloadTracker
+
+
+
+
+        def __openStream(self, xnatUrl, headers = {}):
+            """
+            Runs a streamed GET request, following any redirects.
+
+            @param xnatUrl: The full XNAT url to download.
+            @type xnatUrl: string
+
+            @param headers: The additional request headers.
+            @type headers: dict
+
+            @return: The response, to be released to 'self.connectionPool'.
+            @rtype: httplib.HTTPResponse
+            """
+            requestUrl = xnatUrl
+            for redirect in range(self.MAX_REDIRECTS + 1):
+                response = self.__httpsRequest('GET', requestUrl, 
+                                               headerAdditions = headers, 
+                                               stream = True)
+                location = response.getheader('location')
+                if not response.status in self.REDIRECT_STATUSES or \
+                   not location:
+                    break
+                response.read()
+                self.connectionPool.release(response)
+                requestUrl = urlparse.urljoin(requestUrl, location)
+            return response
+
+
+
+
+        def __removePartial(self, _dst):
+            """
+            Removes the partial download of '_dst' and its sidecar.
+
+            @param _dst: The local destination of the download.
+            @type _dst: string
+            """
+            for path in [_dst + self.PARTIAL_SUFFIX, 
+                         _dst + self.PARTIAL_INFO_SUFFIX]:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+
+
+        def __getHasher(self, digest, path = None):
+            """
+            @param digest: The MD5 digest a download is to be verified 
+                against, if any.
+            @type digest: string
+
+            @param path: The partial file the download resumes, if any.
+            @type path: string
+
+            @return: The MD5 hash to update with the downloaded bytes, 
+                starting from those of 'path', or None if the download 
+                isn't to be verified.
+            @rtype: hashlib.md5
+            """
+            if not digest or not self.verifyDigests:
+                return None
+            hasher = hashlib.md5()
+            if path:
+                with open(path, 'rb') as f:
+                    for buffer in iter(lambda: f.read(self.MAX_BUFFER_SIZE), 
+                                       ''):
+                        hasher.update(buffer)
+            return hasher
+
+
+
+        def __checkDigest(self, name, hasher, digest):
+            """
+            @param name: The name of the checked download, for the error.
+            @type name: string
+
+            @param hasher: The hash of the download (see '__getHasher').
+            @type hasher: hashlib.md5
+
+            @param digest: The MD5 digest it should have.
+            @type digest: string
+
+            @raise: Xnat.io.digestError if the hash doesn't match the 
+                digest.
+            """
+            if hasher and hasher.hexdigest() != digest.lower():
+                raise Xnat.io.digestError("'%s' doesn't match its digest " \
+                                          "(%s)"%(name, digest))
+
+
+
+        def __setVerified(self, path, digest):
+            """
+            Records that the file at 'path' was verified against 'digest' 
+            (see 'verifiedDigests').
+
+            @param path: The local path of the file.
+            @type path: string
+
+            @param digest: The MD5 digest of the file.
+            @type digest: string
+            """
+            if digest and os.path.exists(path):
+                self.verifiedDigests[os.path.normpath(path)] = digest.lower()
+
+
+
+
+        def __bufferRead(self, _src, dstFile, response, downloadTracker, 
+                         cancelled, hasher = None, bufferSize = None):
+            """
+            Downloads a file by buffer (see '__readBuffers').
+
+            @param _src: The _src url to run the GET request on.
+            @type _src: string
+
+            @param dstFile: The open python file to write the buffers to.
+            @type dstFile: file  
+
+            @param response: The response to read buffers from.
+            @type response: A file-like object. 
+
+            @param downloadTracker: The size tracker of the download.
+            @type downloadTracker: dict
+
+            @param cancelled: Set if the download is cancelled (see 
+                '__getCancelFlag').
+            @type cancelled: threading.Event
+
+            @param hasher: The digest of the file so far, updated with 
+                every buffer, if it is to be verified.
+            @type hasher: hashlib.md5
+
+            @param bufferSize: The first buffer size to read.  Defaults to 
+                MIN_BUFFER_SIZE.
+            @type bufferSize: integer
+
+            @return: The total downloaded bytes, or None if the download 
+                was cancelled.
+            @rtype: integer
+            """
+
+
+            #--------------------
+            # Pre-download callbacks
+            #--------------------
+            size = downloadTracker['totalDownloadSize']['bytes'] \
+                   if downloadTracker['totalDownloadSize']['bytes'] else -1
+            self.runEventCallbacks('downloadStarted', _src, size)
+
+
+
+            #--------------------
+            # Define the buffer read loop
+            #--------------------
+            for buffer in self.__readBuffers(response, cancelled.is_set, 
+                                             bufferSize):     
+
+                #
+                # Write buffer chunk to file
+                #
+                dstFile.write(buffer)
+                if hasher:
+                    hasher.update(buffer)
+
+                #
+                # And update progress indicators
+                #
+                if downloadTracker['encoded']:
+                    downloadTracker['downloadedSize']['bytes'] = \
+                                                        response.rawBytes
+                else:
+                    downloadTracker['downloadedSize']['bytes'] += len(buffer)
+                self.__runProgressCallbacks('downloading', _src, 
+                            downloadTracker['downloadedSize']['bytes'])
+
+
+            #
+            # If DOWNLOAD CANCELLED
+            #              
+            if cancelled.is_set():
+                return None
+            self.__runProgressCallbacks('downloading', _src, 
+                        downloadTracker['downloadedSize']['bytes'], True)
+            return downloadTracker['downloadedSize']['bytes']
+
+
+
+
+        def __readBuffers(self, response, isStopped, bufferSize = None):
+            """
+            Generates the body of a response by buffer, until it is read or
+            'isStopped' returns True.
+
+            Responses that support it are read with 'readinto' (see 
+            Xnat.connectionPool.response) into one reusable bytearray, so 
+            no string is allocated per buffer: the generated buffers are 
+            views of it, and are only valid until the next one.  The buffer 
+            size starts at 'bufferSize' and doubles, up to MAX_BUFFER_SIZE, 
+            while buffers are filled faster than 'progressInterval' / 10: 
+            fast transfers are read in fewer, larger calls.  It halves 
+            again, down to MIN_BUFFER_SIZE, if a buffer takes longer than 
+            'progressInterval' to fill, so that progress and cancellation 
+            stay responsive on slow ones.
+
+            @param response: The response to read.
+            @type response: httplib.HTTPResponse
+
+            @param isStopped: Returns True if reading should stop.
+            @type isStopped: function
+
+            @param bufferSize: The first buffer size to read.  Defaults to 
+                MIN_BUFFER_SIZE.
+            @type bufferSize: integer
+
+            @raise: httplib.IncompleteRead if the connection drops before 
+                the end of the body.
+            """
+            bufferSize = bufferSize or self.MIN_BUFFER_SIZE
+            readinto = getattr(response, 'readinto', None)
+            if readinto:
+                view = memoryview(bytearray(self.MAX_BUFFER_SIZE))
+
+            while not isStopped():
+                readStart = time.time()
+                if readinto:
+                    buffer = view[:readinto(view[:bufferSize])]
+                else:
+                    buffer = response.read(bufferSize)
+                if not len(buffer): 
+                    #
+                    # httplib returns short reads, rather than raising, 
+                    # when the connection drops before 'content-length'.
+                    #
+                    if getattr(response, 'length', None):
+                        raise httplib.IncompleteRead('', response.length)
+                    return
+
+                #
+                # Adapt the buffer size to the throughput.
+                #
+                readTime = time.time() - readStart
+                if len(buffer) == bufferSize and \
+                   readTime < self.progressInterval / 10:
+                    bufferSize = min(bufferSize * 2, self.MAX_BUFFER_SIZE)
+                elif readTime > self.progressInterval:
+                    bufferSize = max(bufferSize / 2, self.MIN_BUFFER_SIZE)
+
+                yield buffer
+
+
+
+
+
+        def __getJson(self, _uri, allowStale = False, reportErrors = True):
+            """ 
+            Returns a json object from a given XNAT URI using
+            the internal method '__httpsRequest'.
+
+            Results are kept in 'self.metadataCache'.  Fresh ones are 
+            returned without a request; expired ones are revalidated with 
+            'If-None-Match'/'If-Modified-Since' and reused if the host 
+            answers '304 Not Modified'.
+
+            @param _uri: The xnat uri to retrieve the JSON object from.
+            @type _uri: string
+
+            @param allowStale: Whether to return an expired cached result 
+                right away, revalidating it in the background.
+            @type allowStale: boolean
+
+            @param reportErrors: Whether to run the 'jsonError' callbacks 
+                if the response isn't JSON.
+            @type reportErrors: boolean
+
+            @return: A dictionary of the JSON result.
+            @rtype: dict
+            """
+
+            #-------------------- 
+            # Get the response from httpRequest
+            #--------------------     
+            xnatUrl = Xnat.path.makeXnatUrl(self.host, _uri)
+            cached = self.metadataCache.get(xnatUrl)
+            if cached and cached.fresh():
+                return cached.result
+            if cached and allowStale:
+                self.__revalidateInBackground(xnatUrl, cached)
+                return cached.result
+            headers = cached.validators() if cached else {}
+            response = self.__httpsRequest('GET', xnatUrl, 
+                                           headerAdditions = headers)
+            if cached and response.status == 304:
+                response.read()
+                self.metadataCache.refresh(xnatUrl)
+                return cached.result
+            etag = response.getheader('etag')
+            lastModified = response.getheader('last-modified')
+            response = response.read()
+
+
+
+            #-------------------- 
+            # Try to load the response as a JSON...
+            #-------------------- 
+            try:
+                result = json.loads(response)['ResultSet']['Result']
+                self.metadataCache.put(xnatUrl, result, etag, lastModified)
+                return result
+            except Exception, e:
+                if reportErrors:
+                    self.runEventCallbacks('jsonError', self.host, 
+                                           self.username, response)
+
+
+
+
+        def __getJsonAll(self, _uris, allowStale = False):
+            """
+            Runs '__getJson' on several URIs at once, on up to 
+            MAX_QUERY_STREAMS threads.  Events raised by the threads are run 
+            before returning, as they would be if the URIs were requested 
+            one after the other.
+
+            @param _uris: The xnat uris to retrieve the JSON objects from.
+            @type _uris: list.<string>
+
+            @param allowStale: See '__getJson'.
+            @type allowStale: boolean
+
+            @return: The results of '__getJson', in the order of '_uris'.
+            @rtype: list
+
+            @raise: The exception of the first failed uri, if any.
+            """
+            if len(_uris) < 2:
+                return [self.__getJson(_uri, allowStale) for _uri in _uris]
+
+            results = [None] * len(_uris)
+            errors = {}
+            pending = Queue.Queue()
+            for i in range(len(_uris)):
+                pending.put(i)
+
+            def getJson():
+                while True:
+                    try:
+                        i = pending.get(False)
+                    except Queue.Empty:
+                        return
+                    try:
+                        results[i] = self.__getJson(_uris[i], allowStale)
+                    except Exception, e:
+                        errors[i] = e
+
+            threads = [threading.Thread(target = getJson) for i in 
+                       range(min(len(_uris), self.MAX_QUERY_STREAMS))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            if threading.current_thread() == self.__eventThread:
+                self.dispatchEvents()
+            if errors:
+                raise errors[min(errors)]
+            return results
+
+
+
+
+        def isRevalidating(self):
+            """
+            @return: Whether stale metadata is being revalidated in the 
+                background (its 'metadataChanged' events then need 
+                'dispatchEvents' to run).
+            @rtype: boolean
+            """
+            with self.__revalidatingLock:
+                return len(self.__revalidating) > 0
+
+
+
+
+        def __revalidateInBackground(self, xnatUrl, cached):
+            """
+            Revalidates an expired cache entry on a separate thread, running 
+            the 'metadataChanged' callbacks if the host returns different 
+            contents.  Only one revalidation runs per url.
+
+            @param xnatUrl: The url of the cache entry.
+            @type xnatUrl: string
+
+            @param cached: The expired entry.
+            @type cached: Xnat.metadataCache.entry
+            """
+            with self.__revalidatingLock:
+                if xnatUrl in self.__revalidating:
+                    return
+                self.__revalidating.add(xnatUrl)
+
+            def revalidate():
+                try:
+                    result = self.__getJson(xnatUrl)
+                    if result != None and result != cached.result:
+                        self.runEventCallbacks('metadataChanged', xnatUrl)
+                except Exception, e:
+                    print "Unable to revalidate '%s': %s"%(xnatUrl, str(e))
+                finally:
+                    with self.__revalidatingLock:
+                        self.__revalidating.discard(xnatUrl)
+
+            thread = threading.Thread(target = revalidate)
+            thread.daemon = True
+            thread.start()
+
+
+
+    class connectionPool(object):
+        """
+        A per-host pool of persistent (keep-alive) httplib connections.
+
+        Connections are handed out by 'request' and handed back with 
+        'release' once their response has been read to the end.  At most 
+        'maxIdle' connections are kept open per host, connections idle for 
+        longer than 'idleTimeout' seconds are closed instead of reused, 
+        and a request that fails on a reused connection (because the server 
+        closed the socket in the meantime) is retried once on a new one.
+
+        The pool is thread-safe.
+
+        Example Usage:
+
+        >>> pool = Xnat.connectionPool()
+        >>> response = pool.request('GET', 'https://central.xnat.org/data/'
+            'projects?format=json')
+        >>> contents = response.read()
+        >>> pool.release(response)
+        """
+
+        MAX_IDLE_CONNECTIONS = 4
+        IDLE_TIMEOUT = 30
+        STALE_ERRORS = (httplib.HTTPException, socket.error)
+
+
+        
+        def __init__(self, maxIdle = None, idleTimeout = None, timeout = None):
+            """
+            @param maxIdle: The maximum number of idle connections kept per 
+                host.  Defaults to MAX_IDLE_CONNECTIONS.
+            @type maxIdle: integer
+
+            @param idleTimeout: The number of seconds after which an idle 
+                connection is no longer reused.  Defaults to IDLE_TIMEOUT.
+            @type idleTimeout: number
+
+            @param timeout: The optional socket timeout of new connections.
+            @type timeout: number
+            """
+            self.maxIdle = maxIdle if maxIdle != None else \
+                           Xnat.connectionPool.MAX_IDLE_CONNECTIONS
+            self.idleTimeout = idleTimeout if idleTimeout != None else \
+                               Xnat.connectionPool.IDLE_TIMEOUT
+            self.timeout = timeout
+            self.__idle = {}
+            self.__lock = threading.Lock()
+
+
+
+        def request(self, method, url, body = '', headers = {}):
+            """
+            Runs a request on a pooled connection to the url's host.
+
+            The returned response keeps a reference to its connection; pass 
+            it to 'release' once it has been read.
+
+            @param method: The request method ('GET', 'PUT', etc.).
+            @type method: string
+
+            @param url: The full url to request.
+            @type url: string
+
+            @param body: The request body.  File-like bodies are rewound 
+                before a retry.
+            @type body: string | file
+
+            @param headers: The request headers.
+            @type headers: dict
+
+            @return: The response.  Responses with a 'gzip' or 'deflate' 
+                'content-encoding' are decompressed as they are read.
+            @rtype: httplib.HTTPResponse | 
+                Xnat.connectionPool.decodedResponse
+            """
+            request = urllib2.Request(url)
+            host = request.get_host()
+            selector = request.get_selector()
+
+            fresh = False
+            while True:
+                connection, reused = self.__getConnection(host, fresh)
+                try:
+                    connection.request(method, selector, body = body, 
+                                       headers = headers)
+                    response = connection.getresponse()
+                except Xnat.connectionPool.STALE_ERRORS, e:
+                    connection.close()
+                    #
+                    # Only a reused connection is presumed stale:
+                    # retry once on a fresh one.
+                    #
+                    if not reused:
+                        raise
+                    if hasattr(body, 'seek'):
+                        body.seek(0)
+                    fresh = True
+                    continue
+                except:
+                    #
+                    # i.e. the body raised (an upload was cancelled): the
+                    # request is half sent, so the connection can't be 
+                    # reused.
+                    #
+                    connection.close()
+                    raise
+
+                response.poolHost = host
+                response.poolConnection = connection
+                if response.getheader('content-encoding', '').lower() in \
+                   Xnat.connectionPool.decodedResponse.DECODERS:
+                    return Xnat.connectionPool.decodedResponse(response)
+                return response
+
+
+
+        def release(self, response, discard = False):
+            """
+            Returns the connection of a response to the pool.  The 
+            connection is closed instead if the response wasn't read to the 
+            end, if the server asked to close it, or if 'discard' is True.
+
+            @param response: A response returned by 'request'.
+            @type response: httplib.HTTPResponse
+
+            @param discard: Whether to close the connection regardless.
+            @type discard: boolean
+            """
+            if isinstance(response, Xnat.connectionPool.decodedResponse):
+                response = response.raw
+            connection = getattr(response, 'poolConnection', None)
+            if not connection:
+                return
+            response.poolConnection = None
+
+            if discard or response.will_close or not response.isclosed():
+                response.close()
+                connection.close()
+                return
+
+            with self.__lock:
+                idle = self.__idle.setdefault(response.poolHost, [])
+                if len(idle) < self.maxIdle:
+                    idle.append((connection, time.time()))
+                    return
+            connection.close()
+
+
+
+        def clear(self):
+            """
+            Closes all of the idle connections in the pool.
+            """
+            with self.__lock:
+                idle = self.__idle
+                self.__idle = {}
+            for host in idle:
+                for connection, lastUsed in idle[host]:
+                    connection.close()
+
+
+
+        def __getConnection(self, host, fresh = False):
+            """
+            Returns an idle connection to 'host' if one is available and 
+            hasn't timed out, otherwise a new connection.
+
+            @param host: The host (and optional port).
+            @type host: string
+
+            @param fresh: Whether to skip the idle connections.
+            @type fresh: boolean
+
+            @return: The connection and whether it was reused.
+            @rtype: httplib.HTTPConnection, boolean
+            """
+            if not fresh:
+                with self.__lock:
+                    idle = self.__idle.get(host, [])
+                    while len(idle):
+                        connection, lastUsed = idle.pop()
+                        if time.time() - lastUsed < self.idleTimeout:
+                            return connection, True
+                        connection.close()
+
+            #-------------------- 
+            # For local uris
+            #
+            # A ':' indicates the port...
+            #-------------------- 
+            if ':' in host:
+                connection = httplib.HTTPConnection(host, 
+                                                    timeout = self.timeout)
+            else:
+                connection = httplib.HTTPSConnection(host, 
+                                                     timeout = self.timeout)
+            connection.response_class = Xnat.connectionPool.response
+            return connection, False
+
+
+
+        class response(httplib.HTTPResponse):
+            """
+            An httplib.HTTPResponse that can be read into a buffer, as in 
+            Python 3, so that large downloads don't allocate a string per 
+            read (see Xnat.io.__readBuffers).
+            """
+
+            def readinto(self, buffer):
+                """
+                Fills 'buffer' with the body, receiving straight from the 
+                socket into it.  Bodies without a 'content-length', chunked 
+                bodies, and data already buffered by the socket file are 
+                read with 'read' instead.
+
+                @param buffer: The buffer to read into.
+                @type buffer: bytearray | memoryview
+
+                @return: The number of bytes read: fewer than the size of 
+                    'buffer' only at the end of the body (or if the 
+                    connection drops), 0 once it's read.
+                @rtype: integer
+                """
+                rbuf = getattr(self.fp, '_rbuf', None)
+                if self.fp == None or self.chunked or self.length == None \
+                   or self._method == 'HEAD' or rbuf == None or rbuf.tell():
+                    data = self.read(len(buffer))
+                    buffer[:len(data)] = data
+                    return len(data)
+
+                amt = min(len(buffer), self.length)
+                view = memoryview(buffer)
+                read = 0
+                while read < amt:
+                    try:
+                        received = self.fp._sock.recv_into(view[read:amt])
+                    except socket.error, e:
+                        if e.args[0] == errno.EINTR:
+                            continue
+                        raise
+                    if not received:
+                        break
+                    read += received
+
+                #
+                # As in 'read': the caller checks 'length' for a dropped 
+                # connection.
+                #
+                self.length -= read
+                if not self.length or read < amt:
+                    self.close()
+                return read
+
+
+
+        class decodedResponse(object):
+            """
+            A compressed (gzip or deflate 'content-encoding') response, 
+            decompressed as it is read.  Mirrors the parts of the 
+            httplib.HTTPResponse interface used by Xnat.io; 'rawBytes' is 
+            the number of compressed bytes read so far.
+            """
+
+            DECODERS = ['gzip', 'x-gzip', 'deflate']
+
+            def __init__(self, response):
+                """
+                @param response: The compressed response.
+                @type response: httplib.HTTPResponse
+                """
+                self.raw = response
+                self.status = response.status
+                self.reason = response.reason
+                self.msg = response.msg
+                self.rawBytes = 0
+                self.__encoding = response.getheader('content-encoding').\
+                                  lower()
+                self.__decoder = None
+                self.__finished = False
+
+
+
+            @property
+            def length(self):
+                """
+                @return: The number of compressed bytes left to read, if 
+                    known.
+                @rtype: integer
+                """
+                return self.raw.length
+
+
+
+            def read(self, amt = None):
+                """
+                @param amt: The number of compressed bytes to read.  Reads 
+                    the rest of the body if not provided.  
+                @type amt: integer
+
+                @return: The decompressed bytes (possibly more than 'amt'); 
+                    an empty string at the end of the body.
+                @rtype: string
+                """
+                while not self.__finished:
+                    data = self.raw.read() if amt == None else \
+                           self.raw.read(amt)
+                    self.rawBytes += len(data)
+                    if not data:
+                        self.__finished = True
+                        return self.__decoder.flush() if self.__decoder \
+                               else ''
+                    if not self.__decoder:
+                        self.__decoder = self.__makeDecoder(data)
+                    decoded = self.__decoder.decompress(data)
+                    if amt == None:
+                        return decoded + self.read()
+                    if decoded:
+                        return decoded
+                return ''
+
+
+
+            def __makeDecoder(self, data):
+                """
+                @param data: The first compressed bytes.
+                @type data: string
+
+                @return: The decompressor of the encoding.  'deflate' is 
+                    meant to be zlib-wrapped, but some servers send raw 
+                    deflate data, which is detected from the zlib header.
+                """
+                if self.__encoding != 'deflate':
+                    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+                if len(data) >= 2 and ord(data[0]) & 0x0f == 8 and \
+                   (ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+                    return zlib.decompressobj(zlib.MAX_WBITS)
+                return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+
+            def getheader(self, name, default = None):
+                """
+                @param name: The header name (case-insensitive).
+                @type name: string
+
+                @return: The header value, or 'default'.
+                @rtype: string
+                """
+                return self.raw.getheader(name, default)
+
+
+
+            def getheaders(self):
+                """
+                @return: The (header, value) pairs of the response.
+                @rtype: list.<tuple>
+                """
+                return self.raw.getheaders()
+
+
+
+        class bufferedResponse(object):
+            """
+            A fully read response, so that its connection can be returned to 
+            the pool straight away.  Mirrors the parts of the 
+            httplib.HTTPResponse interface used by Xnat.io.
+            """
+
+            def __init__(self, response):
+                """
+                @param response: The response to read.
+                @type response: httplib.HTTPResponse
+                """
+                self.status = response.status
+                self.reason = response.reason
+                self.msg = response.msg
+                self.__body = cStringIO.StringIO(response.read())
+
+
+
+            def read(self, amt = None):
+                """
+                @param amt: The number of bytes to read.  Reads the rest of 
+                    the body if not provided.
+                @type amt: integer
+
+                @return: The read bytes.
+                @rtype: string
+                """
+                if amt == None:
+                    return self.__body.read()
+                return self.__body.read(amt)
+
+
+
+            def getheader(self, name, default = None):
+                """
+                @param name: The header name (case-insensitive).
+                @type name: string
+
+                @return: The header value, or 'default'.
+                @rtype: string
+                """
+                return self.msg.getheader(name, default)
+
+
+
+            def getheaders(self):
+                """
+                @return: The (header, value) pairs of the response.
+                @rtype: list.<tuple>
+                """
+                return self.msg.items()
+
+
+
+    class uploadStream(object):
+        """
+        A read-only file wrapper used as a request body, so that httplib 
+        sends a file from disk in fixed-size chunks instead of from a string 
+        holding all of it.  Reports the number of bytes read so far (which 
+        httplib sends as soon as they are read) after each chunk.
+
+        Example Usage:
+
+        >>> body = Xnat.uploadStream('/tmp/scene.mrb', 256 * 1024, 
+            lambda uploaded: sys.stdout.write('%i\\n'%(uploaded)))
+        >>> pool.request('PUT', url, body, {'content-length': 
+            str(body.size)})
+        >>> body.close()
+        """
+
+        def __init__(self, path, chunkSize, onRead = None, cancelled = None):
+            """
+            @param path: The local file to read.
+            @type path: string
+
+            @param chunkSize: The number of bytes read at a time.
+            @type chunkSize: integer
+
+            @param onRead: The optional callback run with the total number 
+                of bytes read after each chunk.
+            @type onRead: function
+
+            @param cancelled: The optional flag that, once set, makes the 
+                next read raise Xnat.io.uploadCancelled.
+            @type cancelled: threading.Event
+            """
+            self.size = os.path.getsize(path)
+            self.chunkSize = chunkSize
+            self.onRead = onRead
+            self.cancelled = cancelled
+            self.bytesRead = 0
+            self.__file = open(path, 'rb')
+
+
+
+        def read(self, amt = None):
+            """
+            Reads the next chunk.  httplib asks for small blocks, so 'amt' is 
+            only used if it is larger than the chunk size.
+
+            @param amt: The requested number of bytes.
+            @type amt: integer
+
+            @return: The read bytes; an empty string at the end of the file.
+            @rtype: string
+
+            @raise: Xnat.io.uploadCancelled if the upload was cancelled.
+            """
+            if self.cancelled and self.cancelled.is_set():
+                raise Xnat.io.uploadCancelled("Upload cancelled.")
+            data = self.__file.read(max(amt or 0, self.chunkSize))
+            if data:
+                self.bytesRead += len(data)
+                if self.onRead:
+                    self.onRead(self.bytesRead)
+            return data
+
+
+
+        def seek(self, offset):
+            """
+            Moves to 'offset' (used when a request is retried on a new 
+            connection).
+
+            @param offset: The offset from the start of the file.
+            @type offset: integer
+            """
+            self.__file.seek(offset)
+            self.bytesRead = offset
+
+
+
+        def close(self):
+            """
+            Closes the file.
+            """
+            self.__file.close()
+
+
+
+    class archiveStream(object):
+        """
+        A read-only, uncompressed tar archive of a directory, generated as 
+        it is read, used as a request body (see Xnat.io.putFiles).  Nothing
+        is written to disk, and since the size of a tar archive follows 
+        from the sizes of its files, it is sent with a 'content-length'.  
+        Reports the number of bytes read so far, as Xnat.uploadStream does.
+
+        Example Usage:
+
+        >>> body = Xnat.archiveStream('/tmp/DICOM', 256 * 1024)
+        >>> pool.request('PUT', url + '/DICOM.tar?extract=true', body, 
+            {'content-length': str(body.size)})
+        >>> body.close()
+        """
+
+        def __init__(self, directory, chunkSize, onRead = None, 
+                     cancelled = None, relPaths = None):
+            """
+            @param directory: The local directory to archive.  Its files 
+                are archived by their paths below it.
+            @type directory: string
+
+            @param chunkSize: The number of bytes read at a time.
+            @type chunkSize: integer
+
+            @param onRead: The optional callback run with the total number 
+                of bytes read after each chunk.
+            @type onRead: function
+
+            @param cancelled: The optional flag that, once set, makes the 
+                next read raise Xnat.io.uploadCancelled.
+            @type cancelled: threading.Event
+
+            @param relPaths: The paths of the files to archive, relative 
+                to 'directory'.  Every file in it if not provided.
+            @type relPaths: list.<string>
+            """
+            self.chunkSize = chunkSize
+            self.onRead = onRead
+            self.cancelled = cancelled
+            self.bytesRead = 0
+            if relPaths == None:
+                relPaths = []
+                for root, dirs, files in os.walk(directory):
+                    for fileName in files:
+                        relPaths.append(os.path.relpath(os.path.join(root, 
+                                                    fileName), directory))
+
+
+            #--------------------
+            # Make the header of each file, and size the archive: each 
+            # file is padded to a whole block, and the archive ends with 
+            # two empty blocks, padded to a whole record.
+            #--------------------
+            self.members = []
+            size = 0
+            for relPath in relPaths:
+                path = os.path.join(directory, relPath)
+                tarInfo = tarfile.TarInfo(relPath.replace(os.sep, '/'))
+                tarInfo.size = os.path.getsize(path)
+                tarInfo.mtime = os.path.getmtime(path)
+                header = tarInfo.tobuf()
+                self.members.append((path, tarInfo.size, header))
+                size += len(header) + self.__padded(tarInfo.size)
+            size += 2 * tarfile.BLOCKSIZE
+            self.size = self.__padded(size, tarfile.RECORDSIZE)
+            self.__start()
+
+
+
+        def __padded(self, size, blockSize = tarfile.BLOCKSIZE):
+            """
+            @param size: A number of bytes.
+            @type size: integer
+
+            @param blockSize: The size of a block.
+            @type blockSize: integer
+
+            @return: 'size' rounded up to a whole number of blocks.
+            @rtype: integer
+            """
+            return -(-size // blockSize) * blockSize
+
+
+
+        def __start(self):
+            """
+            (Re)starts the archive from its first byte.
+            """
+            self.__chunks = self.__generate()
+            self.__buffer = ''
+            self.bytesRead = 0
+
+
+
+        def __generate(self):
+            """
+            Generates the archive.
+
+            @return: The chunks of the archive.
+            @rtype: generator
+
+            @raise: IOError if a file changed size after the archive was 
+                sized.
+            """
+            sent = 0
+            for path, size, header in self.members:
+                yield header
+                read = 0
+                with open(path, 'rb') as f:
+                    for data in iter(lambda: f.read(self.chunkSize), ''):
+                        read += len(data)
+                        yield data
+                if read != size:
+                    raise IOError("'%s' changed while being archived."%(path))
+                yield tarfile.NUL * (self.__padded(size) - size)
+                sent += len(header) + self.__padded(size)
+            yield tarfile.NUL * (self.size - sent)
+
+
+
+        def __take(self, amt):
+            """
+            @param amt: The number of bytes to take from the archive.
+            @type amt: integer
+
+            @return: Up to 'amt' bytes; an empty string at the end of the 
+                archive.
+            @rtype: string
+            """
+            while len(self.__buffer) < amt:
+                try:
+                    self.__buffer += next(self.__chunks)
+                except StopIteration:
+                    break
+            data, self.__buffer = self.__buffer[:amt], self.__buffer[amt:]
+            self.bytesRead += len(data)
+            return data
+
+
+
+        def read(self, amt = None):
+            """
+            Reads the next chunk.  As with Xnat.uploadStream, 'amt' is only
+            used if it is larger than the chunk size.
+
+            @param amt: The requested number of bytes.
+            @type amt: integer
+
+            @return: The read bytes; an empty string at the end of the 
+                archive.
+            @rtype: string
+
+            @raise: Xnat.io.uploadCancelled if the upload was cancelled.
+            """
+            if self.cancelled and self.cancelled.is_set():
+                raise Xnat.io.uploadCancelled("Upload cancelled.")
+            data = self.__take(max(amt or 0, self.chunkSize))
+            if data and self.onRead:
+                self.onRead(self.bytesRead)
+            return data
+
+
+
+        def seek(self, offset):
+            """
+            Moves to 'offset' (used when a request is retried on a new 
+            connection) by generating the archive again up to it.
+
+            @param offset: The offset from the start of the archive.
+            @type offset: integer
+            """
+            self.__start()
+            while self.bytesRead < offset and \
+                  self.__take(min(offset - self.bytesRead, self.chunkSize)):
+                pass
+
+
+
+        def close(self):
+            """
+            Stops generating the archive, closing the open file.
+            """
+            self.__chunks.close()
+
+
+
+    class progressReader(object):
+        """
+        A read-only wrapper of a file-like object (i.e. a response handed 
+        to tarfile) that reports the number of bytes read so far after 
+        every read.
+        """
+
+        def __init__(self, fileobj, onRead):
+            """
+            @param fileobj: The object to read from.
+            @type fileobj: file
+
+            @param onRead: The callback run with the total number of bytes 
+                read.
+            @type onRead: function
+            """
+            self.fileobj = fileobj
+            self.onRead = onRead
+            self.bytesRead = 0
+
+
 
+        def read(self, amt = None):
+            """
+            @param amt: The number of bytes to read.  Reads the rest if not 
+                provided.
+            @type amt: integer
 
-            #-------------------- 
-            # Clear queue if there is nothing
-            # left in it.
-            #-------------------- 
-            if len(self.downloadQueue) == 0:
-                self.clearDownloadQueue()
+            @return: The read bytes.
+            @rtype: string
+            """
+            data = self.fileobj.read() if amt == None else \
+                   self.fileobj.read(amt)
+            if data:
+                self.bytesRead += len(data)
+                self.onRead(self.bytesRead)
+            return data
 
 
 
+    class metadataCache(object):
+        """
+        A bounded, thread-safe LRU cache of parsed XNAT JSON results, keyed 
+        by normalized url (query arguments included, in any order).
 
+        Entries are fresh for a time that depends on the XNAT level they 
+        list (see TTLS): project listings change rarely, file listings 
+        often.  Expired entries keep their ETag/Last-Modified validators so 
+        they can be revalidated with a conditional request rather than 
+        downloaded again.
 
-        def __httpsRequest(self, method, _uri, body='', headerAdditions={}):
-            """ 
-            Makes httpsRequests to an XNAT host.
+        'invalidate' is called with the url of anything written to or 
+        deleted from the host: cached listings under it are dropped and 
+        the listings above it are expired.
 
-            @param method: The request method to run ('GET', 'PUT', 'POST', 
-                'DELETE').
-            @type: string
+        If given an Xnat.metadataStore, entries are also written to it, and 
+        read back from it when they aren't in memory.
 
-            @param _uri: The XNAT uri to run the request on.
-            @type: string      
+        Example Usage:
 
-            @param body: The body contents of the request.  Defaults to an 
-                empty string.
-            @type: string
+        >>> cache = Xnat.metadataCache()
+        >>> cache.put(url, result, etag, lastModified)
+        >>> entry = cache.get(url)
+        >>> if entry and entry.fresh(): return entry.result
+        """
 
-            @param headerAdditions: The additional header dictionary to add 
-                to the request.
-            @type: dict
-            """
+        MAX_ENTRIES = 512
+        DEFAULT_TTL = 60
+        TTLS = {
+            'projects': 600,
+            'subjects': 300,
+            'experiments': 300,
+            'scans': 120,
+            'resources': 60,
+            'files': 30,
+        }
 
-            #-------------------- 
-            # Make the request arguments
-            #-------------------- 
-            url = Xnat.path.makeXnatUrl(self.host, _uri)
-            request = urllib2.Request(url)
-            host = request.get_host()
-            #print ("XNAT URL: ", _uri, url) 
-            
-            #-------------------- 
-            # For local uris
-            #
-            # A ':' indicates the port...
-            #-------------------- 
-            if ':' in host:
-                connection = httplib.HTTPConnection(host)
-            else:
-                connection = httplib.HTTPSConnection(host) 
 
-            header = dict(self.authHeader.items() + headerAdditions.items())
 
+        class entry(object):
+            """
+            A cached result and the validators it was returned with.
+            """
 
+            def __init__(self, result, etag, lastModified, ttl, 
+                         fetched = None):
+                """
+                @param result: The parsed 'ResultSet.Result' list.
+                @type result: list.<dict>
 
-            #-------------------- 
-            # Conduct REST call
-            #-------------------- 
-            connection.request(method.upper(), request.get_selector(), 
-                               body=body, headers=header)
-            return connection.getresponse()
+                @param etag: The 'ETag' response header, if any.
+                @type etag: string
 
+                @param lastModified: The 'Last-Modified' response header, if 
+                    any.
+                @type lastModified: string
 
+                @param ttl: The number of seconds the entry is fresh for.
+                @type ttl: number
 
+                @param fetched: The time the result was fetched (or last 
+                    revalidated).  Defaults to now.
+                @type fetched: number
+                """
+                self.result = result
+                self.etag = etag
+                self.lastModified = lastModified
+                self.ttl = ttl
+                self.time = fetched if fetched != None else time.time()
 
-        def __downloadFailed(self, _src, _dst, dstFile, message):
-            """ 
-            Opens a QMessageBox informing the user
-            of the failed download.
 
-            @param _src: The source of the download file.
-            @type _src: string
 
-            @param _dst: The destination of the download file.
-            @type _dst: string
+            def fresh(self):
+                """
+                @return: Whether the entry can be used without revalidation.
+                @rtype: boolean
+                """
+                return time.time() - self.time < self.ttl
 
-            @param dstFile: The destination file that has been opened already.
-            @type dstFile: file
 
-            @param message: The message to indicated that the download failed.
-            @type message: string
-            """
-            self.removeFromDownloadQueue(_src)
-            dstFile.close()
-            os.remove(dstFile.name)
-            print "\nFailed to download '%s'.  Error: %s"%(_src, message)
-            self.runEventCallbacks('downloadFailed', _src, _dst, message)
 
+            def validators(self):
+                """
+                @return: The conditional request headers for revalidating 
+                    the entry.
+                @rtype: dict
+                """
+                headers = {}
+                if self.etag:
+                    headers['If-None-Match'] = self.etag
+                if self.lastModified:
+                    headers['If-Modified-Since'] = self.lastModified
+                return headers
 
 
 
-        def __getFile_httplib(self, _src, _dst):
+        def __init__(self, maxEntries = None, store = None):
             """
-            NOT the preferred method for getting files from XNAT.
+            @param maxEntries: The maximum number of cached results.  
+                Defaults to MAX_ENTRIES.
+            @type maxEntries: integer
 
-            This method exists as a backup to the urllib2-based '__getFile' 
-            function of Xnat.  It's currently not utilized by Xnat.
+            @param store: The optional on-disk store backing the cache.
+            @type store: Xnat.metadataStore
+            """
+            self.maxEntries = maxEntries if maxEntries != None else \
+                              Xnat.metadataCache.MAX_ENTRIES
+            self.store = store
+            self.__entries = collections.OrderedDict()
+            self.__lock = threading.Lock()
 
-            urllib2.urlopen + reponse.read is the preferred method for getting 
-                files because 
-            files can be downloaded in chunks (to allow for a progress
-            indicator) as opposed to one grab, which httplib.HTTPSConnection 
-            does.
 
-            @param _src: The _src url to run the GET request on.
-            @type _src: string
 
-            @param _dst: The destination path of the GET (for getting files).
-            @type _dst: string
+        @staticmethod
+        def normalize(url):
+            """
+            @param url: The full XNAT url.
+            @type url: string
 
-            @param dstFile: The python 'file' classType to run the write the 
-                file to.
-            @type dstFile: file
+            @return: The cache key of the url: the cleaned url with its 
+                query arguments sorted.
+            @rtype: string
             """
+            path, sep, query = url.partition('?')
+            path = Xnat.path.cleanUri(path)
+            if query:
+                path += '?' + '&'.join(sorted(query.split('&')))
+            return path
 
-            #-------------------- 
-            # Pre-download callbacks
-            #-------------------- 
-            self.runEventCallbacks('downloadStarted', _src, -1)
-            self.runEventCallbacks('downloading', _src, 0)
 
 
+        @staticmethod
+        def getTtl(url):
+            """
+            @param url: The full XNAT url.
+            @type url: string
 
-            #-------------------- 
-            # Download
-            #-------------------- 
-            response = self.__httpsRequest('GET', _src)
-            data = response.read()  
-            with open(_dst, 'wb') as f:
-                f.write(data)     
+            @return: The number of seconds results of the url stay fresh, 
+                based on the deepest XNAT level in it.
+            @rtype: number
+            """
+            path = url.split('?')[0].rstrip('/').split('/')
+            for segment in reversed(path):
+                if segment in Xnat.metadataCache.TTLS:
+                    return Xnat.metadataCache.TTLS[segment]
+            return Xnat.metadataCache.DEFAULT_TTL
 
 
 
-            #-------------------- 
-            # Post-download callbacks
-            #--------------------     
-            self.removeFromDownloadQueue(_src)
-            self.runEventCallbacks('downloadFinished', _src)
+        def get(self, url):
+            """
+            @param url: The full XNAT url.
+            @type url: string
 
+            @return: The cached entry of the url, fresh or not, or None.
+            @rtype: Xnat.metadataCache.entry
+            """
+            key = Xnat.metadataCache.normalize(url)
+            with self.__lock:
+                entry = self.__entries.pop(key, None)
+                if entry:
+                    self.__entries[key] = entry
+                    return entry
+            if not self.store:
+                return None
 
+            #
+            # Not in memory: read it from the store.
+            #
+            stored = self.store.load(key)
+            if not stored:
+                return None
+            result, etag, lastModified, fetched = stored
+            entry = Xnat.metadataCache.entry(result, etag, lastModified, 
+                                             Xnat.metadataCache.getTtl(url),
+                                             fetched)
+            self.__add(key, entry)
+            return entry
 
 
 
+        def put(self, url, result, etag = None, lastModified = None):
+            """
+            Caches a result, evicting the least recently used entries if 
+            the cache is full.
 
-        def __getFile_urllib(self, _src, _dst):
-            """ 
-            This is the preferred method for getting files from XNAT.
+            @param url: The full XNAT url.
+            @type url: string
 
-            This method is in place for the main purpose of downlading
-            a given source in packets (buffers) as opposed to one large file.
+            @param result: The parsed result.
+            @type result: list.<dict>
 
-            It should be noted that the urllib2 manager-based convention of 
-            authentication returns a 401 error if the server does not follow 
-            the HTTP authentication standard (some CNDA machines are like this):
+            @param etag: The 'ETag' response header.
+            @type etag: string
 
-                #-------------------- 
-                # RETURNS AN ERROR
-                #-------------------- 
-                >>> passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                >>> passman.add_password(None, _xnatSrc, self.user, \
-                    self.password)
-                >>> authhandler = urllib2.HTTPBasicAuthHandler(passman)
-                >>> opener = urllib2.build_opener(authhandler)
-                >>> urllib2.install_opener(opener)
-                >>> response = urllib2.urlopen(_xnatSrc)
+            @param lastModified: The 'Last-Modified' response header.
+            @type lastModified: string
+            """
+            key = Xnat.metadataCache.normalize(url)
+            entry = Xnat.metadataCache.entry(result, etag, lastModified, 
+                                             Xnat.metadataCache.getTtl(url))
+            self.__add(key, entry)
+            if self.store:
+                self.store.save(key, result, etag, lastModified, entry.time)
 
 
-            A workaround was found for this issue.  It simply includes the 
-            authentication header in the request, and we use urllib2 to open 
-            the request.
 
-                #-------------------- 
-                # WORKS
-                #-------------------- 
-                >>> request = urllib2.Request(xnatUrl)
-                >>> request.add_header("Authorization", \
-                    self.authHeader['Authorization'])
-                >>> response = urllib2.urlopen(request)
+        def __add(self, key, entry):
+            """
+            Adds an entry to memory, evicting the least recently used 
+            entries if the cache is full.
 
+            @param key: The normalized url.
+            @type key: string
 
+            @param entry: The entry.
+            @type entry: Xnat.metadataCache.entry
+            """
+            with self.__lock:
+                self.__entries.pop(key, None)
+                self.__entries[key] = entry
+                while len(self.__entries) > self.maxEntries:
+                    self.__entries.popitem(last = False)
 
-            @see:
-            U{http://www.voidspace.org.uk/python/articles/authentication.shtml}
-            U{http://blog.oneiroi.co.uk/python/python-urllib2-basic-http-
-                 authentication/}
-            U{http://stackoverflow.com/questions/5131403/http-basic-
-                 authentication-doesnt-seem-to-work-with-urllib2-in-python}
-            U{http://stackoverflow.com/questions/635113/python-urllib2-
-                 basic-http-authentication-and-tr-im/4188709#4188709}
 
 
-            @param _src: The _src url to run the GET request on.
-            @type _src: string
+        def refresh(self, url):
+            """
+            Makes the entry of a url fresh again (the host confirmed it 
+            hasn't changed).
 
-            @param _dst: The destination path of the GET (for getting files).
-            @type _dst: string         
+            @param url: The full XNAT url.
+            @type url: string
             """
+            entry = self.get(url)
+            if entry:
+                entry.time = time.time()
+                if self.store:
+                    self.store.touch(Xnat.metadataCache.normalize(url), 
+                                     entry.time)
 
-            #-------------------- 
-            # Open the local destination file 
-            # so that it can start reading in the buffers.
-            #-------------------- 
-            try:
-                dstDir = os.path.dirname(_dst)        
-                if not os.path.exists(dstDir):
-                    os.makedirs(dstDir)
-                dstFile = open(_dst, "wb")
-            except Exception, e:
-                self.__downloadFailed(_src, _dst, dstFile, str(e))
-                return
 
 
+        def invalidate(self, url):
+            """
+            Drops the entries at or below a url that was written to or 
+            deleted, and expires those above it (their listings may have 
+            changed, but can still be revalidated).
 
-            #-------------------- 
-            # Construct the request and authentication handler
-            #-------------------- 
-            xnatUrl = Xnat.path.makeXnatUrl(self.host, _src)
-            request = urllib2.Request(xnatUrl)
-            request.add_header("Authorization", 
-                               self.authHeader['Authorization'])
+            @param url: The full XNAT url that was modified.
+            @type url: string
+            """
+            changed = Xnat.metadataCache.normalize(url.split('?')[0])
+            with self.__lock:
+                for key in self.__entries.keys():
+                    path = key.split('?')[0]
+                    if path == changed or path.startswith(changed + '/'):
+                        del self.__entries[key]
+                    elif changed.startswith(path + '/'):
+                        self.__entries[key].time = 0
+            if self.store:
+                self.store.invalidate(changed)
 
 
 
-            #-------------------- 
-            # Get the response from the XNAT host.
-            #-------------------- 
-            try:
-                response = urllib2.urlopen(request)
+        def clear(self):
+            """
+            Empties the cache.
+            """
+            with self.__lock:
+                self.__entries.clear()
 
 
 
+    class metadataStore(object):
+        """
+        An SQLite file of XNAT JSON results with the time they were fetched, 
+        so that metadata outlives the session.  One file can hold the 
+        metadata of several hosts and users: every row belongs to the 
+        host/username given to the constructor.
 
-            #-------------------- 
-            # If the urllib2 version fails then use httplib.
-            # See get_httplib for more details.
-            #-------------------- 
-                #except urllib2.HTTPError, e:
-            except Exception as e:
-                #print str(e)
-                #print _src, _dst
-                #print d
-                self.__downloadFailed(_src, _dst, dstFile, str(e))
-                return
+        Used by Xnat.metadataCache; keys are its normalized urls.  The file 
+        is pruned when it is opened: rows fetched more than MAX_AGE seconds 
+        ago are deleted, then all but the MAX_ROWS most recently fetched.
 
+        Example Usage:
 
-            #-------------------- 
-            # Get the content size, first by checking log, then by reading 
-            # header
-            #-------------------- 
-            self.downloadTracker['downloadedSize']['bytes'] = 0   
-            self.downloadTracker['totalDownloadSize'] = \
-                                                self.getFileSize(xnatUrl)
-            if not self.downloadTracker['totalDownloadSize']['bytes']:
-                # If not in log, read the header
-                if response.headers and "Content-Length" in response.headers:
-                    self.downloadTracker['totalDownloadSize']['bytes'] = \
-                                    int(response.headers["Content-Length"])  
-                    self.downloadTracker['totalDownloadSize']['MB'] =  \
-                            Xnat.utils.bytesToMB(\
-                            self.downloadTracker['totalDownloadSize']['bytes'])
+        >>> store = Xnat.metadataStore('/tmp/metadata.db', 
+            'https://central.xnat.org/', 'testUser')
+        >>> cache = Xnat.metadataCache(store = store)
+        """
 
+        MAX_AGE = 30 * 24 * 60 * 60
+        MAX_ROWS = 10000
 
-            #-------------------- 
-            # Start the buffer reading cycle by
-            # calling on the buffer_read function above.
-            #-------------------- 
-            bytesRead = self.__bufferRead(xnatUrl, dstFile, response)
-            dstFile.close()
+        def __init__(self, path, host, username):
+            """
+            @param path: The SQLite file (created if needed).
+            @type path: string
 
+            @param host: The XNAT host.
+            @type host: string
 
+            @param username: The XNAT user.
+            @type username: string
+            """
+            self.path = path
+            self.owner = (host, username)
+            self.__lock = threading.Lock()
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            #
+            # The connection is shared by the threads revalidating metadata, 
+            # hence 'check_same_thread' and the lock.
+            #
+            self.__db = sqlite3.connect(path, check_same_thread = False)
+            with self.__lock:
+                self.__db.execute("CREATE TABLE IF NOT EXISTS metadata (" +
+                                  "host TEXT, username TEXT, url TEXT, " + 
+                                  "result TEXT, etag TEXT, " + 
+                                  "lastModified TEXT, fetched REAL, " + 
+                                  "PRIMARY KEY (host, username, url))")
+                self.__db.execute("CREATE INDEX IF NOT EXISTS " + 
+                                  "metadataByFetched ON metadata (fetched)")
+                self.__db.commit()
+            self.prune()
 
 
-        def __bufferRead(self, _src, dstFile, response, bufferSize=8192):
-            """
-            Downloads a file by a constant buffer size.
 
-            @param _src: The _src url to run the GET request on.
-            @type _src: string
+        def prune(self):
+            """
+            Deletes the rows, of every host and user, fetched more than 
+            MAX_AGE seconds ago, then all but the MAX_ROWS most recently 
+            fetched.
+            """
+            with self.__lock:
+                self.__db.execute("DELETE FROM metadata WHERE fetched < ?", 
+                                  (time.time() - self.MAX_AGE,))
+                self.__db.execute("DELETE FROM metadata WHERE rowid IN " + 
+                                  "(SELECT rowid FROM metadata ORDER BY " + 
+                                  "fetched DESC LIMIT -1 OFFSET ?)", 
+                                  (self.MAX_ROWS,))
+                self.__db.commit()
 
-            @param dstFile: The open python file to write the buffers to.
-            @type dstFile: file  
 
-            @param response: The urllib2 response to read buffers from.
-            @type response: A file-like object. 
-                @see: U{http://docs.python.org/2/library/urllib2.html}
 
-            @param bufferSize: Buffer size to read.  Defaults to the standard 
-                8192.
-            @type bufferSize: integer
+        def load(self, url):
+            """
+            @param url: The normalized url.
+            @type url: string
 
-            @return: The total downloaded bytes.  
-            @rtype: intengerhttp://docs.python.org/2/library/urllib2.html
+            @return: The stored result, ETag, Last-Modified and fetch time of 
+                the url, or None.
+            @rtype: tuple
             """
+            with self.__lock:
+                row = self.__db.execute("SELECT result, etag, lastModified, " + 
+                                        "fetched FROM metadata WHERE " + 
+                                        "host=? AND username=? AND url=?", 
+                                        self.owner + (url,)).fetchone()
+            if not row:
+                return None
+            try:
+                return (json.loads(row[0]),) + tuple(row[1:])
+            except ValueError:
+                return None
 
 
-            #--------------------
-            # Pre-download callbacks
-            #--------------------
-            size = self.downloadTracker['totalDownloadSize']['bytes'] \
-                   if self.downloadTracker['totalDownloadSize']['bytes'] else -1
-            self.runEventCallbacks('downloadStarted', _src, size)
 
+        def save(self, url, result, etag, lastModified, fetched):
+            """
+            @param url: The normalized url.
+            @type url: string
 
+            @param result: The parsed result.
+            @type result: list.<dict>
 
-            #--------------------
-            # Define the buffer read loop
-            #--------------------
-            while 1:     
+            @param etag: The 'ETag' response header.
+            @type etag: string
 
-                #
-                # If DOWNLOAD CANCELLED
-                #              
-                if not self.inDownloadQueue(_src):
-                    print "Cancelling download of '%s'"%(_src)
-                    dstFile.close()
-                    os.remove(dstFile.name)
-                    self.runEventCallbacks('downloadCancelled', _src)
-                    break
+            @param lastModified: The 'Last-Modified' response header.
+            @type lastModified: string
 
+            @param fetched: The time the result was fetched.
+            @type fetched: number
+            """
+            with self.__lock:
+                self.__db.execute("INSERT OR REPLACE INTO metadata VALUES " + 
+                                  "(?, ?, ?, ?, ?, ?, ?)", 
+                                  self.owner + (url, json.dumps(result), 
+                                                etag, lastModified, fetched))
+                self.__db.commit()
 
-                #
-                # If DOWNLOAD FINISHED
-                #
-                buffer = response.read(bufferSize)
-                if not buffer: 
-                    # Pop from the queue
-                    self.removeFromDownloadQueue(_src)
-                    self.runEventCallbacks('downloadFinished', _src)
-                    break
 
 
-                #
-                # Otherwise, Write buffer chunk to file
-                #
-                dstFile.write(buffer)
+        def touch(self, url, fetched):
+            """
+            Updates the fetch time of a revalidated url.
 
-                #
-                # And update progress indicators
-                #
-                self.downloadTracker['downloadedSize']['bytes'] += len(buffer)
-                self.runEventCallbacks('downloading', _src, 
-                            self.downloadTracker['downloadedSize']['bytes'])
+            @param url: The normalized url.
+            @type url: string
 
+            @param fetched: The time the result was revalidated.
+            @type fetched: number
+            """
+            with self.__lock:
+                self.__db.execute("UPDATE metadata SET fetched=? WHERE " + 
+                                  "host=? AND username=? AND url=?", 
+                                  (fetched,) + self.owner + (url,))
+                self.__db.commit()
 
-            return self.downloadTracker['downloadedSize']['bytes']
 
 
+        def invalidate(self, url):
+            """
+            Deletes the rows at or below a modified url and expires the ones 
+            above it (see Xnat.metadataCache.invalidate).
 
+            @param url: The normalized url that was modified.
+            @type url: string
+            """
+            with self.__lock:
+                #
+                # Below: the url, with any query, and the urls under it.
+                #
+                for prefix in [url + '?', url + '/']:
+                    self.__db.execute("DELETE FROM metadata WHERE host=? " + 
+                                      "AND username=? AND url >= ? AND " + 
+                                      "url < ?", self.owner + 
+                                      self.__prefixRange(prefix))
+                self.__db.execute("DELETE FROM metadata WHERE host=? AND " + 
+                                  "username=? AND url=?", 
+                                  self.owner + (url,))
 
+                #
+                # Above: each of its parent urls, with any query.
+                #
+                parents = [url[:i] for i in range(1, len(url)) 
+                           if url[i] == '/']
+                for parent in parents:
+                    self.__db.execute("UPDATE metadata SET fetched=0 " + 
+                                      "WHERE host=? AND username=? AND " + 
+                                      "(url=? OR (url >= ? AND url < ?))", 
+                                      self.owner + (parent,) + 
+                                      self.__prefixRange(parent + '?'))
+                self.__db.commit()
 
-        def __getJson(self, _uri):
-            """ 
-            Returns a json object from a given XNAT URI using
-            the internal method '__httpsRequest'.
 
-            @param _uri: The xnat uri to retrieve the JSON object from.
-            @type _uri: string
 
-            @return: A dictionary of the JSON result.
-            @rtype: dict
+        def __prefixRange(self, prefix):
             """
+            @param prefix: The start of a url.
+            @type prefix: string
 
-            #-------------------- 
-            # Get the response from httpRequest
-            #--------------------     
-            xnatUrl = Xnat.path.makeXnatUrl(self.host, _uri)
-            response = self.__httpsRequest('GET', xnatUrl).read()
+            @return: The bounds of the urls that start with 'prefix', for 
+                an indexed 'url >= ? AND url < ?' query.
+            @rtype: tuple
+            """
+            return (prefix, prefix + u'\uffff')
 
 
 
-            #-------------------- 
-            # Try to load the response as a JSON...
-            #-------------------- 
-            try:
-                return json.loads(response)['ResultSet']['Result']
-            except Exception, e:
-                self.runEventCallbacks('jsonError', self.host, 
-                                       self.username, response)
+        def clear(self):
+            """
+            Deletes every row of the host/username.
+            """
+            with self.__lock:
+                self.__db.execute("DELETE FROM metadata WHERE host=? AND " + 
+                                  "username=?", self.owner)
+                self.__db.commit()
 
 
 
@@ -1134,6 +4540,85 @@ class Xnat(object):
 
 
 
+        RESULT_ARRAY = re.compile(r'"Result"\s*:\s*\[')
+        JSON_SEPARATORS = ' \t\r\n,'
+
+        @staticmethod
+        def iterJsonRows(fileobj, tags = None, bufferSize = 16384):
+            """
+            Incrementally parses the 'ResultSet.Result' array of an XNAT 
+            JSON response, yielding each row once it has been read, so 
+            neither the whole body nor all of its rows need to be in 
+            memory.
+
+            @param fileobj: The response (or any object with 'read').
+            @type fileobj: httplib.HTTPResponse
+
+            @param tags: The keys to keep in each row.  Default is all of 
+                them.
+            @type tags: list.<string>
+
+            @param bufferSize: The number of bytes read at a time.
+            @type bufferSize: integer
+
+            @return: The rows.
+            @rtype: generator.<dict>
+
+            @raise: ValueError, with the body read so far as its message, if 
+                the response has no 'Result' array (i.e. a login page), or 
+                if the array is truncated.
+            """
+            decoder = json.JSONDecoder()
+
+
+            #--------------------
+            # Find the start of the array.
+            #--------------------
+            buffer = ''
+            while True:
+                match = Xnat.utils.RESULT_ARRAY.search(buffer)
+                if match:
+                    break
+                chunk = fileobj.read(bufferSize)
+                if not chunk:
+                    raise ValueError(buffer)
+                buffer += chunk
+
+
+
+            #--------------------
+            # Decode the rows one by one, reading more whenever a row is 
+            # incomplete.
+            #--------------------
+            buffer = buffer[match.end():]
+            position = 0
+            finished = False
+            while True:
+                while position < len(buffer) and \
+                      buffer[position] in Xnat.utils.JSON_SEPARATORS:
+                    position += 1
+                if position < len(buffer):
+                    if buffer[position] == ']':
+                        return
+                    try:
+                        row, position = decoder.raw_decode(buffer, position)
+                    except ValueError:
+                        row = None
+                    if row != None:
+                        if tags:
+                            row = dict((tag, row[tag]) for tag in tags 
+                                       if tag in row)
+                        yield row
+                        continue
+                if finished:
+                    raise ValueError(buffer[position:])
+                chunk = fileobj.read(bufferSize)
+                finished = not chunk
+                buffer = buffer[position:] + chunk
+                position = 0
+
+
+
     class path(object):
         """
         URI/URL methods specific to XNAT interaction.
@@ -1463,6 +4948,35 @@ class Xnat(object):
 
 
 
+        @staticmethod
+        def toColumns(rows, tags):
+            """ 
+            Converts rows of XNAT metadata to the dictionary of lists 
+            returned by Xnat.io.getFolder, keeping only the given tags.
+
+            @param rows: The rows of metadata.
+            @type rows: list.<dict>
+
+            @param tags: The metadata tags to keep.
+            @type tags: list.<string>
+
+            @rtype: dict.<string, list>
+            @returns: The values of each tag found in the rows, in order.
+            """
+            columns = {}
+            for row in rows:
+                for tag in tags:
+                    if tag in row:
+                        #
+                        # Create the object attribute if not there.
+                        #
+                        if not tag in columns:
+                            columns[tag] = []
+                        columns[tag].append(row[tag])
+            return columns
+
+
+
   
 
 
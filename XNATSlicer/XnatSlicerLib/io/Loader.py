@@ -38,7 +38,8 @@ class Loader(object):
     """
 
         
-    def __init__(self, MODULE, _src, fileUris = None):
+    def __init__(self, MODULE, _src, fileUris = None, fileSizes = None, 
+                 fileDigests = None):
         """ 
         Init function.
 
@@ -51,26 +52,45 @@ class Loader(object):
         @param fileUris: The fileUrs to download from (in case the 
             download is of an entire 'files' folder).
         @type fileUris: list(str)
+
+        @param fileSizes: The sizes of 'fileUris' in bytes, by URI, as 
+            listed in the 'Size' metadata of the folder.
+        @type fileSizes: dict
+
+        @param fileDigests: The MD5 digests of 'fileUris', by URI, as 
+            listed in the 'digest' metadata of the folder.  The downloaded 
+            files are verified against them.
+        @type fileDigests: dict
         """
         self.MODULE = MODULE
         self._src = _src
         self._dst = ''
         self.fileUris = fileUris
+        self.fileSizes = fileSizes or {}
+        self.fileDigests = dict([(fileUri, digest) for fileUri, digest in 
+                                 (fileDigests or {}).iteritems() if digest])
         self.useCached = None
+        self.extract = False
+        self.files = None
+        self.keepPaths = False
         self._dstBase = XnatSlicerGlobals.LOCAL_URIS['downloads']
         
 
         
     @property
     def loadArgs(self):
-        return {'src': self._src, 'dst': self._dst}
+        return {'src': self._src, 'dst': self._dst, 'extract': self.extract, 
+                'files': self.files, 'digests': self.fileDigests,
+                'keepPaths': self.keepPaths}
 
         
 
     def extractDst(self):
         """
         Extracts the downloaded zip file and its contents
-        to the appropriate dst.
+        to the appropriate dst.  If the download was extracted as it 
+        downloaded (see 'Loader_Images.STREAM_EXTRACT'), 'self._dst' is 
+        already the extracted directory.
         """
         
 
@@ -80,6 +100,15 @@ class Loader(object):
         if not os.path.exists(self._dst):
             return
 
+
+        #--------------------
+        # Already extracted
+        #--------------------
+        if os.path.isdir(self._dst):
+            self.extractPath = self._dst
+            self.inventoryExtractPath()
+            return
+
         #--------------------
         # Rename the dst file (it creates errors in Windows if we don't)
         #--------------------
@@ -116,7 +145,39 @@ class Loader(object):
         # Decompress zips.
         #--------------------
         MokaUtils.file.extractAllFiles(self._dst, self.extractPath)
-        
+        self.inventoryExtractPath()
+
+
+
+    def cacheFiles(self, paths, downloaded = True):
+        """
+        Indexes the loaded files in the download cache, if they were just 
+        downloaded, and pins them there while they are in the scene.  See 
+        CacheIndex.  The checksums of the files XnatIo verified are 
+        indexed with them.
+
+        @param paths: The local paths of the loaded files.
+        @type paths: list(str)
+
+        @param downloaded: Whether the files were just downloaded.
+        @type downloaded: bool
+        """
+        if downloaded:
+            verifiedDigests = self.MODULE.XnatIo.verifiedDigests
+            checksums = {}
+            for path in paths:
+                checksum = verifiedDigests.pop(os.path.normpath(path), None)
+                if checksum:
+                    checksums[path] = checksum
+            self.MODULE.CacheIndex.add(paths, checksums)
+        self.MODULE.CacheIndex.pin(paths)
+
+
+
+    def inventoryExtractPath(self):
+        """
+        Lists the files in 'self.extractPath' as 'self.extractedFiles'.
+        """
 
         #--------------------
         # Tracj files
@@ -165,6 +226,7 @@ class Loader_File(Loader):
         """
         if not os.path.exists(self._dst): return 
         SlicerUtils.loadNodeFromFile(self._dst)
+        self.cacheFiles([self._dst])
 
 
 
@@ -173,9 +235,17 @@ class Loader_File(Loader):
 class Loader_Images(Loader):
     """
     A subclass of the Loader class for downlading image sets (DICOM, Analyze, etc.).
+
+    If STREAM_EXTRACT is True, image sets are downloaded as 
+    '?format=tar.gz' archives that XnatIo extracts as they download, in 
+    which case 'self._dst' is the directory of the extracted files rather 
+    than a zip file.
     """
 
-    def __init__(self, MODULE, _src, fileUris):
+    STREAM_EXTRACT = True
+
+    def __init__(self, MODULE, _src, fileUris, fileSizes = None, 
+                 fileDigests = None):
         """
         Init function.
 
@@ -188,14 +258,25 @@ class Loader_Images(Loader):
         @param fileUris: The fileUrs to download from (in case the download 
                          is of an entire 'files' folder).
         @type fileUris: list(str)
+
+        @param fileSizes: The sizes of 'fileUris' in bytes, by URI.
+        @type fileSizes: dict
+
+        @param fileDigests: The MD5 digests of 'fileUris', by URI.
+        @type fileDigests: dict
         """
-        super(Loader_Images, self).__init__(MODULE, _src, fileUris)
+        super(Loader_Images, self).__init__(MODULE, _src, fileUris, 
+                                            fileSizes, fileDigests)
 
         #--------------------
         # Derive a src and dst
         #--------------------
         self._src, self._dst = Xnat.path.modifySrcDstForZipDownload(self._src, 
                                                                 self._dstBase)
+        if self.STREAM_EXTRACT:
+            self.extract = True
+            self._src = self._src.replace('?format=zip', self.formatQuery)
+            self._dst = os.path.splitext(self._dst)[0]
 
 
         #--------------------
@@ -244,7 +325,8 @@ class Loader_Images(Loader):
             self._oldSrc = self._src
             self._oldDst = self._dst
             self._src = self._src.split('/data/')[0] + fileDirs[0] # + '?format=zip'
-            self._dst = self._dstBase + fileDirs[0] + '.zip'
+            self._dst = self._dstBase + fileDirs[0] + \
+                        ('' if self.extract else '.zip')
 
             #--------------------
             # Remove any folders that 
@@ -252,7 +334,8 @@ class Loader_Images(Loader):
             # We don't need them.
             #--------------------  
             splitter = 'files'
-            self._src = self._src.split(splitter)[0] + splitter + '?format=zip'
+            self._src = self._src.split(splitter)[0] + splitter + \
+                        self.formatQuery
             
             
 
@@ -261,8 +344,18 @@ class Loader_Images(Loader):
         #--------------------            
         if self.MODULE.Workflow_Load.XnatDownloadPopup and self._oldSrc:
             self.MODULE.Workflow_Load.XnatDownloadPopup.changeRowKey(\
-                                self._oldSrc.replace('?format=zip', ''),\
-                                    self._src.replace('?format=zip', ''))
+                                self._oldSrc.split('?format=')[0],\
+                                    self._src.split('?format=')[0])
+
+
+
+    @property
+    def formatQuery(self):
+        """
+        @return: The query argument of the archive format to download.
+        @rtype: str
+        """
+        return '?format=tar.gz' if self.extract else '?format=zip'
 
 
 
@@ -295,7 +388,7 @@ class Loader_Images(Loader):
         """
         """
         self._dst = None
-        folderUri = self._src.replace('?format=zip', '')
+        folderUri = self._src.split('?format=')[0]
         
         # Update the download popup
         self.MODULE.Workflow_Load.XnatDownloadPopup.setText(folderUri, 
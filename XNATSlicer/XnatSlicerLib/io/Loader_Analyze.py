@@ -40,30 +40,24 @@ class Loader_Analyze(Loader_Images):
         @params args: The dummy arguments needed for checking the cache.
         @types: None
         """
-        splitter = '/projects/'
-     
-        abbreviatedUris = [self._src.split(splitter)[1].replace('?format=zip', 
-                '') + '/' + 
-                    os.path.basename(fileUri) for fileUri in self.fileUris]
-        #print "ABBREVIATED URIS", abbreviatedUris
+        cacheIndex = self.MODULE.CacheIndex
+        cacheDir = self._dst.replace('.zip', '')
+        cacheUris = [cacheIndex.getUri(os.path.join(cacheDir, 
+                                            os.path.basename(fileUri)))
+                     for fileUri in self.fileUris]
+        checksums = dict([(cacheUri, self.fileDigests[fileUri]) 
+                          for cacheUri, fileUri in zip(cacheUris, 
+                                                       self.fileUris)
+                          if fileUri in self.fileDigests])
+        #print "CACHE URIS", cacheUris
         
-        foundCount = 0
-        self.cachedFiles = []
-        for root, dirs, files in os.walk(self._dst.replace('.zip', '')):
-            for f in files:
-                if XnatSlicerUtils.isAnalyze(f):
-                    #print "\n\nCACHED ANALYZE", os.path.join(root, f), "\n\n",
-                    #root, f
-                    uri = os.path.join(root, f).replace('\\', '/')
-                    #print uri
-                    #print uri.split(splitter)[1] in abbreviatedUris
-                    if uri.split(splitter)[1] in abbreviatedUris:
-                        foundCount +=1
-                        self.cachedFiles.append(uri)
-
-        #print "FOUND", foundCount, "URS", len(abbreviatedUris)
+        cachedFiles = cacheIndex.lookup(cacheUris, checksums)
+        self.cachedFiles = [cachedFiles[uri] for uri in cacheUris \
+                            if uri in cachedFiles]
+
+        #print "FOUND", len(self.cachedFiles), "URS", len(cacheUris)
         
-        if foundCount == len(abbreviatedUris):
+        if len(self.cachedFiles) == len(cacheUris):
             return True
 
             
@@ -78,11 +72,12 @@ class Loader_Analyze(Loader_Images):
         if self.useCached:
             MokaUtils.debug.lf( "\n\nUsing cached analyze files:", 
                                 self.extractedFiles, "\n\n")
-            
+            self.cacheFiles(self.extractedFiles, False)
             
         else:
             if not os.path.exists(self._dst): return 
             self.extractDst()
+            self.cacheFiles(self.extractedFiles)
             
         headersFound = 0
         for fileName in self.extractedFiles:
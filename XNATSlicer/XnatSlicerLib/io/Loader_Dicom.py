@@ -19,6 +19,7 @@ import DICOMScalarVolumePlugin
 # module
 from Loader import *
 from XnatSlicerUtils import *
+from CacheIndex import *
 
 
 
@@ -30,72 +31,167 @@ class Loader_Dicom(Loader_Images):
 
     NOTE: DICOMLoader makes use of Slicer's DICOM database and 
     for parsing.
+
+    Large scans are downloaded file by file, several at a time, rather 
+    than as an archive, which XNAT has to build before it sends anything 
+    (minutes for scans of thousands of slices).  Scans of at least 
+    PER_FILE_MIN_SIZE bytes whose files average PER_FILE_MIN_FILE_SIZE 
+    bytes or more are downloaded this way; below that, the archive is 
+    quick to build, or the per-request overhead of each file outweighs 
+    the wait.
     """
-    
+
+    PER_FILE_MIN_SIZE = 64 * 1024 * 1024
+    PER_FILE_MIN_FILE_SIZE = 32 * 1024
+
+
+    def __init__(self, MODULE, _src, fileUris, fileSizes = None, 
+                 fileDigests = None):
+        """
+        Init function.
+
+        @param MODULE: The XNATSlicer module.
+        @type MODULE: XnatSlicerWidget
+
+        @param _src: The source URI to begin the load from.
+        @type _src: str
+
+        @param fileUris: The DICOM file URIs of the scan.
+        @type fileUris: list(str)
+
+        @param fileSizes: The sizes of 'fileUris' in bytes, by URI.
+        @type fileSizes: dict
+
+        @param fileDigests: The MD5 digests of 'fileUris', by URI.
+        @type fileDigests: dict
+        """
+        super(Loader_Dicom, self).__init__(MODULE, _src, fileUris, 
+                                           fileSizes, fileDigests)
+        if not self.useCached and self.isPerFileDownload():
+            self.setPerFileDownload()
+
+
+
+    def getDicomSizes(self):
+        """
+        @return: The sizes of the DICOM files of 'self.fileUris' in bytes, 
+            by URI, or None if any of them is unknown.
+        @rtype: dict
+        """
+        dicomSizes = {}
+        for fileUri in self.fileUris:
+            if not XnatSlicerUtils.isDICOM(fileUri):
+                continue
+            try:
+                dicomSizes[fileUri] = int(self.fileSizes[fileUri])
+            except (KeyError, TypeError, ValueError):
+                return None
+        return dicomSizes
+
+
+
+    def isPerFileDownload(self):
+        """
+        Determines whether the scan should be downloaded file by file 
+        rather than as an archive, from the number of DICOM files and 
+        their total 'Size'.  See the class description.
+
+        @return: Whether to download the scan file by file.
+        @rtype: bool
+        """
+        dicomSizes = self.getDicomSizes()
+        if not dicomSizes:
+            return False
+        totalSize = sum(dicomSizes.values())
+        return totalSize >= self.PER_FILE_MIN_SIZE and \
+            totalSize / len(dicomSizes) >= self.PER_FILE_MIN_FILE_SIZE
+
+
+
+    def setPerFileDownload(self):
+        """
+        Switches the download of the scan from an archive to its 
+        individual DICOM files, downloaded into the directory the archive 
+        would have been extracted to.
+        """
+        self.files = self.getDicomSizes()
+        self.extract = False
+        self._src = self._src.split('?format=')[0]
+        if self._dst.endswith('.zip'):
+            self._dst = os.path.splitext(self._dst)[0]
+
 
     def checkCache(self, fileUris):
         """ 
-        Checks the fileUris against the dicom database.  If there's
-        a 100% match, immediately defaults to using the cache.
+        Checks the fileUris against the DICOM files indexed in the 
+        CacheIndex (see 'indexDicoms').  If there's a 100% match, whose 
+        series are still in slicer.dicomDatabase (and whose files match 
+        their digests, if known), immediately defaults to using the 
+        cache.
 
         @param fileUris: The fileUris to check the cache against.
         @type fileUris: list(str)
         """
 
         # Adjust path slashes
-        fileUris = [MokaUtils.path.adjustPathSlashes(fileUri) \
-                    for fileUri in fileUris]
-        
-
-        splitter = '/experiments/'
-        #--------------------
-        # Get the abbreviated file URIs
-        # and their directories.
-        #--------------------
-        abbrevUris = []
-        for fileUri in fileUris:
-            if XnatSlicerUtils.isDICOM(fileUri):
-                abbrevUris.append(fileUri.split(splitter)[1])
-        #print "abbrevUris", abbrevUris
-                
+        dicomUris = [MokaUtils.path.adjustPathSlashes(fileUri) \
+                     for fileUri in fileUris \
+                     if XnatSlicerUtils.isDICOM(fileUri)]
+        #print "dicomUris", dicomUris
+        self.cachedFiles = []
+        if not slicer.dicomDatabase:
+            return False
 
 
-                    
-        #--------------------
-        # Get database files, abbreviate as necessary
-        #--------------------
-        fullToAbbrev = {}
-        for fullDbFile in slicer.dicomDatabase.allFiles():
-            adjFile = MokaUtils.path.adjustPathSlashes(fullDbFile)
-            if splitter in adjFile:
-                fullToAbbrev[adjFile.split(splitter)[1]] = adjFile
-                
         #--------------------
-        # Check for string matches between the folder URI
-        # and the database files 
+        # Look up the indexed database files.
         #--------------------
-        self.cachedFiles = []
-        for key, value in fullToAbbrev.iteritems():
-            for abbrevUri in abbrevUris:
-                if abbrevUri in key:
-                    self.cachedFiles.append(value)
-
-        #print "FULL TO ABBREV", fullToAbbrev
-        #print "ABBREV URIS", abbrevUris
+        checksums = dict([(MokaUtils.path.adjustPathSlashes(fileUri), 
+                           digest) for fileUri, digest in 
+                          self.fileDigests.iteritems()])
+        cachedDicoms = self.MODULE.CacheIndex.lookupDicom(dicomUris, 
+                                                          checksums)
+        self.cachedFiles = [cachedDicoms[dicomUri][0] \
+                            for dicomUri in dicomUris \
+                            if dicomUri in cachedDicoms]
         #print "CACHED FILES", self.cachedFiles  
-        #print len(self.cachedFiles), len(abbrevUris), \
-        #      len(self.cachedFiles) == len(abbrevUris)
-         
+        if len(self.cachedFiles) < len(dicomUris):
+            return False
+
+
         #--------------------   
         # If all URIs are in the database, use cache, exit.
         #--------------------    
-        if len(self.cachedFiles) == len(abbrevUris):
-            return True
-          
-        return False
-       
+        for series in set([series for path, series in 
+                           cachedDicoms.values()]):
+            if not slicer.dicomDatabase.filesForSeries(series):
+                return False
+        return True
+
+
+
+
+    def indexDicoms(self):
+        """
+        Indexes the downloaded DICOM files ('self.extractedFiles') in the 
+        CacheIndex by their XNAT URI, with their series in 
+        slicer.dicomDatabase, once they have been added to it.
+        """
+        extractedByName = {}
+        for extractedFile in self.extractedFiles:
+            extractedByName[os.path.basename(extractedFile)] = extractedFile
+
+        dicoms = []
+        for fileUri in self.fileUris:
+            fileUri = MokaUtils.path.adjustPathSlashes(fileUri)
+            extractedFile = extractedByName.get(os.path.basename(fileUri))
+            if not extractedFile:
+                continue
+            series = slicer.dicomDatabase.seriesForFile(extractedFile)
+            if series:
+                dicoms.append((fileUri, extractedFile, series))
+        self.MODULE.CacheIndex.addDicom(dicoms)
 
-                
 
 
                 
@@ -106,6 +202,7 @@ class Loader_Dicom(Loader_Images):
         """
 
         if self.useCached:
+            self.cacheFiles(self.extractedFiles, False)
             return self.loadDicomsFromDatabase(self.extractedFiles)
 
 
@@ -138,29 +235,37 @@ class Loader_Dicom(Loader_Images):
         
 
         #--------------------
-        # Add DICOM files to slicer.dicomDataase
+        # Add DICOM files to slicer.dicomDataase, a batch at a time, 
+        # loading them once they're all in.  The files are pinned in 
+        # the cache first so they aren't evicted meanwhile.
         #--------------------
-        dicomIndexer = ctk.ctkDICOMIndexer()
-        try:
-            dicomIndexer.addListOfFiles(slicer.dicomDatabase, \
-                                        self.extractedFiles)
-        except Exception, e:
-            
-            #
-            # If the database is uninitialized, then initialize it.
-            #
-            errorString = str(e)
-            if 'uninitialized ctkDICOMItem' in errorString:
-                #print (MokaUtils.debug.lf(), "The slicer.dicomDabase is " + \
-                    #"unitialized (%s).  Initializing it."%(errorString))
-                slicer.dicomDatabase.initialize()
-                dicomIndexer.addListOfFiles(slicer.dicomDatabase, 
-                                            self.extractedFiles)
+        self.cacheFiles(self.extractedFiles)
+        Workflow_Load = self.MODULE.Workflow_Load
+        popupKey = self._src.split('?format=')[0]
+        def onIndexing(indexed, total):
+            Workflow_Load.XnatDownloadPopup.setIndexing(popupKey, indexed, 
+                                                        total)
+        def onIndexFailed(message):
+            Workflow_Load.XnatDownloadPopup.setFailed(popupKey, message)
+        Workflow_Load.DicomIndexQueue.add(popupKey, self.extractedFiles, 
+                                          self.onIndexed, onIndexing, 
+                                          onIndexFailed)
+
+
+
+    def onIndexed(self):
+        """
+        Callback for when the downloaded DICOM files are in 
+        slicer.dicomDatabase (see DicomIndexQueue).  Loads them.
+        """
+        self.indexDicoms()
+
 
         #--------------------
-        # Delete dst
+        # Delete dst (the zip file, if it was one).
         #--------------------
-        os.remove(self._dst)
+        if os.path.isfile(self._dst):
+            os.remove(self._dst)
 
 
         #--------------------
@@ -195,21 +300,36 @@ class Loader_Dicom(Loader_Images):
 
             
         #--------------------
-        # Parse through the slicer.dicomDatabase
-        # to get all of the files, as determined by series.
+        # Get the series of the downloaded DICOMS: those indexed for 
+        # the scans, or otherwise as found in the slicer.dicomDatabase.
+        #--------------------
+        seriesUids = set()
+        for scanUri in set([CacheIndex.getScanUri(fileUri) \
+                            for fileUri in self.fileUris]):
+            if scanUri:
+                seriesUids.update(
+                    self.MODULE.CacheIndex.getScanSeries(scanUri))
+        if not seriesUids:
+            seriesUids = set([slicer.dicomDatabase.seriesForFile(dicomFile) 
+                              for dicomFile in dicomFiles])
+
+
+            
+        #--------------------
+        # Get the files of the series, as determined by the database.
         #--------------------
         matchedDatabaseFiles = []
-        for patient in slicer.dicomDatabase.patients():
-            for study in slicer.dicomDatabase.studiesForPatient(patient):
-                for series in slicer.dicomDatabase.seriesForStudy(study):
-                    seriesFiles = slicer.dicomDatabase.filesForSeries(series)
-                    #
-                    # Compare files in series with what was just downloaded.
-                    # If there's a match, append to 'matchedDatabaseFiles'.
-                    #
-                    for sFile in seriesFiles:
-                       if os.path.basename(sFile) in dlDicomObj: 
-                           matchedDatabaseFiles.append(sFile)
+        for series in seriesUids:
+            if not series:
+                continue
+            seriesFiles = slicer.dicomDatabase.filesForSeries(series)
+            #
+            # Compare files in series with what was just downloaded.
+            # If there's a match, append to 'matchedDatabaseFiles'.
+            #
+            for sFile in seriesFiles:
+                if os.path.basename(sFile) in dlDicomObj: 
+                    matchedDatabaseFiles.append(sFile)
 
 
                            
@@ -268,3 +388,189 @@ class Loader_Dicom(Loader_Images):
         self.MODULE.View.startNewSession(sessionArgs)
 
 
+
+
+
+class DicomIndexQueue(object):
+    """
+    DicomIndexQueue adds DICOM files to slicer.dicomDatabase a batch of 
+    BATCH_SIZE files at a time, on a qt.QTimer, so that Slicer stays 
+    interactive while large series are indexed.  (The database can't be 
+    used off the GUI thread.)
+
+    Jobs are indexed one after the other, in the order they were added, 
+    so scans load in the order their downloads finished.  'onJobDone' 
+    runs after each job is finished, cancelled or failed (Workflow_Load 
+    holds the loaders after a DICOM loader until then).  A job fails, 
+    and is dropped, if the database can't index one of its batches.
+    """
+
+    BATCH_SIZE = 20
+
+
+    def __init__(self):
+        """
+        Init function.
+        """
+        self.jobs = []
+        self.dicomIndexer = ctk.ctkDICOMIndexer()
+        self.timer = qt.QTimer()
+        self.timer.setInterval(0)
+        self.timer.connect('timeout()', self.__indexBatch)
+        self.onEmpty = None
+        self.onJobDone = None
+
+
+
+    def add(self, key, dicomFiles, onFinished, onProgress = None, 
+            onFailed = None):
+        """
+        Queues a set of files to index.
+
+        @param key: The key of the job, i.e. the download popup row key.
+        @type key: str
+
+        @param dicomFiles: The local DICOM files to index.
+        @type dicomFiles: list(str)
+
+        @param onFinished: The callback for when the files are indexed.
+        @type onFinished: function
+
+        @param onProgress: The callback run after each batch, with the 
+            number of files indexed and the number of files in the job.
+        @type onProgress: function
+
+        @param onFailed: The callback for when the files can't be 
+            indexed, with the error message.
+        @type onFailed: function
+        """
+        self.jobs.append({
+            'key': key,
+            'files': list(dicomFiles),
+            'indexed': 0,
+            'onFinished': onFinished,
+            'onProgress': onProgress,
+            'onFailed': onFailed
+        })
+        if onProgress:
+            onProgress(0, len(dicomFiles))
+        self.timer.start()
+
+
+
+    def cancel(self, key):
+        """
+        Cancels a job.  Files that were already indexed stay in the 
+        database.
+
+        @param key: The key of the job.
+        @type key: str
+
+        @return: Whether there was a job to cancel.
+        @rtype: bool
+        """
+        for job in self.jobs:
+            if job['key'] == key:
+                self.jobs.remove(job)
+                if self.onJobDone:
+                    self.onJobDone()
+                self.__checkEmpty()
+                return True
+        return False
+
+
+
+    def isEmpty(self):
+        """
+        @return: Whether there is nothing left to index.
+        @rtype: bool
+        """
+        return len(self.jobs) == 0
+
+
+
+    def __indexBatch(self):
+        """
+        Timer callback.  Indexes the next batch of files of the first job.
+        """
+        if not self.jobs:
+            return self.__checkEmpty()
+        job = self.jobs[0]
+        batch = job['files'][job['indexed']:job['indexed'] + self.BATCH_SIZE]
+        try:
+            self.__addFiles(batch)
+        except Exception, e:
+            self.__finishJob(job, job['onFailed'], str(e))
+            return
+
+        job['indexed'] += len(batch)
+        if job['onProgress']:
+            job['onProgress'](job['indexed'], len(job['files']))
+
+        #
+        # The job may have been cancelled by the callbacks.
+        #
+        if job['indexed'] >= len(job['files']) and job in self.jobs:
+            self.__finishJob(job, job['onFinished'])
+            return
+        self.__checkEmpty()
+
+
+
+    def __addFiles(self, dicomFiles):
+        """
+        Adds files to slicer.dicomDatabase.
+
+        @param dicomFiles: The files.
+        @type dicomFiles: list(str)
+        """
+        try:
+            self.dicomIndexer.addListOfFiles(slicer.dicomDatabase, dicomFiles)
+        except Exception, e:
+            
+            #
+            # If the database is uninitialized, then initialize it.
+            #
+            if not 'uninitialized ctkDICOMItem' in str(e):
+                raise
+            slicer.dicomDatabase.initialize()
+            self.dicomIndexer.addListOfFiles(slicer.dicomDatabase, dicomFiles)
+
+
+
+    def __finishJob(self, job, callback, *args):
+        """
+        Removes a job, runs its callback (if any) and 'onJobDone', and 
+        stops the timer if there are no jobs left -- even if the 
+        callbacks raise.
+
+        @param job: The job.
+        @type job: dict
+
+        @param callback: The callback of the job to run.
+        @type callback: function
+
+        @param args: The arguments of the callback.
+        """
+        self.jobs.remove(job)
+        try:
+            if callback:
+                callback(*args)
+        finally:
+            try:
+                if self.onJobDone:
+                    self.onJobDone()
+            finally:
+                self.__checkEmpty()
+
+
+
+    def __checkEmpty(self):
+        """
+        Stops the timer, and runs 'onEmpty', once there are no jobs left.
+        """
+        if self.jobs or not self.timer.isActive():
+            return
+        self.timer.stop()
+        if self.onEmpty:
+            self.onEmpty()
@@ -59,12 +59,15 @@ class Loader_Mrb(Loader_File):
         # Update all absolute MRML filenames to local
         #-------------------------
         mrmls = []
+        unpackedFiles = []
         def callback(localFile):
+            unpackedFiles.append(localFile)
             if XnatSlicerUtils.isMRML(localFile) and \
                not os.path.basename(localFile).startswith('.'):
                 mrmls.append(self.__updateAbsoluteMrmlUrisToRelative(\
                                                         self._src, localFile))
         MokaUtils.path.fileWalk(unpackDir, callback)
+        self.cacheFiles(unpackedFiles)
 
         
         # Delete the dst.
@@ -0,0 +1,155 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import shutil
+import urlparse
+
+# external
+from MokaUtils import *
+
+# module
+from XnatSlicerGlobals import *
+from XnatSlicerUtils import *
+from Loader_Mrb import *
+
+
+
+class Loader_Scene(Loader_Mrb):
+    """
+    Loader_Scene loads scenes saved as separate files rather than as an
+    .mrb (see Workflow_Save.uploadSceneFiles).  The MRML is kept in the
+    Slicer resource as '<scene>.mrml', and the rest of the scene's bundle
+    directory (i.e. 'Data/') under the '<scene>/' folder next to it.  The
+    scene is reassembled in the cache as its bundle directory, and loaded
+    from its MRML.
+
+    Files of the scene that are cached and match the digests XNAT lists
+    for them aren't downloaded again.  The MRML always is.
+    """
+
+    SCENE_FILE_METADATA = ['URI', 'Size', 'digest']
+    DOWNLOAD_SUFFIX = '.download'
+
+
+    def __init__(self, MODULE, _src):
+        """
+        @param MODULE: The XNATSlicer module.
+        @type MODULE: XnatSlicerWidget
+
+        @param _src: The XNAT URL of the scene's MRML.
+        @type _src: str
+        """
+        super(Loader_Scene, self).__init__(MODULE, _src)
+        self.sceneName = os.path.splitext(os.path.basename(_src))[0]
+        self.keepPaths = True
+
+
+        #--------------------
+        # List the files of the scene.
+        #--------------------
+        mrmlUri = None
+        fileUris = []
+        contents = self.MODULE.XnatIo.getFolder(_src.rsplit('/', 1)[0],
+                                    metadata = self.SCENE_FILE_METADATA)
+        if not isinstance(contents, dict):
+            contents = {}
+        sizes = dict(zip(contents.get('URI', []), contents.get('Size', [])))
+        digests = dict(zip(contents.get('URI', []),
+                           contents.get('digest', [])))
+        for fileUri in contents.get('URI', []):
+            fileName = fileUri.split('/files/', 1)[-1]
+            if fileName == os.path.basename(_src):
+                mrmlUri = fileUri
+            elif fileName.startswith(self.sceneName + '/'):
+                fileUris.append(fileUri)
+        if not mrmlUri:
+            mrmlUri = urlparse.urlparse(_src).path
+        self.fileUris = fileUris
+        self.fileDigests = dict([(fileUri, digests[fileUri]) for fileUri \
+                                 in fileUris if digests.get(fileUri)])
+
+
+
+        #--------------------
+        # The scene is reassembled in the cache, where its files would
+        # be cached (i.e. 'downloads/data/experiments/.../files/<scene>').
+        #--------------------
+        sceneUri = mrmlUri.rsplit('/files/', 1)[0] + '/files/' + \
+                   self.sceneName
+        self.sceneDir = os.path.normpath(self._dstBase + sceneUri)
+        self._dst = self.sceneDir + self.DOWNLOAD_SUFFIX
+
+
+
+        #--------------------
+        # Download the files that aren't cached (or don't match their
+        # digests), and the MRML.
+        #--------------------
+        cached = self.MODULE.CacheIndex.lookup(self.fileDigests.keys(),
+                                               self.fileDigests)
+        self.cachedFiles = cached.values()
+        self.files = {}
+        for fileUri in [mrmlUri] + fileUris:
+            if fileUri in cached:
+                continue
+            try:
+                self.files[fileUri] = int(sizes[fileUri])
+            except (KeyError, TypeError, ValueError):
+                self.files[fileUri] = None
+
+
+
+    def load(self):
+        """
+        Moves the downloaded files into the scene's bundle directory,
+        then loads its MRML.
+        """
+        if not os.path.exists(self._dst):
+            return
+
+
+        #-------------------------
+        # Move the downloaded files into place.  The MRML is
+        # downloaded next to the '<scene>' folder, and goes into it.
+        #-------------------------
+        downloaded = []
+        verifiedDigests = self.MODULE.XnatIo.verifiedDigests
+        for root, dirs, files in os.walk(self._dst):
+            for fileName in files:
+                path = os.path.join(root, fileName)
+                relPath = os.path.relpath(path, self._dst)
+                if relPath.startswith(self.sceneName + os.sep):
+                    relPath = relPath[len(self.sceneName + os.sep):]
+                localPath = os.path.join(self.sceneDir, relPath)
+                if not os.path.exists(os.path.dirname(localPath)):
+                    os.makedirs(os.path.dirname(localPath))
+                if os.path.exists(localPath):
+                    os.remove(localPath)
+                os.rename(path, localPath)
+                if os.path.normpath(path) in verifiedDigests:
+                    verifiedDigests[os.path.normpath(localPath)] = \
+                        verifiedDigests.pop(os.path.normpath(path))
+                downloaded.append(localPath)
+        shutil.rmtree(self._dst, True)
+        self.cacheFiles(downloaded)
+        self.cacheFiles(self.cachedFiles, False)
+
+
+
+        #-------------------------
+        # Load the MRML.
+        #-------------------------
+        mrml = os.path.join(self.sceneDir, os.path.basename(self._src))
+        if not os.path.exists(mrml):
+            return False
+        return self.loadFinish(mrml)
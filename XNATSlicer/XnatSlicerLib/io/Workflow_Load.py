@@ -9,6 +9,9 @@ __email__ = "herrickr@mir.wustl.edu"
 __status__ = "Production"
 
 
+# python
+import collections
+
 # application
 from __main__ import qt, slicer
 
@@ -21,6 +24,7 @@ from Loader import *
 from Loader_Analyze import *
 from Loader_Dicom import *
 from Loader_Mrb import *
+from Loader_Scene import *
 from Popup import *
 from SlicerUtils import *
 from XnatSlicerUtils import *
@@ -36,8 +40,16 @@ class Workflow_Load(object):
     
     Parent Load workflow class to: XnatDicomWorkflow_Load, 
     XnatMrbWorkflow_Load, and XnatFileWorkflow_Load.
+
+    If PIPELINE_LOADS is True, each loader is loaded as soon as its 
+    download is done, while the rest of the queue keeps downloading.  
+    Loaders are always loaded in the order 'loaderFactory' returned them, 
+    so a loader whose download finishes early waits for the ones before it.
     """
 
+    PIPELINE_LOADS = True
+    SCAN_FILE_METADATA = ['URI', 'Size', 'digest']
+
     
     def __init__(self, MODULE):
         """ 
@@ -52,7 +64,11 @@ class Workflow_Load(object):
 
         self.skipEmptySceneCheck = False
         self._src = None
-        self.loaders = {}
+        self.loaders = collections.OrderedDict()
+        self.downloaded = set()
+        self.loaded = set()
+        self.__loading = False
+        self.__loadAll = False
 
         
         #--------------------------------
@@ -70,7 +86,11 @@ class Workflow_Load(object):
 
 
         self.XnatDownloadPopup = XnatDownloadPopup()
-        self.XnatDownloadPopup.setCancelCallback(self.MODULE.XnatIo.cancelDownload)
+        self.XnatDownloadPopup.setCancelCallback(self.__cancel)
+
+        self.DicomIndexQueue = DicomIndexQueue()
+        self.DicomIndexQueue.onEmpty = self.XnatDownloadPopup.hide
+        self.DicomIndexQueue.onJobDone = self.__onDicomsIndexed
         
         self.clearScenePopup = XnatClearScenePopup()
         self.clearScenePopup.connect('buttonClicked(QAbstractButton*)', self.__clearSceneButtonClicked) 
@@ -80,6 +100,22 @@ class Workflow_Load(object):
 
 
 
+    def __cancel(self, uriKey):
+        """
+        Callback for the cancel buttons of the download popup.  Cancels 
+        the indexing of the row's DICOM files if they are being indexed, 
+        otherwise its download.
+
+        @param uriKey: The key of the download popup row.
+        @type uriKey: str
+        """
+        if self.DicomIndexQueue.cancel(uriKey):
+            self.XnatDownloadPopup.setCancelled(uriKey)
+            return
+        self.MODULE.XnatIo.cancelDownload(uriKey)
+
+
+
     def __sortLoadablesByType(self, fileUris):
         """
         Sorts a list of file uris by XNATSlicer loadable types.  Generally used 
@@ -133,7 +169,7 @@ class Workflow_Load(object):
         def downloadStarted(_xnatSrc, size = 0):
             #print "\n\nDOWNLOAD START", self.XnatDownloadPopup.downloadRows, "\n\n"
             #if size > 0:
-            self.XnatDownloadPopup.setSize(_xnatSrc.split('?format=zip')[0], size)
+            self.XnatDownloadPopup.setSize(_xnatSrc.split('?format=')[0], size)
             slicer.app.processEvents()
         self.MODULE.XnatIo.onEvent('downloadStarted', downloadStarted)
 
@@ -143,7 +179,7 @@ class Workflow_Load(object):
         # Downloading
         #--------------------------------
         def downloading(_xnatSrc, size = 0):
-            self.XnatDownloadPopup.updateDownload(_xnatSrc.split('?format=zip')[0], size)
+            self.XnatDownloadPopup.updateDownload(_xnatSrc.split('?format=')[0], size)
             slicer.app.processEvents()
         self.MODULE.XnatIo.onEvent('downloading', downloading)
 
@@ -156,7 +192,7 @@ class Workflow_Load(object):
             #
             # Update the popup
             #
-            self.XnatDownloadPopup.setFinished(_xnatSrc.split('?format=zip')[0])
+            self.XnatDownloadPopup.setFinished(_xnatSrc.split('?format=')[0])
             slicer.app.processEvents()
         self.MODULE.XnatIo.onEvent('downloadFinished', downloadFinished)
 
@@ -170,7 +206,7 @@ class Workflow_Load(object):
             #
             # Update the popup
             #
-            self.XnatDownloadPopup.setCancelled(_xnatSrc.split('?format=zip')[0])
+            self.XnatDownloadPopup.setCancelled(_xnatSrc.split('?format=')[0])
 
             #
             # Set loader to None if it pertains to the 
@@ -180,7 +216,8 @@ class Workflow_Load(object):
                 if loader and _xnatSrc in loader.loadArgs['src']:
                     self.loaders[key] = None
 
-            if len(self.MODULE.XnatIo.downloadQueue) == 0:
+            if len(self.MODULE.XnatIo.downloadQueue) == 0 and \
+               self.DicomIndexQueue.isEmpty():
                 self.XnatDownloadPopup.hide()
                 slicer.app.processEvents()
         self.MODULE.XnatIo.onEvent('downloadCancelled', downloadCancelled)
@@ -270,18 +307,29 @@ class Workflow_Load(object):
         #------------------------
         # Set Download finished callbacks
         #------------------------        
+        def onLoaderDownloaded(_xnatSrc, *args):
+            for key in self.loaders:
+                if _xnatSrc in key:
+                    self.downloaded.add(key)
+            if self.PIPELINE_LOADS:
+                self.__loadDownloaded()
+
         def onDownloadFinished():
             self.XnatDownloadPopup.hide()
             self.postDownloadPopup.show()
-            for key, loader in self.loaders.iteritems():
-                #print "DOWNLOAD FINISHED!"
-                if loader:
-                    loader.load()
-                    slicer.app.processEvents()
-                    self._src = None
+            self.__loadAll = True
+            self.__loadDownloaded(True)
+            self.MODULE.CacheIndex.evict(
+                self.MODULE.Settings['CACHE'].getCacheSize(), 
+                slicer.dicomDatabase)
             self.postDownloadPopup.hide()
+            #
+            # DICOM files still being indexed (see DicomIndexQueue) 
+            # keep the download popup open until they're done.
+            #
+            if not self.DicomIndexQueue.isEmpty():
+                self.XnatDownloadPopup.show()
             self.MODULE.XnatIo.clearDownloadQueue()
-            self.loaders = {}
 
             
         
@@ -294,11 +342,23 @@ class Workflow_Load(object):
 
         
         #------------------------
-        # Get loaders, add to queue
+        # Get loaders, add to queue.  Loaders of an earlier 
+        # load that are held behind DICOM indexing (see 
+        # __loadDownloaded) stay queued ahead of the new ones: 
+        # their downloads are done.
         #------------------------  
+        for key in self.loaded:
+            self.loaders.pop(key, None)
+        self.loaded = set()
+        self.downloaded = set(self.loaders)
+        self.__loadAll = False
         for loader in self.loaderFactory(self._src):
             if not loader.useCached:
-                self.MODULE.XnatIo.addToDownloadQueue(loader.loadArgs['src'], loader.loadArgs['dst'])
+                self.MODULE.XnatIo.addToDownloadQueue(loader.loadArgs['src'], loader.loadArgs['dst'], 
+                                                      loader.loadArgs['extract'], 
+                                                      loader.loadArgs['files'],
+                                                      loader.loadArgs['digests'],
+                                                      loader.loadArgs['keepPaths'])
             self.loaders[loader.loadArgs['src']] = loader
                          
 
@@ -309,6 +369,9 @@ class Workflow_Load(object):
         #------------------------ 
         self.preDownloadPopup.hide()
         self.XnatDownloadPopup.show()
+        for event in ['downloadFinished', 'downloadCancelled', 
+                      'downloadFailed']:
+            self.MODULE.XnatIo.onEvent(event, onLoaderDownloaded)
         self.MODULE.XnatIo.onEvent('downloadQueueFinished', onDownloadFinished)
         self.MODULE.XnatIo.startDownloadQueue()
       
@@ -322,14 +385,71 @@ class Workflow_Load(object):
     
 
 
+
+    def __loadDownloaded(self, force = False):
+        """
+        Loads, in order, the loaders whose downloads are done (or that use 
+        the cache), stopping at the first one still downloading.  Loaders 
+        of cancelled or failed downloads are skipped.
+
+        DICOM loaders only queue their files for indexing (see 
+        DicomIndexQueue) and load once they're indexed, so loading also 
+        stops while the DicomIndexQueue has jobs: the loaders after them 
+        are held, and loaded by __onDicomsIndexed, so that scans still 
+        load in loaderFactory order.
+
+        @param force: Load every remaining loader (i.e. once the download 
+            queue is finished).
+        @type force: bool
+        """
+
+        #------------------------
+        # A load can process events that end other downloads: the 
+        # running loop picks those up.
+        #------------------------
+        if self.__loading:
+            return
+        self.__loading = True
+        try:
+            for key, loader in self.loaders.iteritems():
+                if key in self.loaded:
+                    continue
+                if not self.DicomIndexQueue.isEmpty():
+                    return
+                if loader and not loader.useCached and not force and \
+                   not key in self.downloaded:
+                    return
+                self.loaded.add(key)
+                if loader:
+                    loader.load()
+                    slicer.app.processEvents()
+                    self._src = None
+        finally:
+            self.__loading = False
+
+
+
+    def __onDicomsIndexed(self):
+        """
+        Callback for when the DicomIndexQueue finishes (or cancels) a 
+        job.  Loads the loaders that were held behind it.
+        """
+        self.__loadDownloaded(self.__loadAll)
+
+
+
         
-    def loaderFactory(self, _src):
+    def loaderFactory(self, _src, scanContents = None):
         """ 
         Returns the appropriate set of loaders after analyzing the
         '_src' argument.
         
         @param _src: The URI to create loaders from.
         @type _src: str
+
+        @param scanContents: The 'URI', 'Size' and 'digest' metadata of the 
+            files of the scan '_src', if already known.  Queried otherwise.
+        @type scanContents: dict
         
         @return: The loader list.
         @rtype: list(Loader)
@@ -358,8 +478,12 @@ class Workflow_Load(object):
         #------------------------
         if '/files/' in _src:
             
+            # MRML of a scene saved as separate files
+            if '/Slicer/files/' in _src and XnatSlicerUtils.isMRML(_src):
+                loaders.append(Loader_Scene(self.MODULE, _src))
+
             # MRB
-            if '/Slicer/files/' in _src:
+            elif '/Slicer/files/' in _src:
                 #print "FOUND SLICER FILE"
                 loaders.append(Loader_Mrb(self.MODULE, _src))
                 
@@ -378,8 +502,16 @@ class Workflow_Load(object):
             splitScan =  _src.split('/scans/')   
             scanSrc = splitScan[0] + '/scans/' + splitScan[1].split('/')[0] + '/files'
             #print "SPLIT SCAN:", splitScan, '\n\t',scanSrc
-            # query xnat for folder contents
-            contentUris = self.MODULE.XnatIo.getFolder(scanSrc, metadata= ['URI'])['URI']
+            # query xnat for folder contents, unless given
+            contents = scanContents or self.MODULE.XnatIo.getFolder(scanSrc, metadata= self.SCAN_FILE_METADATA)
+            contentUris = contents['URI']
+            contentSizes = contents.get('Size', [])
+            contentSizes = dict(zip(contentUris, contentSizes)) \
+                           if len(contentSizes) == len(contentUris) else {}
+            # Not every catalog has digests.
+            contentDigests = contents.get('digest', [])
+            contentDigests = dict(zip(contentUris, contentDigests)) \
+                             if len(contentDigests) == len(contentUris) else {}
             #print "CONTENT URIS", contentUris
             # get file uris and sort them by type
             loadables = self.__sortLoadablesByType(contentUris)
@@ -389,9 +521,9 @@ class Workflow_Load(object):
             for loadableType, loadableList in loadables.iteritems():
                 if len(loadableList) > 0:
                     if loadableType == 'analyze':
-                        loaders.append(Loader_Analyze(self.MODULE, _src, loadables[loadableType]))
+                        loaders.append(Loader_Analyze(self.MODULE, _src, loadables[loadableType], contentSizes, contentDigests))
                     if loadableType == 'dicom':      
-                        loaders.append(Loader_Dicom(self.MODULE, _src, loadables[loadableType]))
+                        loaders.append(Loader_Dicom(self.MODULE, _src, loadables[loadableType], contentSizes, contentDigests))
                     if loadableType == 'misc':
                         loaders.append(Loader_File(self.MODULE, _src, loadables[loadableType]))
 
@@ -401,7 +533,8 @@ class Workflow_Load(object):
         # '/experiments/' LEVEL 
         #
         # Basically, recurse this function after querying for the 
-        # scans in it.
+        # scans in it.  The files of every scan are listed with one 
+        # request if the host allows it, otherwise each scan is queried.
         #------------------------
         elif '/experiments/' in _src and not '/scans/' in _src and not '/resources/' in _src:
 
@@ -409,6 +542,15 @@ class Workflow_Load(object):
             splitExpt = _src.split('/experiments/')
             exptSrc = splitExpt[0] + '/experiments/' + splitExpt[1].split('/')[0] + '/scans'
             #print "SPLIT Expt:", splitExpt, '\n\t',exptSrc
+            # Query for the files of all the scans at once.
+            scanFiles = self.MODULE.XnatIo.getScanFiles(exptSrc.rsplit('/scans', 1)[0], 
+                                                        metadata = self.SCAN_FILE_METADATA)
+            if scanFiles != None:
+                for scanId, scanContents in scanFiles.iteritems():
+                    scanSrc = exptSrc + '/' + scanId + '/files'
+                    loaders += self.loaderFactory(scanSrc, scanContents)
+                return loaders
+
             # Query for Scan IDs from XNAT.
             contents = self.MODULE.XnatIo.getFolder(exptSrc, metadata = ['ID'])
             #print "SCAN IDS", contents
@@ -22,6 +22,7 @@ from FileInfo import *
 from ScenePackager import *
 from Timer import *
 from SaveDialog import *
+from Popup import *
 from MokaUtils import *
 
 
@@ -32,8 +33,16 @@ class Workflow_Save(object):
     """ 
     Workflow_Save manages all of the processes needed to upload
     a file to an XNAT.  Packaging scenes are conducted here.
+
+    Packaged scenes are uploaded in the background by the XnatIo upload 
+    queue, shown in an XnatUploadPopup, so the user can keep working.
+    Scenes can also be uploaded as separate files, in which case only 
+    the files that changed are sent (see 'uploadSceneFiles').
     """
 
+    WAIT_TEXT = "Please wait while the scene is packaged..."
+    UPLOAD_POLL_INTERVAL = 100
+
     def __init__(self, MODULE):
         """ 
         Init function.
@@ -47,8 +56,26 @@ class Workflow_Save(object):
         #------------------------
         # Set wait window
         #------------------------
-        self.waitWindow = qt.QMessageBox(1, "Uploading", \
-                                         "Please wait while file uploads...")
+        self.waitWindow = qt.QMessageBox(1, "Saving", self.WAIT_TEXT)
+
+
+
+        #------------------------
+        # Upload queue popup, and the timer that runs the upload
+        # events while the queue is running.  'uploads' holds the 
+        # session args and tree uri of each upload, by XNAT url.
+        # 'packageDirs' holds the local directories of the saves being
+        # uploaded, removed once the queue is done.
+        #------------------------
+        self.XnatUploadPopup = XnatUploadPopup()
+        self.XnatUploadPopup.setCancelCallback(self.__cancel)
+        self.uploads = {}
+        self.packageDirs = []
+        self.uploadFailed = False
+        self.uploadIo = None
+        self.uploadTimer = qt.QTimer()
+        self.uploadTimer.setInterval(self.UPLOAD_POLL_INTERVAL)
+        self.uploadTimer.connect('timeout()', self.__onUploadTimeout)
 
 
         
@@ -100,6 +127,24 @@ class Workflow_Save(object):
 
 
 
+
+    def __onVtkConverted(self, converted, total):
+        """
+        Shows the progress of the VTK conversions in the wait window.  See 
+        ScenePackager.convertAllBinaryVtksToAscii.
+
+        @param converted: The number of files converted.
+        @type converted: int
+
+        @param total: The number of files to convert.
+        @type total: int
+        """
+        self.waitWindow.setText("Converting models to ASCII " + 
+                                "(%i of %i)..."%(converted, total))
+        slicer.app.processEvents()
+
+
+
         
     def saveScene(self):    
         """  
@@ -121,111 +166,289 @@ class Workflow_Save(object):
 
 
 
-        #------------------------
-        # Save the scene locally via ScenePackager.saveSlicerScene
-        #------------------------
-        package = self.ScenePackager.saveSlicerScene(\
+        try:
+
+            #------------------------
+            # Save the scene locally via ScenePackager.saveSlicerScene
+            #------------------------
+            package = self.ScenePackager.saveSlicerScene(\
                                 self.MODULE.View.sessionManager.sessionArgs)
 
 
         
-        #------------------------
-        # Get the appropriate file paths from 
-        # the locally saved scene above.
-        #------------------------
-        projectDir = package['path']
-        mrmlFile =  package['mrml']  
+            #------------------------
+            # Get the appropriate file paths from 
+            # the locally saved scene above.
+            #------------------------
+            projectDir = package['path']
+            mrmlFile =  package['mrml']  
+            self.packageDirs.append(os.path.dirname(projectDir))
         
 
 
-        #------------------------
-        # Using the file paths above, 
-        # zip up the save directory...
-        #------------------------ 
+            #------------------------
+            # Using the file paths above, 
+            # zip up the save directory...
+            #------------------------ 
 
-        #
-        # Construct the .mrb uri.
-        #
-        srcMrb = projectDir + XnatSlicerGlobals.DEFAULT_SLICER_EXTENSION
-        
-        #
-        # Remove any mrb files with the same name, 
-        # if they exist.
-        #
-        if os.path.exists(srcMrb): 
-            os.remove(srcMrb) 
+            #
+            # Construct the .mrb uri.  The save has a directory of its own 
+            # (see ScenePackager.saveSlicerScene), so an earlier save of the 
+            # scene that is still uploading is left alone.
+            #
+            srcMrb = projectDir + XnatSlicerGlobals.DEFAULT_SLICER_EXTENSION
 
-        #-----------------------------------
-        # IMPORTANT PLEASE READ!!!!
-        #
-        #
-        # We need to convert any vtk files to ascii so that XTK
-        # can read it when XNATImageViewer is used.
-        #-----------------------------------
-        self.ScenePackager.convertAllBinaryVtksToAscii(projectDir)
+            #-----------------------------------
+            # IMPORTANT PLEASE READ!!!!
+            #
+            #
+            # We need to convert any vtk files to ascii so that XTK
+            # can read it when XNATImageViewer is used.  This can be
+            # turned off in the 'Save' settings, which keeps them binary
+            # (smaller, and quicker to save and upload).
+            #-----------------------------------
+            if self.MODULE.Settings['SAVE'].isChecked('asciiVtks'):
+                self.ScenePackager.convertAllBinaryVtksToAscii(projectDir, 
+                                                    self.__onVtkConverted)
+                self.waitWindow.setText(self.WAIT_TEXT)
+
+
+            #------------------------
+            # Upload the scene as separate files, if set to in the 'Save'
+            # settings, sending only those that changed...
+            #------------------------
+            if self.MODULE.Settings['SAVE'].isChecked('sceneFiles'):
+                self.uploadSceneFiles(projectDir, mrmlFile)
+
+            #------------------------
+            # ...otherwise move the save directory into the mrb uri (the
+            # directory is removed as it goes) and queue the mrb for 
+            # upload to XNAT.  The tree is updated once it is uploaded 
+            # (see '__onUploadFinished').
+            #------------------------
+            else:
+                self.ScenePackager.packageDirectory(srcMrb, projectDir)
+                dstMrb = \
+                    self.MODULE.View.sessionManager.sessionArgs['saveUri'] + \
+                    "/" + os.path.basename(srcMrb)
+                self.__upload(srcMrb, dstMrb)
+
+
+
+        finally:
+            #------------------------
+            # Hide wait window, and let the user
+            # keep working while the upload runs
+            # (or after the save failed).
+            #------------------------
+            self.waitWindow.hide()
+            self.waitWindow.setText(self.WAIT_TEXT)
+            self.MODULE.View.setEnabled(True)
+
+
+
+
+    def uploadSceneFiles(self, projectDir, mrmlFile):
+        """
+        Uploads a saved scene as separate files rather than as an .mrb: 
+        the MRML as '<scene>.mrml' in the Slicer resource, and the rest of
+        the bundle directory (i.e. 'Data/') under '<scene>/' next to it 
+        (see Loader_Scene).  
+
+        The scene is synced by the upload queue (see XnatIo.syncFiles), 
+        so the files are compared with those on XNAT off the GUI thread.
+        Only the files that changed are sent, then the MRML, then the 
+        files no longer in the scene are deleted.  
+
+        @param projectDir: The bundle directory of the saved scene.
+        @type projectDir: str
 
+        @param mrmlFile: The MRML of the saved scene.
+        @type mrmlFile: str
+        """
+        saveUri = self.MODULE.View.sessionManager.sessionArgs['saveUri']
+        sceneName = os.path.basename(os.path.normpath(projectDir))
 
         #
-        # Compress the save diectory to the mrb uri.
+        # Move the MRML next to the bundle directory, as it is on XNAT,
+        # so the directory holds only the files it refers to.
         #
-        self.ScenePackager.convertDirectoryToZip(srcMrb, projectDir)
+        srcMrml = os.path.join(os.path.dirname(os.path.normpath(projectDir)),
+                               sceneName + XnatSlicerGlobals.MRML_EXTENSIONS[0])
+        os.rename(mrmlFile, srcMrml)
+        self.__upload(srcMrml, saveUri + '/' + sceneName + 
+                      XnatSlicerGlobals.MRML_EXTENSIONS[0], 
+                      srcDir = projectDir, 
+                      dstDir = saveUri + '/' + sceneName)
 
-        #
-        # Remove the uncompressed directory, as we
-        # don't need it any more. 
-        #       
-        shutil.rmtree(projectDir)
 
 
 
-        #------------------------
-        # Upload the mrb to XNAT.
-        #------------------------
+    def __upload(self, src, dst, srcDir = None, dstDir = None):
+        """
+        Adds a file to the XnatIo upload queue and shows it in the upload 
+        popup, starting the queue if it isn't running.  An earlier upload
+        to 'dst' that hasn't finished is replaced by this one (see 
+        XnatIo.addToUploadQueue).
 
-        #
-        # Construct the upload string.
-        #
-        dstMrb = self.MODULE.View.sessionManager.sessionArgs['saveUri'] + \
-                 "/" + os.path.basename(srcMrb)    
+        @param src: The local file (i.e. the .mrb).
+        @type src: str
 
-        #
-        # Upload via XnatIo
-        #
-        self.MODULE.XnatIo.putFile(srcMrb, dstMrb)
+        @param dst: The XNAT uri to upload it to.
+        @type dst: str
 
-        #
-        # Process events.
-        #
-        slicer.app.processEvents()
-  
+        @param srcDir: The optional directory of the files 'src' refers
+            to (i.e. those of a scene uploaded as separate files), synced
+            to 'dstDir' along with it.
+        @type srcDir: str
 
+        @param dstDir: The XNAT uri to sync 'srcDir' to.
+        @type dstDir: str
+        """
+        if not self.uploadIo or not self.uploadIo.isUploading():
+            self.__resetUploadCallbacks()
 
-        #------------------------
-        # Update viewer
-        #------------------------
-        baseName = os.path.basename(srcMrb)
+        uploadUrl = self.uploadIo.addToUploadQueue(src, dst, 
+                                    srcDir = srcDir, dstDir = dstDir)
+        self.uploads[uploadUrl] = {
+            'sessionArgs': self.MODULE.View.sessionManager.sessionArgs,
+            'treeUri': 'projects' + dst.split('projects')[1]
+        }
+
+        self.XnatUploadPopup.addDownloadRow(uploadUrl)
+        self.XnatUploadPopup.setSize(uploadUrl, os.path.getsize(src))
+        self.XnatUploadPopup.show()
+
+        self.uploadIo.startUploadQueue()
+        self.uploadTimer.start()
+
+
+
+
+    def __resetUploadCallbacks(self):
+        """ 
+        Clears and sets the upload callbacks of MODULE.XnatIo, and clears
+        the rows of the previous uploads from the popup.
+        """
+        self.uploadIo = self.MODULE.XnatIo
+        for event in ['uploadStarted', 'uploading', 'uploadFinished', 
+                      'uploadCancelled', 'uploadFailed', 
+                      'uploadQueueFinished']:
+            self.uploadIo.clearEvents(event)
+        self.XnatUploadPopup.downloadRows = {}
+        self.uploadFailed = False
+
+        self.uploadIo.onEvent('uploadStarted', 
+                              self.XnatUploadPopup.setSize)
+        self.uploadIo.onEvent('uploading', 
+                              self.XnatUploadPopup.updateDownload)
+        self.uploadIo.onEvent('uploadFinished', self.__onUploadFinished)
+        self.uploadIo.onEvent('uploadCancelled', self.__onUploadCancelled)
+        self.uploadIo.onEvent('uploadFailed', self.__onUploadFailed)
+        self.uploadIo.onEvent('uploadQueueFinished', 
+                              self.__onUploadQueueFinished)
+
+
+
+
+    def __onUploadTimeout(self):
+        """
+        Runs the upload events on the GUI thread until the upload queue
+        is done.
+        """
+        uploading = self.uploadIo.isUploading()
+        self.uploadIo.dispatchEvents()
+        if not uploading:
+            self.uploadTimer.stop()
+
+
+
+
+    def __cancel(self, uploadUrl):
+        """
+        Cancel callback of the upload popup.
+
+        @param uploadUrl: The XNAT url of the upload.
+        @type uploadUrl: str
+        """
+        self.uploadIo.cancelUpload(uploadUrl)
+
+
+
+
+    def __onUploadFinished(self, uploadUrl):
+        """
+        Callback for when a scene is uploaded: selects it in the tree.
+
+        @param uploadUrl: The XNAT url of the upload.
+        @type uploadUrl: str
+        """
+        self.XnatUploadPopup.setFinished(uploadUrl)
+        upload = self.uploads.pop(uploadUrl, None)
+        if not upload:
+            return
 
         #
         # Create a new session
         #
-        self.MODULE.View.sessionManager.sessionArgs['sessionType'] = \
-                                                    "scene upload"
-        self.MODULE.View.startNewSession(\
-                    self.MODULE.View.sessionManager.sessionArgs)
+        upload['sessionArgs']['sessionType'] = "scene upload"
+        self.MODULE.View.startNewSession(upload['sessionArgs'])
 
         #
         # Select the newly saved object as a node in the viewer.
         #
-        treeUri = 'projects' + dstMrb.split('projects')[1]
-        self.MODULE.View.selectItem_byUri(treeUri)
-        self.MODULE.View.setEnabled(True)
-        MokaUtils.debug.lf("\nUpload of '%s' complete."%(baseName))
+        self.MODULE.View.selectItem_byUri(upload['treeUri'])
+        MokaUtils.debug.lf("\nUpload of '%s' complete."%(\
+                                            os.path.basename(uploadUrl)))
 
 
 
-        #------------------------
-        # Hide wait window
-        #------------------------
-        self.waitWindow.hide()
 
-                    
+    def __onUploadCancelled(self, uploadUrl):
+        """
+        @param uploadUrl: The XNAT url of the upload.
+        @type uploadUrl: str
+        """
+        self.XnatUploadPopup.setCancelled(uploadUrl)
+        self.uploads.pop(uploadUrl, None)
+
+
+
+
+    def __onUploadFailed(self, uploadUrl, src, message):
+        """
+        @param uploadUrl: The XNAT url of the upload.
+        @type uploadUrl: str
+
+        @param src: The local file.
+        @type src: str
+
+        @param message: The error message.
+        @type message: str
+        """
+        self.XnatUploadPopup.setFailed(uploadUrl, message)
+        self.uploads.pop(uploadUrl, None)
+        self.uploadFailed = True
+        MokaUtils.debug.lf("\nUpload of '%s' failed: %s"%(src, message))
+
+
+
+
+    def __onUploadQueueFinished(self):
+        """
+        Hides the upload popup once every upload is done, unless one of 
+        them failed, and removes the local directories of the uploaded 
+        saves.
+        """
+        if not self.uploadFailed:
+            self.XnatUploadPopup.hide()
+
+        #
+        # i.e. a scene was saved since the queue finished, and is 
+        # uploading: its directory is removed once that queue is done.
+        #
+        if self.uploadIo.isUploading():
+            return
+        for packageDir in self.packageDirs:
+            shutil.rmtree(packageDir, True)
+        self.packageDirs = []
@@ -66,11 +66,10 @@ class CheckBoxSetting(object):
             self.addSyncCallback_ToFile(storeTag,  self.__syncToFile)
             self.addSyncCallback_FileTo(storeTag, self.__syncFileTo)
             
-            
-        #
-        # Add to widget
-        #
-        self.masterLayout.addWidget(self.CHECKBOXES[key]['widget'])
+            #
+            # Add to widget
+            #
+            self.masterLayout.addWidget(self.CHECKBOXES[key]['widget'])
         self.masterLayout.addStretch()
 
 
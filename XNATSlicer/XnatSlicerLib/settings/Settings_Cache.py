@@ -39,10 +39,87 @@ class Settings_Cache(CheckBoxSetting, Settings):
     ])
 
 
+    CACHE_SIZE_TAG = 'cacheSizeGb'
+    DEFAULT_CACHE_SIZE = 20
+    MAX_CACHE_SIZE = 2000
+
+
     def setup(self):
         """
         Setup function inherited from parent class.
+            -Adds the cache size spin box and its relevant callbacks 
+            to the widget.
             -Adds a checkbox and its relevant callbacks to the widget.
         """   
+        self.createCacheSizeSpinBox()
         self.createCheckBoxes()
 
+
+
+    def getCacheSizeStorageTag(self):
+        """
+        @return: The storage tag of the cache size.
+        @rtype: str
+        """
+        return self.__class__.__name__ + '_' + self.CACHE_SIZE_TAG
+
+
+
+    def createCacheSizeSpinBox(self):
+        """
+        Adds the spin box of the size, in GB, that the download cache is 
+        kept to (see CacheIndex).
+        """
+        storeTag = self.getCacheSizeStorageTag()
+        self.cacheSizeSpinBox = qt.QSpinBox()
+        self.cacheSizeSpinBox.setRange(1, self.MAX_CACHE_SIZE)
+        self.cacheSizeSpinBox.setSuffix(' GB')
+        self.cacheSizeSpinBox.setFixedWidth(100)
+        self.cacheSizeSpinBox.connect('valueChanged(int)', 
+                                      self.__syncCacheSizeFileTo)
+        self.DEFAULTS[storeTag] = self.DEFAULT_CACHE_SIZE
+        self.addSyncCallback_ToFile(storeTag, self.__syncCacheSizeToFile)
+        self.addSection('Download cache size', self.cacheSizeSpinBox)
+
+
+
+    def getCacheSize(self):
+        """
+        @return: The size the download cache is kept to, in bytes.
+        @rtype: int
+        """
+        cacheSize = self.DEFAULT_CACHE_SIZE
+        if self.currXnatHost:
+            setting = self.SettingsFile.getSetting(self.currXnatHost, 
+                                            self.getCacheSizeStorageTag())
+            if setting and setting[0].isdigit():
+                cacheSize = int(setting[0])
+        return cacheSize * 1024 * 1024 * 1024
+
+
+
+    def __syncCacheSizeToFile(self):
+        """
+        Syncs the spin box to the stored cache size in the SettingsFile.
+        """
+        setting = self.SettingsFile.getSetting(self.currXnatHost, 
+                                               self.getCacheSizeStorageTag())
+        if setting and setting[0].isdigit():
+            self.cacheSizeSpinBox.blockSignals(True)
+            self.cacheSizeSpinBox.setValue(int(setting[0]))
+            self.cacheSizeSpinBox.blockSignals(False)
+
+
+
+    def __syncCacheSizeFileTo(self, value):
+        """
+        Syncs the SettingsFile to the spin box.  Also the callback for 
+        when the spin box changes.
+
+        @param value: The cache size in GB.
+        @type value: int
+        """
+        if self.currXnatHost:
+            self.SettingsFile.setSetting(self.currXnatHost, 
+                                {self.getCacheSizeStorageTag(): str(value)})
+
@@ -0,0 +1,69 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+from collections import OrderedDict
+
+# module
+from Settings import *
+from CheckBoxSetting import *
+
+
+
+class Settings_Save(CheckBoxSetting, Settings):
+    """
+    Manages settings related to saving scenes to XNAT.
+    """
+
+    CHECKBOXES = OrderedDict([
+        ('asciiVtks', {
+            'tag': 'asciiVtks',
+            'desc': 'Convert VTK models to ASCII (for XNAT Image Viewer).',
+            'checked': True,
+            'event': 'ASCIIVTKS'
+        }),
+        ('sceneFiles', {
+            'tag': 'sceneFiles',
+            'desc': 'Upload scenes as separate files, sending only the ' + 
+                    'files that changed (instead of an .mrb).',
+            'checked': False,
+            'event': 'SCENEFILES'
+        })
+    ])
+
+
+
+    def setup(self):
+        """
+        Setup function inherited from parent class.
+            -Adds a checkbox and its relevant callbacks to the widget.
+        """
+        self.addSection('Scene packaging')
+        self.createCheckBoxes()
+
+
+
+    def isChecked(self, checkBoxKey):
+        """
+        @param checkBoxKey: The key of the checkbox in CHECKBOXES.
+        @type checkBoxKey: str
+
+        @return: Whether the checkbox is checked for the current host
+            (its default if it was never set).
+        @rtype: bool
+        """
+        if not self.currXnatHost:
+            return self.CHECKBOXES[checkBoxKey]['checked']
+        setting = self.SettingsFile.getSetting(self.currXnatHost,
+                                    self.getCheckBoxStorageTag(checkBoxKey))
+        if not setting:
+            return self.CHECKBOXES[checkBoxKey]['checked']
+        return 'True' in setting[0]
@@ -152,6 +152,7 @@ class XnatDownloadPopup(XnatEmptyPopup):
     FONT_NAME = 'Arial'
     FONT_SIZE = 10
     LABEL_FONT = qt.QFont(FONT_NAME, FONT_SIZE, 10, False)
+    ACTIVE_TEXT = 'DOWNLOADING'
 
     def __init__(self, title = "XNAT Download Queue", memDisplay = "MB"):
         """ 
@@ -288,7 +289,7 @@ class XnatDownloadPopup(XnatEmptyPopup):
         def cancelClick():
             rowWidget.setEnabled(False)
             #print "Cancelling download '%s'"%(dlStr)
-            textEdit.setText(textEdit.toHtml().replace('DOWNLOADING', 
+            textEdit.setText(textEdit.toHtml().replace(self.ACTIVE_TEXT, 
                                                        'CANCELLED'))
             for key, item in self.downloadRows.iteritems():
                 if item['progressBar'] == progressBar:
@@ -439,7 +440,7 @@ class XnatDownloadPopup(XnatEmptyPopup):
         if downloadSize == '0MB':
             downloadSize = '[Unknown Size]'
         self.downloadRows[uriKey]['textEdit'].setText(\
-                    "DOWNLOADING<br>%s<br>%sMB out of %s<br>"%(\
+                    "%s<br>%s<br>%sMB out of %s<br>"%(self.ACTIVE_TEXT, 
                      self.makeDownloadPath(\
                             self.downloadRows[uriKey]['pathDict']),  
                             self.downloadRows[uriKey]['downloaded'], 
@@ -509,9 +510,51 @@ class XnatDownloadPopup(XnatEmptyPopup):
         self.downloadRows[uriKey]['textEdit'].setText("FINISHED<br><i>%s</i>"\
                 %(self.makeDownloadPath(self.downloadRows[uriKey]['pathDict'])))
         self.setProgressBarValue(uriKey, 100)
+
+
+
+    def setFailed(self, uriKey, message):
+        """
+        Updates the relevant download row to the failed state.
+        
+        @param uriKey: The key referring to the download row.
+        @type uriKey: str
+
+        @param message: The error message.
+        @type message: str
+        """
+        self.downloadRows[uriKey]['widget'].setEnabled(False)
+        self.downloadRows[uriKey]['textEdit'].setText(\
+                "FAILED<br><i>%s</i><br>%s"%(self.makeDownloadPath(\
+                        self.downloadRows[uriKey]['pathDict']), message))
+
+
         
 
+    def setIndexing(self, uriKey, indexed, total):
+        """
+        Updates the relevant download row to show the progress of adding 
+        its files to the DICOM database.  The row is enabled so the 
+        indexing can be cancelled.
         
+        @param uriKey: The key referring to the download row.
+        @type uriKey: str
+
+        @param indexed: The number of files indexed.
+        @type indexed: int
+
+        @param total: The number of files to index.
+        @type total: int
+        """
+        self.downloadRows[uriKey]['widget'].setEnabled(True)
+        self.downloadRows[uriKey]['textEdit'].setText(\
+                    "INDEXING<br>%s<br>%s out of %s files<br>"%(\
+                     self.makeDownloadPath(\
+                            self.downloadRows[uriKey]['pathDict']), 
+                            indexed, total))
+        self.setProgressBarValue(uriKey, indexed, 0, max(total, 1))
+
+
 
     def setEnabled(self, uriKey, enabled = True):
         """
@@ -559,3 +602,41 @@ class XnatDownloadPopup(XnatEmptyPopup):
         
     
 
+
+
+
+class XnatUploadPopup(XnatDownloadPopup):
+    """ 
+    Subclass of XnatDownloadPopup for the upload queue.  Its rows 
+    are keyed by the XNAT url of the upload.  It isn't modal, so the 
+    user can keep working while scenes upload.
+    """
+
+    ACTIVE_TEXT = 'UPLOADING'
+
+    def __init__(self, title = "XNAT Upload Queue", memDisplay = "MB"):
+        """ 
+        @param title: The window title.
+        @type title: string
+
+        @param memDisplay: The memory value to display.
+        @type memDisplay: string
+        """
+        super(XnatUploadPopup, self).__init__(title = title, 
+                                              memDisplay = memDisplay)
+        self.setWindowModality(0)
+
+
+
+    def addDownloadRow(self, uri, size = -1):
+        """ 
+        Replaces the row of an earlier upload to the same url (i.e. the 
+        scene was saved again while it uploaded).
+        """
+        if uri in self.downloadRows:
+            position = self.downloadRows.pop(uri)['queuePosition']
+            for row in self.downloadRows.values():
+                if row['queuePosition'] > position:
+                    row['queuePosition'] -= 1
+        super(XnatUploadPopup, self).addDownloadRow(uri, size)
+
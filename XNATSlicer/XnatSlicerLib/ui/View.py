@@ -50,6 +50,7 @@ class View(object):
         self.Setting = Setting
 
         self.sessionManager = SessionManager(self.MODULE)
+        self.revalidationTimer = None
         self.setup()
 
 
@@ -97,11 +98,16 @@ class View(object):
             self.clear()
             projectContents = None
 
+            #
+            # Projects from a previous session are shown straight away 
+            # and revalidated in the background (see 
+            # 'watchRevalidation').
+            #
             try:
                 projectContents = self.MODULE.XnatIo.\
                                   getFolder('projects', 
                                   Xnat.metadata.DEFAULT_TAGS['projects'], 
-                                            'accessible')
+                                            'accessible', allowStale = True)
 
             #
             # Error: SERVER ISSUES
@@ -130,6 +136,53 @@ class View(object):
         self.loadProjects(filters = None, projectContents = projectContents)
         slicer.app.processEvents()
         self.MODULE.Buttons.setEnabled(buttonKey='addFolder', enabled=True) 
+        self.watchRevalidation()
+
+
+
+
+    def watchRevalidation(self):
+        """
+        Runs the XnatIo events of any background revalidation of stale 
+        metadata on the GUI thread until it is done.  If the projects have 
+        changed since they were loaded, the View is reloaded.
+        """
+        if not self.MODULE.XnatIo.isRevalidating():
+            return
+
+        self.MODULE.XnatIo.clearEvents('metadataChanged')
+        self.MODULE.XnatIo.onEvent('metadataChanged', self.onMetadataChanged)
+        if not self.revalidationTimer:
+            self.revalidationTimer = qt.QTimer()
+            self.revalidationTimer.setInterval(100)
+            self.revalidationTimer.connect('timeout()', 
+                                           self.onRevalidationTimeout)
+        self.revalidationTimer.start()
+
+
+
+
+    def onRevalidationTimeout(self):
+        """
+        Polls the background revalidation (see 'watchRevalidation').
+        """
+        revalidating = self.MODULE.XnatIo.isRevalidating()
+        self.MODULE.XnatIo.dispatchEvents()
+        if not revalidating:
+            self.revalidationTimer.stop()
+
+
+
+
+    def onMetadataChanged(self, xnatUrl):
+        """
+        Callback for when revalidated metadata turns out to have changed.
+
+        @param xnatUrl: The url of the metadata.
+        @type xnatUrl: str
+        """
+        if xnatUrl.split('?')[0].endswith('/projects'):
+            self.begin(skipAnim = True, hardReset = True)
 
 
 
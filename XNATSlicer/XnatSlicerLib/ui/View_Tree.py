@@ -42,6 +42,7 @@ class View_Tree(View, qt.QTreeWidget):
     """  
 
     DEFAULT_FONT_SIZE = 10
+    POPULATE_BATCH_SIZE = 200
     
     def setup(self):
         """ 
@@ -1360,13 +1361,31 @@ class View_Tree(View, qt.QTreeWidget):
 
                 
         #--------------------
-        # Get folder contents via metadata.  
-        # Set nodeNames from metadata.
+        # Get folder contents via metadata, adding the child items in 
+        # batches as the rows are parsed, so that large folders appear 
+        # progressively.  
+        #
+        # NOTE: DICOM files in scans are condensed to one item by 
+        # 'makeTreeItems', so those are added at once.
         #-------------------- 
-        metadata = self.MODULE.XnatIo.getFolder(pathObj['childQueryUris'], 
-                                                Xnat.metadata.\
-                                                getTagsByLevel(currXnatLevel), \
-                                                queryArguments)
+        tags = Xnat.metadata.getTagsByLevel(currXnatLevel)
+        xnatLabel = self.getMergedLabelTagByLevel(currXnatLevel)
+        condense = pathObj['childXnatLevel'] == 'files' and \
+                   self.getXnatUriObject(item.parent())['currLevel'] == \
+                   'scans' and self.isDICOMFolder(item)
+        rows = []
+        childKeys = set()
+        for row in self.MODULE.XnatIo.iterFolder(pathObj['childQueryUris'], 
+                                                 tags, queryArguments):
+            rows.append(row)
+            if not condense and len(rows) == self.POPULATE_BATCH_SIZE:
+                childKeys.update(self.addChildRows(item, rows, tags, 
+                                                   xnatLabel, 
+                                                   pathObj['childXnatLevel']))
+                rows = []
+                slicer.app.processEvents()
+        childKeys.update(self.addChildRows(item, rows, tags, xnatLabel, 
+                                           pathObj['childXnatLevel']))
 
 
 
@@ -1375,28 +1394,12 @@ class View_Tree(View, qt.QTreeWidget):
         # (Means that there are no children to the 
         # node).
         #--------------------        
-        xnatLabel = self.getMergedLabelTagByLevel(currXnatLevel)
-        if not xnatLabel in metadata:
+        if not xnatLabel in childKeys:
             ##print "NO XNAT LABEL"
             return
 
 
         
-        #--------------------
-        # Set the child names based on the level, metadata key
-        #--------------------
-        childNames = metadata[xnatLabel]
-
-        
-        
-        #--------------------
-        # Set the categories of the children.
-        #--------------------
-        metadata['XNAT_LEVEL'] = [pathObj['childXnatLevel'] \
-                                  for x in range(len(childNames))]
-
-
-        
         #--------------------
         # Special case for children with Slicer URIs
         #--------------------
@@ -1410,60 +1413,96 @@ class View_Tree(View, qt.QTreeWidget):
             # files exists 
             #
             if self.getMergedLabelTagByLevel('files') in slicerMetadata:
+                #
+                # The files of scenes saved as separate files are kept
+                # in a folder below their MRML (see Loader_Scene): only 
+                # the MRML is shown.
+                #
+                if 'URI' in slicerMetadata:
+                    shown = [i for i, uri in enumerate(slicerMetadata['URI'])
+                             if not '/' in uri.split('/files/', 1)[-1]]
+                    for key in slicerMetadata:
+                        if len(slicerMetadata[key]) == \
+                           len(slicerMetadata['URI']):
+                            slicerMetadata[key] = [slicerMetadata[key][i] 
+                                                   for i in shown]
                 slicerChildNames = slicerMetadata[\
                                     self.getMergedLabelTagByLevel('files')]
-                prevLen = len(childNames)
-                childNames = childNames + slicerChildNames 
                 #
-                # Merge slicerMetadata with metadata
+                # Only keep the keys that the other children don't have.  
+                # For instance, Scans do not share the 'Name' key, 
+                # even though they are displayed at the same depth in 
+                # the tree hierarchy.
                 #
-                for key in slicerMetadata:
-                    if not key in metadata:
-                        #
-                        # Set empty strings for keys that aren't shared.  
-                        # For instance, Scans do not share the 'Name' key, 
-                        # even though they are displayed at the same depth in 
-                        # the tree hierarchy.
-                        #
-                        metadata[key] = [''] * prevLen
-                        metadata[key] += slicerMetadata[key]
-
-                        if (key == 'Size'):
-                            for i in range(0, len(metadata[key])):
-                                if metadata[key][i]:
-                                    metadata[key][i] = '%i MB'%(int(round(\
-                                                       MokaUtils.convert.\
-                                                        bytesToMB(metadata[key]\
-                                                                [i]))))
-                metadata['XNAT_LEVEL'] = metadata['XNAT_LEVEL'] + \
-                            ['Slicer' for x in range(len(slicerChildNames))]  
-                
+                for key in slicerMetadata.keys():
+                    if key in childKeys:
+                        del slicerMetadata[key]
+                    elif (key == 'Size'):
+                        for i in range(0, len(slicerMetadata[key])):
+                            if slicerMetadata[key][i]:
+                                slicerMetadata[key][i] = '%i MB'%(int(round(\
+                                                   MokaUtils.convert.\
+                                                    bytesToMB(\
+                                                    slicerMetadata[key][i]))))
+                slicerMetadata['XNAT_LEVEL'] = ['Slicer' for x in \
+                                                range(len(slicerChildNames))]
+                self.makeTreeItems(parentItem = item, 
+                                   children = slicerChildNames, 
+                                   metadata = slicerMetadata, 
+                                   expandible = [1] * len(slicerChildNames))
 
-            
+
+        item.setExpanded(True)
+        self.setCurrentItem(item) 
+
+
+
+
+    def addChildRows(self, item, rows, tags, xnatLabel, childXnatLevel):
+        """ 
+        Adds tree items for rows of XNAT metadata (see 'getChildren').
+
+        @param item: The parent item.
+        @type item: qt.QTreeWidgetItem
+
+        @param rows: The metadata rows of the children.
+        @type rows: list.<dict>
+
+        @param tags: The metadata tags to keep.
+        @type tags: list.<str>
+
+        @param xnatLabel: The metadata tag that labels the children.
+        @type xnatLabel: str
+
+        @param childXnatLevel: The XNAT level of the children.
+        @type childXnatLevel: str
+
+        @return: The metadata keys of the added children.
+        @rtype: list.<str>
+        """
+        metadata = Xnat.metadata.toColumns(rows, tags)
+        if not xnatLabel in metadata:
+            return metadata.keys()
+
+        
         #--------------------
-        # Determine expandibility of the child node.
-        #--------------------    
-        expandible = []
-        for i in range(0, len(metadata['XNAT_LEVEL'])):
-            level = metadata['XNAT_LEVEL'][i]
-            #
-            # 'files' and 'Slicer' category are
-            # immediately ruled as unexpandable (1).
-            #
-            if (level == 'files' or level == 'Slicer') :
-                expandible.append(1)
-            else:
-                expandible.append(0)
+        # Set the child names and categories based on the level, metadata 
+        # key.  'files' are unexpandable (1).
+        #--------------------
+        childNames = metadata[xnatLabel]
+        metadata['XNAT_LEVEL'] = [childXnatLevel \
+                                  for x in range(len(childNames))]
+        expandible = [1 if childXnatLevel == 'files' else 0] * \
+                     len(childNames)
 
 
-                
+        
         #--------------------
         # Make the treeItems
         #-------------------- 
         self.makeTreeItems(parentItem = item, children = childNames, \
                            metadata = metadata, expandible = expandible)
-        item.setExpanded(True)
-        self.setCurrentItem(item) 
+        return metadata.keys()
             
 
         
@@ -0,0 +1,461 @@
+__author__ = "Sunil Kumar (kumar.sunil.p@gmail.com)"
+__copyright__ = "Copyright 2014, Washington University in St. Louis"
+__credits__ = ["Sunil Kumar", "Steve Pieper", "Dan Marcus"]
+__license__ = "XNAT Software License Agreement " + \
+              "(see: http://xnat.org/about/license.php)"
+__version__ = "2.1.1"
+__maintainer__ = "Rick Herrick"
+__email__ = "herrickr@mir.wustl.edu"
+__status__ = "Production"
+
+
+# python
+import os
+import time
+import sqlite3
+import hashlib
+
+
+
+
+class CacheIndex(object):
+    """
+    CacheIndex keeps an index of the files downloaded into the XNATSlicer
+    cache (XnatSlicerGlobals.LOCAL_URIS['downloads']) so the loaders can
+    look them up without walking the cache, and so the cache can be kept
+    to a size.
+
+    Files are indexed by their XNAT URI, which is their path relative to
+    the cache (i.e. '/data/experiments/.../files/1.dcm'), along with their
+    size, checksum (if known) and the time they were last used.
+    'evict' removes the least recently used files until the cache fits
+    its size.  Files in the current scene are pinned, and never evicted.
+
+    Looked up files can be checked against the checksums (MD5 digests) 
+    XNAT lists for them.  A file is only hashed if its checksum isn't 
+    indexed yet (i.e. its download wasn't verified), after which it is.
+
+    DICOM files are also indexed by the URI of the file on XNAT, along 
+    with their series in slicer.dicomDatabase and their scan, so cached 
+    scans can be found and loaded without searching the database.  The 
+    database refers to the files where they are in the cache, so DICOM 
+    files are evicted a series at a time, after the series is removed 
+    from the database.
+
+    The index is kept in an SQLite database.  Files already in the cache
+    when the database is created are indexed then.
+    """
+
+    CHECKSUM_BUFFER_SIZE = 1024 * 1024
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            uri TEXT PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            checksum TEXT,
+            lastAccess REAL
+        );
+        CREATE INDEX IF NOT EXISTS filesByAccess ON files (lastAccess);
+        CREATE INDEX IF NOT EXISTS filesByPath ON files (path);
+        CREATE TABLE IF NOT EXISTS dicom (
+            uri TEXT PRIMARY KEY,
+            path TEXT,
+            series TEXT,
+            scan TEXT
+        );
+        CREATE INDEX IF NOT EXISTS dicomByPath ON dicom (path);
+        CREATE INDEX IF NOT EXISTS dicomByScan ON dicom (scan);
+        CREATE TABLE IF NOT EXISTS info (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+
+
+    def __init__(self, root, path):
+        """
+        @param root: The directory of the cache.
+        @type root: str
+
+        @param path: The path of the index database.
+        @type path: str
+        """
+        self.root = os.path.normpath(root)
+        self.pinned = set()
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.database = sqlite3.connect(path)
+        self.database.executescript(self.SCHEMA)
+
+        #--------------------
+        # Index what's already in the cache.
+        #--------------------
+        if not self.database.execute("SELECT value FROM info WHERE " +
+                                     "key = 'indexed'").fetchone():
+            self.add(self.__walk(self.root))
+            with self.database:
+                self.database.execute("INSERT INTO info VALUES " +
+                                      "('indexed', ?)", (time.time(),))
+
+
+
+    def __walk(self, directory):
+        """
+        @param directory: The directory to list.
+        @type directory: str
+
+        @return: The paths of the files in 'directory' and below.
+        @rtype: list(str)
+        """
+        paths = []
+        for root, dirs, files in os.walk(directory):
+            for fileName in files:
+                paths.append(os.path.join(root, fileName))
+        return paths
+
+
+
+    def getUri(self, path):
+        """
+        @param path: The path of a file in the cache.
+        @type path: str
+
+        @return: The XNAT URI of the file (its path relative to the cache).
+        @rtype: str
+        """
+        return '/' + os.path.relpath(os.path.normpath(path),
+                                     self.root).replace('\\', '/')
+
+
+
+    def add(self, paths, checksums = None):
+        """
+        Indexes files, i.e. once they are downloaded.  Files that are
+        already indexed are updated.
+
+        @param paths: The paths of the files.
+        @type paths: list(str)
+
+        @param checksums: The checksums of the files, by path, if known.
+        @type checksums: dict
+        """
+        checksums = checksums or {}
+        now = time.time()
+        rows = []
+        for path in paths:
+            if os.path.isfile(path):
+                rows.append((self.getUri(path), path, os.path.getsize(path),
+                             checksums.get(path), now))
+        with self.database:
+            self.database.executemany("INSERT OR REPLACE INTO files " +
+                                      "VALUES (?, ?, ?, ?, ?)", rows)
+
+
+
+    def lookup(self, uris, checksums = None):
+        """
+        Finds the files of the given URIs that are in the cache, marking
+        them as used.  Indexed files that are no longer on disk are
+        dropped from the index.
+
+        @param uris: The XNAT URIs to look up.
+        @type uris: list(str)
+
+        @param checksums: The checksums the files should have, by URI, if 
+            known.  Files that don't match aren't found.
+        @type checksums: dict
+
+        @return: The paths of the cached files, by URI.
+        @rtype: dict
+        """
+        checksums = checksums or {}
+        found = {}
+        missing = []
+        for uri in uris:
+            row = self.database.execute("SELECT path FROM files WHERE " +
+                                        "uri = ?", (uri,)).fetchone()
+            if not row:
+                continue
+            if not os.path.isfile(row[0]):
+                missing.append((uri,))
+            elif self.isVerified(row[0], checksums.get(uri)):
+                found[uri] = row[0]
+
+        with self.database:
+            self.database.executemany("DELETE FROM files WHERE uri = ?",
+                                      missing)
+        self.touch(found.keys())
+        return found
+
+
+
+    @staticmethod
+    def getScanUri(uri):
+        """
+        @param uri: The XNAT URI of a file of a scan.
+        @type uri: str
+
+        @return: The XNAT URI of the scan, i.e. 
+            '/data/experiments/E/scans/1'.
+        @rtype: str
+        """
+        if not '/scans/' in uri:
+            return None
+        splitScan = uri.split('/scans/')
+        return splitScan[0] + '/scans/' + splitScan[1].split('/')[0]
+
+
+
+    def addDicom(self, files):
+        """
+        Indexes DICOM files in slicer.dicomDatabase by their URI on XNAT.
+
+        @param files: The (XNAT URI, database file path, series UID) of 
+            each file.
+        @type files: list(tuple)
+        """
+        with self.database:
+            self.database.executemany("INSERT OR REPLACE INTO dicom " +
+                                      "VALUES (?, ?, ?, ?)", 
+                                      [(uri, path, series, 
+                                        self.getScanUri(uri)) 
+                                       for uri, path, series in files])
+
+
+
+    def lookupDicom(self, uris, checksums = None):
+        """
+        Finds the DICOM files of the given XNAT URIs that are indexed and 
+        still in the cache, marking them as used.
+
+        @param uris: The XNAT URIs of the files.
+        @type uris: list(str)
+
+        @param checksums: The checksums the files should have, by URI, if 
+            known.  Files that don't match aren't found.
+        @type checksums: dict
+
+        @return: The (database file path, series UID) of each found file, 
+            by XNAT URI.
+        @rtype: dict
+        """
+        checksums = checksums or {}
+        found = {}
+        for uri in uris:
+            row = self.database.execute("SELECT path, series FROM dicom " +
+                                        "WHERE uri = ?", (uri,)).fetchone()
+            if row and os.path.isfile(row[0]) and \
+               self.isVerified(row[0], checksums.get(uri)):
+                found[uri] = row
+        self.touch([self.getUri(path) for path, series in found.values()])
+        return found
+
+
+
+    def getScanSeries(self, scanUri):
+        """
+        @param scanUri: The XNAT URI of a scan.
+        @type scanUri: str
+
+        @return: The UIDs of the indexed series of the scan.
+        @rtype: list(str)
+        """
+        return [row[0] for row in self.database.execute(
+            "SELECT DISTINCT series FROM dicom WHERE scan = ?", (scanUri,))]
+
+
+
+    def isVerified(self, path, checksum):
+        """
+        Checks a cached file against its checksum.  The indexed checksum 
+        is used if there is one; otherwise the file is hashed, and the 
+        checksum indexed if it matches.
+
+        @param path: The path of the file.
+        @type path: str
+
+        @param checksum: The MD5 digest the file should have, if known.
+        @type checksum: str
+
+        @return: Whether the file matches 'checksum' (True if there is 
+            none to check).
+        @rtype: bool
+        """
+        if not checksum:
+            return True
+        checksum = checksum.lower()
+        row = self.database.execute("SELECT checksum FROM files WHERE " +
+                                    "path = ?", (path,)).fetchone()
+        if row and row[0]:
+            return row[0] == checksum
+        if self.getChecksum(path) != checksum:
+            return False
+        with self.database:
+            self.database.execute("UPDATE files SET checksum = ? WHERE " +
+                                  "path = ?", (checksum, path))
+        return True
+
+
+
+    def getChecksum(self, path):
+        """
+        @param path: The path of a file.
+        @type path: str
+
+        @return: The MD5 digest of the file.
+        @rtype: str
+        """
+        hasher = hashlib.md5()
+        with open(path, 'rb') as f:
+            for buffer in iter(lambda: f.read(self.CHECKSUM_BUFFER_SIZE), 
+                               ''):
+                hasher.update(buffer)
+        return hasher.hexdigest()
+
+
+
+    def touch(self, uris):
+        """
+        Marks files as used.
+
+        @param uris: The XNAT URIs of the files.
+        @type uris: list(str)
+        """
+        now = time.time()
+        with self.database:
+            self.database.executemany("UPDATE files SET lastAccess = ? " +
+                                      "WHERE uri = ?",
+                                      [(now, uri) for uri in uris])
+
+
+
+    def pin(self, paths):
+        """
+        Keeps files from being evicted, i.e. while they are in the scene.
+
+        @param paths: The paths of the files.
+        @type paths: list(str)
+        """
+        self.pinned.update([self.getUri(path) for path in paths])
+
+
+
+    def unpin(self, paths = None):
+        """
+        Allows files to be evicted again.
+
+        @param paths: The paths of the files.  Every file is unpinned if
+            not provided (i.e. when the scene is closed).
+        @type paths: list(str)
+        """
+        if paths == None:
+            self.pinned = set()
+            return
+        self.pinned.difference_update([self.getUri(path) for path in paths])
+
+
+
+    def getSize(self):
+        """
+        @return: The total size of the indexed files in bytes.
+        @rtype: int
+        """
+        return int(self.database.execute("SELECT TOTAL(size) " +
+                                         "FROM files").fetchone()[0])
+
+
+
+    def evict(self, maxBytes, dicomDatabase = None):
+        """
+        Removes the least recently used files that aren't pinned until the
+        cache is no bigger than 'maxBytes'.  The files of a DICOM series 
+        are removed together, once the series is removed from 
+        'dicomDatabase'.  Without a database, DICOM files are kept, and 
+        left out of the size.
+
+        @param maxBytes: The size to keep the cache to.
+        @type maxBytes: int
+
+        @param dicomDatabase: The database the DICOM files are indexed in, 
+            i.e. slicer.dicomDatabase.
+        @type dicomDatabase: ctkDICOMDatabase
+
+        @return: The paths of the removed files.
+        @rtype: list(str)
+        """
+        size = self.getSize()
+        if size <= maxBytes:
+            return []
+
+
+
+        #--------------------
+        # Group the files into what's evicted together (a file, or the 
+        # files of a series), least recently used first.
+        #--------------------
+        groups = {}
+        rows = self.database.execute("SELECT files.uri, files.path, " +
+                                     "files.size, files.lastAccess, " +
+                                     "dicom.series FROM files LEFT JOIN " +
+                                     "dicom ON dicom.path = files.path"
+                                     ).fetchall()
+        for uri, path, fileSize, lastAccess, series in rows:
+            group = groups.setdefault(series or uri, {'series': series, 
+                                                      'files': [], 
+                                                      'lastAccess': 0, 
+                                                      'pinned': False})
+            group['files'].append((path, fileSize))
+            group['lastAccess'] = max(group['lastAccess'], lastAccess)
+            group['pinned'] = group['pinned'] or uri in self.pinned
+            if series and dicomDatabase == None:
+                size -= fileSize
+
+
+
+        #--------------------
+        # Remove them until the cache fits.
+        #--------------------
+        evicted = []
+        released = []
+        for group in sorted(groups.values(), 
+                            key = lambda group: group['lastAccess']):
+            if size <= maxBytes:
+                break
+            if group['pinned'] or \
+               (group['series'] and dicomDatabase == None):
+                continue
+            if group['series']:
+                dicomDatabase.removeSeries(group['series'])
+                released += [path for path, fileSize in group['files']]
+            for path, fileSize in group['files']:
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError, e:
+                    # i.e. the file is open on Windows.
+                    continue
+                evicted.append(path)
+                size -= fileSize
+
+        with self.database:
+            self.database.executemany("DELETE FROM files WHERE path = ?", 
+                                      [(path,) for path in evicted])
+            self.database.executemany("DELETE FROM dicom WHERE path = ?", 
+                                      [(path,) for path in released])
+
+
+
+        #--------------------
+        # Remove the directories emptied by the eviction.
+        #--------------------
+        for directory in set([os.path.dirname(path) for path in evicted]):
+            while directory.startswith(self.root) and \
+                  directory != self.root and os.path.isdir(directory) and \
+                  not os.listdir(directory):
+                os.rmdir(directory)
+                directory = os.path.dirname(directory)
+
+        return evicted
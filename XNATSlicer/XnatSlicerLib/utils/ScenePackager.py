@@ -17,8 +17,11 @@ import datetime, time
 import os
 import sys
 import shutil
+import tempfile
+import Queue
+import threading
 from contextlib import closing
-from zipfile import ZipFile, ZIP_DEFLATED
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
 
 
 from XnatSlicerGlobals import *
@@ -38,16 +41,27 @@ class ScenePackager(object):
     ScenePackager is used for the Save / upload process.  When 
     sending a scene to XNAT, the class calls the necessary slicer.app API 
     functions to get all of the scene's files into a .zip (or .mrb).  
-    
-    TODO : 
+
+    The .mrb is written by 'packageDirectory', which moves each file of 
+    the saved bundle directory into the archive, so the scene is only 
+    written once more rather than copied and then zipped.  Files that 
+    are compressed already (see 'isCompressed') are stored rather than 
+    deflated again, and 'compression' can be set to ZIP_STORED to store 
+    everything.
     """
        
     VTK_EXT = '.vtk'
+    COMPRESSED_EXTS = ['.gz', '.bz2', '.zip', '.mgz', '.mrb', 
+                       '.png', '.jpg', '.jpeg']
+    NRRD_EXTS = ['.nrrd', '.nhdr']
+    NRRD_COMPRESSED_ENCODINGS = ['gzip', 'gz', 'bzip2', 'bz2']
+    NRRD_MAX_HEADER_LINES = 1024
 
     def __init__(self, MODULE = None):
         """ Init function.
         """
         self.MODULE = MODULE
+        self.compression = ZIP_DEFLATED
 
     
     def saveSlicerScene(self, args):
@@ -65,34 +79,15 @@ class ScenePackager(object):
 
 
         #-------------------
-        # Create a directory for saving locally.
+        # Create a directory for saving locally.  Each save gets a 
+        # directory of its own, so a new save of a scene doesn't 
+        # overwrite the files of an earlier one that is still uploading.
+        # The directory is removed once its upload is done (see 
+        # Workflow_Save).
         #-------------------
-        saveDirectory = os.path.join(XnatSlicerGlobals.LOCAL_URIS['uploads'], \
-                                     packageName)
-        ##print MokaUtils.debug.lf() +  "CREATE PACKAGE DIRECTORY: %s"%(saveDirectory)
-
-
-
-        #-------------------
-        # Try to remove the existing local directory 
-        # with the same name if it exists
-        #-------------------
-        try:
-            ##print MokaUtils.debug.lf() + ("%s does not exist. Making it."%(saveDirectory)) 
-            if os.path.exists(saveDirectory): 
-                shutil.rmtree(saveDirectory)
-        except Exception, e: 
-            pass
-
-
-
-        #-------------------
-        # Make the local save directory.
-        #-------------------        
-        try: 
-            os.mkdir(saveDirectory)
-        except Exception, e: 
-            pass
+        saveDirectory = os.path.join(tempfile.mkdtemp(dir = \
+                        XnatSlicerGlobals.LOCAL_URIS['uploads']), packageName)
+        os.mkdir(saveDirectory)
 
 
 
@@ -143,33 +138,94 @@ class ScenePackager(object):
 
 
 
-    def convertAllBinaryVtksToAscii(self, projectDir):
+    def convertAllBinaryVtksToAscii(self, projectDir, onProgress = None):
         """
+        Converts the binary legacy .vtk files in a directory to ASCII, one 
+        at a time, off the GUI thread, so 'onProgress' can keep Slicer 
+        updated meanwhile.  (VTK holds the GIL while it reads and writes, 
+        so more threads wouldn't convert any faster.)  Files that are 
+        ASCII already, and XML VTK files, are left as they are.
+
         @param projectDir: The vtk filename
         @type projectDir: string
+
+        @param onProgress: The callback run on this thread, with the 
+            number of files converted so far and the number to convert, 
+            while the files are converted.
+        @type onProgress: function
          
-        @return: Whether the file was converted (1 or 0) for every file.
+        @return: Whether the file was converted (1 or 0) for every binary 
+            file.
         @rtype: array.<number>
         """
 
         #
-        # Get the vtk files in the directory 
+        # Get the binary vtk files in the directory 
         #
-        vtks = []
+        vtkFiles = []
         for root, dirs, files in os.walk(projectDir):
             for relFileName in files:
-                if relFileName.lower().endswith(ScenePackager.VTK_EXT):
-                    vtks.append(os.path.join(root, relFileName))
+                vtkFile = os.path.join(root, relFileName)
+                if relFileName.lower().endswith(ScenePackager.VTK_EXT) and \
+                   not self.isAsciiVtk(vtkFile):
+                    vtkFiles.append(vtkFile)
+        total = len(vtkFiles)
+
         #
-        # Convert the files
+        # Convert the files on a worker, which stops at the first error.
         #
+        finished = Queue.Queue()
+        def convert():
+            for vtkFile in vtkFiles:
+                try:
+                    finished.put((self.convertBinaryVtkToAscii(vtkFile), 
+                                  None))
+                except Exception, e:
+                    finished.put((0, e))
+                    return
+
+        worker = threading.Thread(target = convert)
+        worker.daemon = True
+        worker.start()
+
         converteds = []
-        for vtkFile in vtks:
-            converteds.append(self.convertBinaryVtkToAscii(vtkFile))
+        error = None
+        while len(converteds) < total and not error:
+            try:
+                converted, error = finished.get(True, 0.1)
+                if not error:
+                    converteds.append(converted)
+            except Queue.Empty:
+                pass
+            if onProgress:
+                onProgress(len(converteds), total)
+
+        #
+        # Don't leave the worker writing into the bundle.
+        #
+        worker.join()
+        if error:
+            raise error
         return converteds
 
 
 
+    def isAsciiVtk(self, vtkFile):
+        """
+        @param vtkFile: The vtk filename
+        @type vtkFile: string
+
+        @return: Whether the legacy vtk file is ASCII, per the third line 
+            of its header.
+        @rtype: bool
+        """
+        with open(vtkFile, 'rb') as f:
+            for i in range(3):
+                line = f.readline()
+        return line.strip().upper() == 'ASCII'
+
+
+
     def storeSceneView(self, name, description=""):
         """  
 
@@ -240,10 +296,58 @@ class ScenePackager(object):
 
 
     
-    def convertDirectoryToZip(self, zipFileName, directoryToZip):
-        """ Zips the bundled directory according to the
-            native API methods.
+    def isCompressed(self, filename):
+        """
+        @param filename: The path of a file.
+        @type filename: string
+
+        @return: Whether the file is compressed already, by its extension 
+            or, for NRRDs, the 'encoding' field of its header.
+        @rtype: bool
+        """
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in ScenePackager.COMPRESSED_EXTS:
+            return True
+        if not ext in ScenePackager.NRRD_EXTS:
+            return False
+
+        #
+        # The header ends at the first blank line.
+        #
+        with open(filename, 'rb') as f:
+            for i in range(ScenePackager.NRRD_MAX_HEADER_LINES):
+                line = f.readline().strip()
+                if not line:
+                    break
+                if line.lower().startswith('encoding:'):
+                    return line.split(':', 1)[1].strip().lower() in \
+                        ScenePackager.NRRD_COMPRESSED_ENCODINGS
+        return False
+
+
+
+    def packageDirectory(self, zipFileName, directoryToZip):
+        """
+        Moves the files of the bundle directory into a zip (i.e. the .mrb), 
+        removing each file once it is in the archive, then the directory.  
+        As with slicer.app.applicationLogic().Zip, the archive holds the 
+        directory itself, not just its contents.
+
+        @param zipFileName: The path of the zip to write.
+        @type zipFileName: string
+
+        @param directoryToZip: The bundle directory.
+        @type directoryToZip: string
         """
-        slicer.app.applicationLogic().Zip(str(zipFileName), str(directoryToZip))
-        #return
-  
+        parentDir = os.path.dirname(os.path.normpath(directoryToZip))
+        with closing(ZipFile(zipFileName, 'w', self.compression, 
+                             allowZip64 = True)) as z:
+            for root, dirs, files in os.walk(directoryToZip):
+                for fileName in files:
+                    filename = os.path.join(root, fileName)
+                    compression = ZIP_STORED if self.isCompressed(filename) \
+                                  else self.compression
+                    z.write(filename, os.path.relpath(filename, parentDir), 
+                            compression)
+                    os.remove(filename)
+        shutil.rmtree(directoryToZip)
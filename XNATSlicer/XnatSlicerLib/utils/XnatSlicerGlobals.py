@@ -29,6 +29,7 @@ class XnatSlicerGlobals(object):
         "projects" : os.path.join(CACHE_URI, "projects"),
         "downloads" : os.path.join(CACHE_URI, "downloads"),
         "uploads" : os.path.join(CACHE_URI, "uploads"), 
+        "metadata" : os.path.join(CACHE_URI, "metadata"),
         "icons" : os.path.join(RESOURCES_URI, "Icons"),                       
     }
     